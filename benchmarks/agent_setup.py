@@ -0,0 +1,55 @@
+"""
+    Microbenchmark of the per-request agent setup cost.
+
+    Compares building a new `Agent` + `Task` on every request (the old behaviour of `manage_events`)
+    with borrowing a prebuilt agent from the `AgentPool` and only building the `Task`.
+    No LLM or Composio call is made.
+
+    Usage: python -m benchmarks.agent_setup [iterations]
+"""
+
+import os
+import sys
+import time
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("COMPOSIO_API_KEY", "benchmark")
+
+from crewai import Task
+from utils.manage_events import build_calendar_agent, agent_pool
+
+
+def build_task(agent):
+    return Task(
+        description="Manage events in Google Calendar based on: \n list my events today \n",
+        agent=agent,
+        expected_output="A short answer.",
+    )
+
+
+def per_request(iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        build_task(build_calendar_agent())
+    return (time.perf_counter() - start) / iterations
+
+
+def pooled(iterations: int) -> float:
+    agent_pool.warm_up(1)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with agent_pool.acquire() as agent:
+            build_task(agent)
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    before = per_request(iterations)
+    after = pooled(iterations)
+
+    print(f"iterations:            {iterations}")
+    print(f"new agent per request: {before * 1000:.3f} ms")
+    print(f"pooled agent:          {after * 1000:.3f} ms")
+    print(f"speedup:               {before / after:.1f}x")
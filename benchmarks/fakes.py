@@ -0,0 +1,326 @@
+"""
+    Local stand-ins for Discord, the LLM, Composio and Google Calendar used by the benchmarks.
+"""
+
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import requests
+
+
+# ---- Discord ----
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.sent = 0
+        self.edits = 0
+
+    async def send(self, content: str = None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, content)
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, content: str):
+        self.channel = channel
+        self.content = content
+        self.mentions = []
+        self.attachments = []
+
+    async def edit(self, content: str = None, **kwargs):
+        self.channel.edits += 1
+        self.content = content
+
+
+class FakeContext:
+    """
+        The parts of `commands.Context` used by the commands. `responses` collects the sent messages.
+    """
+
+    def __init__(self, user_id: int, guild_id: int | None, channel: FakeChannel, content: str = ""):
+        self.author = FakeUser(user_id)
+        self.guild = FakeGuild(guild_id) if guild_id is not None else None
+        self.channel = channel
+        self.message = FakeMessage(channel, content)
+        self.message.author = self.author
+        self.responses = []
+
+    async def send(self, content: str = None, **kwargs):
+        message = await self.channel.send(content, **kwargs)
+        self.responses.append(message)
+        return message
+
+
+class FakeGateway:
+    """
+        Measures how late the event loop runs a heartbeat, like discord.py's gateway keep-alive.
+        A blocked loop shows up as a large `max_lag`.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.beats = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.max_lag = max(self.max_lag, time.perf_counter() - expected)
+            self.beats += 1
+
+
+# ---- LLM ----
+
+def build_scripted_llm(latency: float = 0.5, tool: str = "Find Events"):
+    """
+        Build a chat model which plays a deterministic ReAct conversation: it calls `tool` once for the
+        connected account of the prompt, then gives a final answer. Every call sleeps `latency` seconds.
+    """
+
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    class ScriptedLLM(BaseChatModel):
+        latency: float = 0.5
+        tool: str = "Find Events"
+        calls: int = 0
+
+        @property
+        def _llm_type(self) -> str:
+            return "scripted"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            self.calls += 1
+
+            prompt = "\n".join(str(message.content) for message in messages)
+            if "Observation:" in prompt:
+                text = "Thought: I now know the final answer\nFinal Answer: Here are your events 📅"
+            else:
+                account = re.search(r"\(connectedAccountId\) is (\S+)", prompt)
+                arguments = {"connectedAccountId": account.group(1).rstrip(".") if account else ""}
+                text = f"Thought: I should look at the calendar\nAction: {self.tool}\nAction Input: {json.dumps(arguments)}"
+
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    return ScriptedLLM(latency=latency, tool=tool)
+
+
+# ---- Composio and Google Calendar ----
+
+class StubBackend:
+    """
+        In-memory calendars of the stub server.
+    """
+
+    def __init__(self, events_per_account: int = 20):
+        self.events_per_account = events_per_account
+        self.calendars = {} # connected account ID -> {event ID: event}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def events(self, account: str) -> dict:
+        with self.lock:
+            events = self.calendars.get(account)
+            if events is None:
+                start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+                events = self.calendars[account] = {}
+                for number in range(self.events_per_account):
+                    event_start = start + timedelta(hours=5 * number)
+                    event = self.make_event(f"Event {number % 7}", event_start, event_start + timedelta(minutes=30))
+                    events[event["id"]] = event
+            return events
+
+    @staticmethod
+    def make_event(title: str, start: datetime, end: datetime, attendees: list | None = None) -> dict:
+        return {
+            "id": uuid.uuid4().hex,
+            "summary": title,
+            "start": {"dateTime": start.isoformat()},
+            "end": {"dateTime": end.isoformat()},
+            "attendees": [{"email": email} for email in attendees or []],
+            "status": "confirmed",
+        }
+
+    def execute(self, action: str, account: str, data: dict) -> dict:
+        events = self.events(account)
+
+        if action == "googlecalendar_find_event":
+            found = list(events.values())
+            if data.get("query"):
+                found = [event for event in found if data["query"].lower() in event["summary"].lower()]
+            return {"event_data": found[:data.get("max_results") or 250]}
+
+        if action in ("googlecalendar_create_event", "googlecalendar_quick_add"):
+            start = datetime.fromisoformat(data.get("start_datetime") or datetime.now(timezone.utc).isoformat())
+            end = datetime.fromisoformat(data["end_datetime"]) if data.get("end_datetime") else start + timedelta(hours=1)
+            event = self.make_event(data.get("summary") or data.get("text") or "Event", start, end, data.get("attendees"))
+            with self.lock:
+                events[event["id"]] = event
+            return {"response_data": event}
+
+        if action == "googlecalendar_delete_event":
+            with self.lock:
+                events.pop(data["event_id"], None)
+            return {}
+
+        if action == "googlecalendar_update_event":
+            event = events.get(data["event_id"])
+            if event is not None and data.get("summary"):
+                event["summary"] = data["summary"]
+            return {"response_data": event or {}}
+
+        return {}
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    backend: StubBackend = None
+    latency: float = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        self.backend.requests += 1
+        payload = self._read()
+        path = urlparse(self.path).path
+
+        match = re.fullmatch(r"/api/v1/actions/(\w+)/execute", path)
+        if match:
+            response = self.backend.execute(match.group(1), payload["connectedAccountId"], payload.get("input", {}))
+            self._reply({"executed": True, "response": response})
+        elif path == "/api/v1/connectedAccounts":
+            account = uuid.uuid4().hex
+            self._reply({"connectedAccountId": account, "redirectUrl": f"http://localhost/connect/{account}", "connectionStatus": "INITIATED"})
+        else:
+            self._reply({"message": "Not found"}, 404)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.backend.requests += 1
+        url = urlparse(self.path)
+
+        match = re.fullmatch(r"/api/v1/connectedAccounts/(\w+)", url.path)
+        if match:
+            self._reply({
+                "id": match.group(1),
+                "status": "ACTIVE",
+                "connectionParams": {"access_token": "token", "refresh_token": "refresh", "client_id": "client", "client_secret": "secret"},
+            })
+            return
+
+        # Google Calendar `events.list` of the stub calendars, see `StubCalendarService`
+        match = re.fullmatch(r"/calendar/v3/(\w+)/events", url.path)
+        if match:
+            query = parse_qs(url.query)
+            items = list(self.backend.events(match.group(1)).values())
+            self._reply({"items": items, "nextSyncToken": "sync-" + str(int(time.time()))} if "syncToken" not in query else {"items": [], "nextSyncToken": query["syncToken"][0]})
+            return
+
+        self._reply({"message": "Not found"}, 404)
+
+
+class StubServer:
+    """
+        Local HTTP server standing in for the Composio API (`/api/v1/...`) and Google Calendar `events.list`.
+
+        :param optional latency: Seconds every request takes.
+        :param optional events_per_account: Number of events in every stub calendar.
+    """
+
+    def __init__(self, latency: float = 0.05, events_per_account: int = 20):
+        self.backend = StubBackend(events_per_account)
+        handler = type("StubHandler", (_StubHandler,), {"backend": self.backend, "latency": latency})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self.server.serve_forever, name="stub-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class StubCalendarService:
+    """
+        The subset of the googleapiclient Calendar service used by the event index, served by the stub server.
+    """
+
+    def __init__(self, base_url: str, account: str):
+        self.base_url = base_url
+        self.account = account
+        self._session = requests.Session()
+        self._params = None
+
+    def events(self):
+        return self
+
+    def list(self, **params):
+        self._params = params
+        return self
+
+    def execute(self):
+        params = {key: value for key, value in self._params.items() if key in ("syncToken", "pageToken")}
+        return self._session.get(f"{self.base_url}/calendar/v3/{self.account}/events", params=params).json()
+
+
+class StubCalendar:
+    def __init__(self, base_url: str, account: str):
+        self.service = StubCalendarService(base_url, account)
+
+
+_user_ids = itertools.count(10**17)
+
+
+def next_user_id() -> int:
+    return next(_user_ids)
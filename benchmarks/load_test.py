@@ -0,0 +1,195 @@
+"""
+    Offline load test of the bot.
+
+    Discord, Gemini and Composio are replaced by local stand-ins (see `benchmarks/fakes.py`):
+    commands are called with fake contexts, the agent talks to a scripted LLM which answers after
+    `--llm-latency` seconds, and Composio / Google Calendar requests go to a local HTTP server
+    which answers after `--composio-latency` seconds.
+
+    Scenarios:
+        calendar        `!calendar` requests which go through the agent (one tool call, then the answer)
+        routed          `!calendar` requests handled by the intent router, without the LLM
+        create_account  `!create_account` requests of new users
+        tools           direct calls of the `tools.py` tools (find, look up by title, create)
+
+    Reports throughput, p50/p95/p99 latency, the worst event loop stall and memory.
+
+    Usage: python -m benchmarks.load_test [--scenario calendar] [--requests 200] [--concurrency 20]
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeChannel, FakeContext, FakeGateway, StubCalendar, StubServer, build_scripted_llm, next_user_id
+
+
+SCENARIOS = ("calendar", "routed", "create_account", "tools")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test with stubbed Discord, LLM and Composio.")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="calendar")
+    parser.add_argument("--requests", type=int, default=200, help="Total number of requests.")
+    parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight at the same time.")
+    parser.add_argument("--users", type=int, default=50, help="Number of distinct users sending the requests.")
+    parser.add_argument("--guilds", type=int, default=5, help="Number of guilds the users are spread over.")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds every LLM call takes.")
+    parser.add_argument("--composio-latency", type=float, default=0.05, help="Seconds every Composio request takes.")
+    parser.add_argument("--events", type=int, default=20, help="Events in every stub calendar.")
+    return parser.parse_args()
+
+
+def setup_environment(args, server: StubServer):
+    """
+        Point the bot at the stand-ins. Must run before `main` is imported, as it reads its settings at import time.
+    """
+
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    os.environ.setdefault("COMPOSIO_API_KEY", "benchmark")
+    os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+    os.environ.setdefault("INTEGRATION_ID", "benchmark")
+    os.environ["COMPOSIO_BASE_URL"] = f"{server.url}/api/v1"
+    os.environ.setdefault("PROGRESS_EDIT_INTERVAL", "0.2")
+    os.environ.setdefault("PROGRESS_CHANNEL_EDIT_INTERVAL", "0.05")
+
+    # The account database and the TinyDB migration use paths relative to the working directory
+    directory = tempfile.mkdtemp(prefix="load-test-")
+    os.makedirs(os.path.join(directory, "db"))
+    os.chdir(directory)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def drive(count: int, concurrency: int, request) -> tuple[list[float], int, float]:
+    """
+        Call `request(number)` `count` times with at most `concurrency` calls in flight.
+        Returns the latencies, the number of failed requests and the wall time.
+    """
+
+    latencies = []
+    failures = 0
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(number: int):
+        nonlocal failures
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await request(number)
+            except Exception as e:
+                failures += 1
+                print(f"Request {number} failed: {e!r}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(number) for number in range(count)))
+    return latencies, failures, time.perf_counter() - start
+
+
+async def run(args, server: StubServer) -> dict:
+    import main
+    import tools
+    import utils.event_index
+    import utils.manage_events
+
+    utils.manage_events.llm = build_scripted_llm(latency=args.llm_latency)
+    utils.event_index.get_calendar_by_connectedAccountId = lambda account: StubCalendar(server.url, account)
+
+    users = [next_user_id() for _ in range(args.users)]
+    guilds = [number + 1 for number in range(args.guilds)]
+    channels = {guild: FakeChannel(guild) for guild in guilds}
+    for user in users:
+        main.accounts.save_account(user, f"account{user}")
+
+    def context(number: int) -> FakeContext:
+        user = users[number % len(users)]
+        guild = guilds[number % len(guilds)]
+        return FakeContext(user, guild, channels[guild])
+
+    async def calendar(number: int):
+        await main._calendar.callback(context(number), message="what do I have planned with the design team this week?")
+
+    async def routed(number: int):
+        await main._calendar.callback(context(number), message="list my events today")
+
+    async def create_account(number: int):
+        await main._create_account.callback(FakeContext(next_user_id(), guilds[number % len(guilds)], channels[guilds[number % len(guilds)]]))
+
+    def call_tools(number: int):
+        account = f"account{users[number % len(users)]}"
+        start = datetime.now().replace(microsecond=0) + timedelta(days=1, hours=number % 24)
+        tools.find_events.func(account, max_results=10)
+        tools.get_event_id_by_title.func(account, f"Event {number % 7}")
+        tools.create_event.func(account, start.isoformat(), (start + timedelta(minutes=30)).isoformat(), title=f"Load test {number}")
+
+    async def tool_calls(number: int):
+        await asyncio.get_running_loop().run_in_executor(main.agent_executor._pool, call_tools, number)
+
+    request = {"calendar": calendar, "routed": routed, "create_account": create_account, "tools": tool_calls}[args.scenario]
+
+    # Build the pooled agents before measuring, like the bot does once it runs for a while
+    if args.scenario == "calendar":
+        utils.manage_events.agent_pool.warm_up(main.settings.agent_max_workers)
+
+    gateway = FakeGateway()
+    gateway.start()
+    tracemalloc.start()
+    latencies, failures, wall = await drive(args.requests, args.concurrency, request)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await gateway.stop()
+
+    return {
+        "latencies": latencies,
+        "failures": failures,
+        "wall": wall,
+        "loop_lag": gateway.max_lag,
+        "peak": peak,
+        "llm_calls": utils.manage_events.llm.calls,
+        "backend_requests": server.backend.requests,
+        "edits": sum(channel.edits for channel in channels.values()),
+    }
+
+
+def report(args, result: dict):
+    latencies = result["latencies"]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Kilobytes on Linux
+
+    print(f"scenario:          {args.scenario}")
+    print(f"requests:          {args.requests} ({result['failures']} failed), concurrency {args.concurrency}")
+    print(f"throughput:        {args.requests / result['wall']:.2f} requests/s")
+    print(f"latency p50:       {percentile(latencies, 0.50) * 1000:.1f} ms")
+    print(f"latency p95:       {percentile(latencies, 0.95) * 1000:.1f} ms")
+    print(f"latency p99:       {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"latency mean:      {statistics.fmean(latencies) * 1000:.1f} ms")
+    print(f"event loop lag:    {result['loop_lag'] * 1000:.1f} ms (worst)")
+    print(f"peak traced alloc: {result['peak'] / 1024 / 1024:.1f} MiB")
+    print(f"max RSS:           {rss:.1f} MiB")
+    print(f"LLM calls:         {result['llm_calls']}")
+    print(f"stub requests:     {result['backend_requests']}")
+    print(f"message edits:     {result['edits']}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = StubServer(latency=args.composio_latency, events_per_account=args.events).start()
+    setup_environment(args, server)
+    try:
+        report(args, asyncio.run(run(args, server)))
+    finally:
+        server.stop()
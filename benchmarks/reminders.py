@@ -0,0 +1,73 @@
+"""
+    Microbenchmark of the reminder scheduler.
+
+    Schedules the reminders of `users` users with `events` upcoming events each (no Discord or Composio
+    call is made), then reports the memory held per scheduled reminder, the cost of a resync where every
+    event moved (the old heap entries become stale) and the cost of taking all the reminders out of the heap.
+
+    Usage: python -m benchmarks.reminders [users] [events]
+"""
+
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault("COMPOSIO_API_KEY", "benchmark")
+
+from utils.reminders import ReminderScheduler
+
+
+def build_events(user_id: int, count: int, start: datetime) -> list:
+    return [
+        {
+            "id": f"event{user_id}x{number}",
+            "summary": f"Meeting {number}",
+            "start": {"dateTime": (start + timedelta(minutes=30 * number)).isoformat()},
+            "end": {"dateTime": (start + timedelta(minutes=30 * number + 25)).isoformat()},
+        }
+        for number in range(count)
+    ]
+
+
+async def main(users: int, events: int):
+    scheduler = ReminderScheduler(store=None, client=None, send=None, agenda_time="")
+    start = datetime.now(timezone.utc) + timedelta(hours=1)
+    calendars = {user_id: build_events(user_id, events, start) for user_id in range(users)}
+    moved = {user_id: build_events(user_id, events, start + timedelta(minutes=5)) for user_id in range(users)}
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    began = time.perf_counter()
+    for user_id, items in calendars.items():
+        scheduler.apply_events(user_id, items)
+    scheduled_in = time.perf_counter() - began
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    reminders = scheduler.stats()["scheduled"]
+
+    began = time.perf_counter()
+    for user_id, items in moved.items():
+        scheduler.apply_events(user_id, items)
+    resynced_in = time.perf_counter() - began
+    heap_after_resync = scheduler.stats()["heap"]
+
+    began = time.perf_counter()
+    due = scheduler.due(now=time.time() + 86400)
+    drained_in = time.perf_counter() - began
+
+    print(f"users:                 {users}")
+    print(f"reminders:             {reminders}")
+    print(f"memory per reminder:   {held / reminders:.0f} bytes (reminder object, heap and index entries, without the title and ID strings)")
+    print(f"schedule:              {scheduled_in / reminders * 1e6:.2f} µs per reminder")
+    print(f"resync (all moved):    {resynced_in / reminders * 1e6:.2f} µs per reminder, heap of {heap_after_resync} entries")
+    print(f"drain:                 {drained_in / max(len(due), 1) * 1e6:.2f} µs per sent reminder ({len(due)} sent)")
+
+
+if __name__ == "__main__":
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    asyncio.run(main(users, events))
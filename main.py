@@ -1,39 +1,143 @@
-import discord
-from discord.ext import commands
 import os
-from dotenv import load_dotenv
-from tinydb import TinyDB, Query
-import requests 
-import json
-from utils.manage_events import manage_events
+import sys
+import time
+import logging
+import tempfile
+from datetime import datetime, timedelta, timezone
+from utils.settings import get_settings
+from utils.metrics import registry, span, stage_duration, start_metrics_server, startup_phase, record_startup, STARTUP_STARTED, TRACE_LOG
+
+with startup_phase("import_discord"):
+    import discord
+    from discord.ext import commands
+
+# Only the light modules are imported here, so the bot is online before the agent stack (crewAI, LangChain, Google clients) is loaded
+with startup_phase("import_bot"):
+    from utils.composio import composio, ComposioError
+    from utils.executor import AgentExecutor, RemoteAgentExecutor, QueueFullError
+    from utils.job_queue import SQLiteJobQueue
+    from utils.account_store import open_account_store, migrate_from_tinydb
+    from utils.onboarding import OnboardingService
+    from utils.reminders import ReminderScheduler
+    from utils.outbox import SQLiteOutbox, OutboxFlusher
+    from utils.calendar_transfer import CalendarImport, export_calendar, ICS_MAX_SIZE, DOWNLOAD_CHUNK
+    from utils.contacts import get_contacts, EMAIL
+    import aiohttp
+    from utils.progress import ProgressMessage
+    from utils.response_cache import response_cache
+
+
+settings = get_settings()
+AGENT_FUNCTION = "utils.manage_events:manage_events" # Imported by the worker running the first request, or by the warm-up
 
+# Create a database to store user data
+with startup_phase("account_store"):
+    accounts = open_account_store(settings.account_db_path, cache_size=settings.account_cache_size, cache_ttl=settings.account_cache_ttl)
 
-load_dotenv()
-DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-INTEGRATION_ID = os.getenv("INTEGRATION_ID")
-COMPOSIO_API_KEY = os.getenv("COMPOSIO_API_KEY")
+# Move the accounts of the old TinyDB files to the new store (only does something once)
+migrated = migrate_from_tinydb(accounts, './db/user.json', './db/temp_user.json')
+if migrated:
+    print(f"Migrated {migrated} accounts from TinyDB to {settings.account_db_path}")
 
+intents = discord.Intents.default()
+intents.message_content = True
+if settings.shard_count or settings.shard_ids:
+    # Several processes can each run a part of the shards, e.g. SHARD_COUNT=4 SHARD_IDS=0,1 and SHARD_COUNT=4 SHARD_IDS=2,3
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=settings.shard_count or None, shard_ids=settings.shard_ids)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
 
-# Create a database to store user data
+# Agent runs are blocking, so they are executed in a worker pool to keep the gateway responsive
+if settings.agent_pool == "queue":
+    agent_executor = RemoteAgentExecutor(SQLiteJobQueue(settings.job_queue_path, max_per_guild=settings.agent_max_per_guild), max_queue=settings.agent_max_queue)
+else:
+    agent_executor = AgentExecutor(
+        max_workers=settings.agent_max_workers,
+        max_per_guild=settings.agent_max_per_guild,
+        use_processes=settings.agent_pool == "process",
+        max_queue=settings.agent_max_queue,
+    )
 
-if not os.path.exists('./db'):
-    os.makedirs('./db')
 
-if not os.path.exists('./db/temp_user.json'):
-    with open('./db/temp_user.json', 'w') as f:
-        f.close()
+async def send_direct_message(user_id: int, text: str):
+    try:
+        user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+        await user.send(text)
+    except discord.HTTPException as e:
+        print(f"Could not send a direct message to {user_id}: {e}")
 
-if not os.path.exists('./db/user.json'):
-    with open('./db/user.json', 'w') as f:
-        f.close()
 
+async def notify_connected(user_id: int, connected_account_id: str):
+    reminders.watch(user_id, connected_account_id)
+    await send_direct_message(user_id, "Your Google Calendar is connected 🎉 You can now use `!calendar` to manage events.")
 
-temp_user_db = TinyDB('./db/temp_user.json') # Temporary database to store user data for the current session
-user_db = TinyDB('./db/user.json')
 
-intents = discord.Intents.default()
-intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+async def notify_expired(user_id: int, connected_account_id: str):
+    await send_direct_message(user_id, "The link to connect your Google Calendar expired. Use `!create_account` or `!authenticate` to get a new one.")
+
+
+# Promotes the pending accounts in the background as soon as their connection is active
+onboarding = OnboardingService(accounts, composio, on_promoted=notify_connected, on_expired=notify_expired)
+
+# Sends the "starting soon" reminders and the daily agendas
+reminders = ReminderScheduler(accounts, composio, send=send_direct_message)
+
+
+def loaded(module: str):
+    """
+        Get a module if something already imported it, so the metrics don't load the agent stack.
+    """
+
+    return sys.modules.get(module)
+
+
+def mutation_applied(mutation):
+    """
+        Drop what this process cached about the account once a queued change reached Google Calendar (the agent may run here).
+    """
+
+    response_cache.invalidate(mutation.connected_account_id)
+    event_index = loaded("utils.event_index")
+    if event_index is not None and mutation.event_id is None:
+        index = event_index.event_indexes.peek(mutation.connected_account_id)
+        if index is not None:
+            index.stale = True # The new event gets its ID with the next sync
+
+
+# Applies the calendar changes written to the outbox by the agent
+outbox = SQLiteOutbox(settings.outbox_path) if settings.outbox_enabled else None
+outbox_flusher = OutboxFlusher(outbox, composio, accounts, notify=send_direct_message, on_applied=mutation_applied) if outbox is not None else None
+
+# Emails of the members and attendees, the same directory as the tools when the agent runs in this process
+contacts = get_contacts()
+
+
+# Metrics read when they are exported (the ones of modules which aren't loaded yet are skipped)
+registry.gauge("agent_queue_depth", "Requests waiting for a worker.").set_function(lambda: agent_executor.queue_depth)
+registry.gauge("agent_running", "Requests being handled by a worker.").set_function(lambda: agent_executor.running)
+registry.gauge("intent_router_hit_rate", "Share of requests handled without the LLM.").set_function(lambda: loaded("utils.intent_router").router.hit_rate)
+registry.gauge("calendar_cache_hit_rate", "Hit rate of the GoogleCalendar client cache.").set_function(lambda: loaded("utils.calendar").calendar_cache_stats()["hit_rate"])
+registry.gauge("response_cache_hit_rate", "Share of read-only queries answered from the response cache.").set_function(lambda: response_cache.stats()["hit_rate"])
+registry.gauge("conversation_sessions", "Users with a conversation in memory.").set_function(lambda: loaded("utils.session_memory").sessions.stats()["size"])
+registry.gauge("reminders_scheduled", "Reminders and agendas waiting to be sent.").set_function(lambda: reminders.stats()["scheduled"])
+registry.gauge("outbox_depth", "Calendar changes waiting to be applied.").set_function(lambda: outbox.depth() if outbox is not None else 0)
+registry.gauge("outbox_dead", "Calendar changes which failed for good and were kept for inspection.").set_function(lambda: outbox.dead() if outbox is not None else 0)
+registry.counter("composio_throttled_calls_total", "Composio actions which waited for the rate limiter.").set_function(lambda: composio.limiter.throttled)
+registry.counter("composio_coalesced_calls_total", "Composio read actions which shared the response of an identical call.").set_function(lambda: composio.in_flight()["coalesced"])
+registry.gauge("composio_reads_in_flight", "Distinct Composio read actions running now.").set_function(lambda: composio.in_flight()["running"])
+
+if TRACE_LOG:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+
+@bot.after_invoke
+async def record_command_duration(ctx):
+    stage_duration.observe(time.perf_counter() - ctx.started_at, stage="command", command=ctx.command.name)
 
 
 @bot.event
@@ -46,6 +150,37 @@ async def on_ready():
         guild_count = guild_count + 1
 
     print("SampleDiscordBot is in " + str(guild_count) + " guilds.")
+    if bot.shard_count:
+        print(f"Running shards {bot.shard_ids or list(range(bot.shard_count))} of {bot.shard_count}")
+
+    if not hasattr(bot, "metrics_server"):
+        bot.metrics_server = start_metrics_server()
+
+    # on_ready is called again after reconnections
+    if not hasattr(bot, "warm_up"):
+        record_startup("gateway", time.perf_counter() - STARTUP_STARTED)
+        bot.warm_up = bot.loop.create_task(warm_up()) if settings.agent_warm_up else None
+
+    if settings.onboarding_poller:
+        onboarding.start()
+
+    if settings.reminders_enabled:
+        reminders.start()
+
+    if outbox_flusher is not None and settings.outbox_flusher:
+        outbox_flusher.start()
+
+
+async def warm_up():
+    """
+        Load the agent stack in the background once the bot is online, so the first `!calendar` doesn't pay for it.
+    """
+
+    try:
+        with startup_phase("import_agent"):
+            await agent_executor.warm_up(AGENT_FUNCTION)
+    except Exception as e:
+        print(f"Warming up the agent failed: {e!r}")
 
 
 @bot.event
@@ -61,24 +196,19 @@ async def _create_account(ctx):
         Create an account and save `user_id` and `connected_account_id` in the database.
     """
 
-    url = "https://backend.composio.dev/api/v1/connectedAccounts"
     user_id = ctx.author.id
 
     # Check if the user already has an account
-    Account = Query()
-    is_account = user_db.search(Account.user_id == user_id)
-
-    if not is_account:
-        payload = {"integrationId": INTEGRATION_ID}
-        headers = {
-            "X-API-Key": COMPOSIO_API_KEY,
-            "Content-Type": "application/json"
-        }
-
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        response_data = json.loads(response.text)
+    if accounts.get_account(user_id) is None:
+        try:
+            response_data = await composio.acreate_connection(settings.integration_id)
+        except ComposioError as e:
+            print(repr(e))
+            await ctx.send("Something went wrong while connecting your account. Please try again.")
+            return
 
-        temp_user_db.insert({"user_id": user_id, "connected_account_id": response_data["connectedAccountId"]})
+        accounts.save_pending(user_id, response_data["connectedAccountId"])
+        onboarding.watch(response_data["connectedAccountId"])
 
         await ctx.send(f"Click [here]({response_data['redirectUrl']}) to connect your account.\nOnce you have connected your account, you can use `!calendar` to manage events.")
 
@@ -89,32 +219,172 @@ async def _create_account(ctx):
 @bot.command(name='authenticate')
 async def _authenticate(ctx):
     """
-        Create an new account again (because authentication credentials might be expired) and save `user_id` and `connected_account_id` in the database.
+        Create an new account again (because authentication credentials might be expired) and save `user_id` and `connected_account_id` in the database once it's connected.
     """
 
-    url = "https://backend.composio.dev/api/v1/connectedAccounts"
     user_id = ctx.author.id
 
     # Check if the user already has an account
-    Account = Query()
-    is_account = user_db.search(Account.user_id == user_id)
+    if accounts.get_account(user_id) is not None:
+        try:
+            response_data = await composio.acreate_connection(settings.integration_id)
+        except ComposioError as e:
+            print(repr(e))
+            await ctx.send("Something went wrong while connecting your account. Please try again.")
+            return
 
-    if is_account:
-        payload = {"integrationId": INTEGRATION_ID}
-        headers = {
-            "X-API-Key": COMPOSIO_API_KEY,
-            "Content-Type": "application/json"
-        }
+        # The current account keeps being used until the new connection is active
+        accounts.save_pending(user_id, response_data["connectedAccountId"])
+        onboarding.watch(response_data["connectedAccountId"])
+
+        await ctx.send(f"Click [here]({response_data['redirectUrl']}) to connect your account.\nOnce you have connected your account, you can use `!calendar` to manage events.")
 
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        response_data = json.loads(response.text)
+    else:
+        await ctx.send("You don't have an account yet. Please create one using `!create_account`.")
 
-        user_db.update({"connected_account_id": response_data["connectedAccountId"]}, Account.user_id == user_id)
 
-        await ctx.send(f"Click [here]({response_data['redirectUrl']}) to connect your account.\nOnce you have connected your account, you can use `!calendar` to manage events.")
+@bot.command(name='reminders')
+async def _reminders(ctx, setting: str = ""):
+    """
+        Turn the event reminders and the daily agenda on or off (`!reminders on`, `!reminders off`).
+    """
 
+    user_id = ctx.author.id
+    connected_account_id = accounts.get_account(user_id)
+    if connected_account_id is None:
+        await ctx.send("You don't have an account yet. Please create one using `!create_account`.")
+        return
+
+    setting = setting.lower()
+    if setting not in ("on", "off"):
+        await ctx.send("Use `!reminders on` or `!reminders off`.")
+        return
+
+    accounts.set_reminders(user_id, setting == "on")
+    if setting == "on":
+        reminders.watch(user_id, connected_account_id)
+        await ctx.send("I will remind you of your events and send you your agenda every morning ⏰")
     else:
+        reminders.forget(user_id)
+        await ctx.send("I won't send you reminders anymore. Use `!reminders on` to get them back.")
+
+
+@bot.command(name='link_email')
+async def _link_email(ctx, email: str = ""):
+    """
+        Let the members of this server invite you by name or mention (`!link_email you@example.com`, `!link_email off` to stop).
+    """
+
+    if ctx.guild is None:
+        await ctx.send("Link your email from the server whose members should be able to invite you.")
+        return
+
+    if email.lower() == "off":
+        if contacts.unlink(ctx.guild.id, ctx.author.id):
+            await ctx.send("Your email isn't linked in this server anymore.")
+        else:
+            await ctx.send("You haven't linked an email in this server.")
+        return
+
+    if not EMAIL.fullmatch(email):
+        await ctx.send("Use `!link_email you@example.com`.")
+        return
+
+    contacts.link(ctx.guild.id, ctx.author.id, ctx.author.display_name, email.lower())
+    await ctx.send(f"Members of this server can now invite you as **{ctx.author.display_name}** or by mentioning you 📇")
+
+
+# Users with an import or an export running, one at a time per user
+transfers = set()
+
+
+@bot.command(name='calendar_import')
+async def _calendar_import(ctx):
+    """
+        Import the events of an .ics file attached to the command into Google Calendar, without the agent.
+    """
+
+    user_id = ctx.author.id
+    connected_account_id = accounts.get_account(user_id)
+    if connected_account_id is None:
+        await ctx.send("You don't have an account yet. Please create one using `!create_account`.")
+        return
+
+    attachment = next((attachment for attachment in ctx.message.attachments if attachment.filename.lower().endswith(".ics")), None)
+    if attachment is None:
+        await ctx.send("Attach an `.ics` file to the `!calendar_import` message.")
+        return
+    if attachment.size > ICS_MAX_SIZE:
+        await ctx.send(f"The file is too large, the limit is {ICS_MAX_SIZE // (1024 * 1024)} MB.")
+        return
+    if user_id in transfers:
+        await ctx.send("Your previous import or export is still running.")
+        return
+
+    transfers.add(user_id)
+    status = await ctx.send("Importing your events...")
+    progress = ProgressMessage(status, header="Importing your events...")
+    try:
+        # Parsed while it's downloaded, the file is never held in memory
+        async with aiohttp.ClientSession() as session, session.get(attachment.url) as download:
+            download.raise_for_status()
+            report = await CalendarImport(composio, connected_account_id, on_progress=progress.update).run(download.content.iter_chunked(DOWNLOAD_CHUNK))
+        response = report.summary()
+    except aiohttp.ClientError as e:
+        print(f"Downloading the import of {user_id} failed: {e!r}")
+        response = "I couldn't download the file. Please try again."
+    except Exception as e: # Malformed file, Composio or Discord errors: the progress message still gets an answer
+        print(f"Import of {user_id} failed: {e!r}")
+        response = "Something went wrong while importing your events. Events created before the error are kept, importing the file again skips them."
+    finally:
+        transfers.discard(user_id)
+        response_cache.invalidate(connected_account_id)
+
+    await progress.finish(response)
+
+
+@bot.command(name='calendar_export')
+async def _calendar_export(ctx, days: int = 365, calendar_id: str | None = None):
+    """
+        Export the events of the last 30 days and of the next `days` days (365 by default) to an .ics file.
+        Another calendar than the primary one can be exported by its ID (`!calendar_export 365 team@group.calendar.google.com`).
+    """
+
+    user_id = ctx.author.id
+    connected_account_id = accounts.get_account(user_id)
+    if connected_account_id is None:
         await ctx.send("You don't have an account yet. Please create one using `!create_account`.")
+        return
+    if user_id in transfers:
+        await ctx.send("Your previous import or export is still running.")
+        return
+
+    transfers.add(user_id)
+    now = datetime.now(timezone.utc)
+    status = await ctx.send("Exporting your events...")
+    progress = ProgressMessage(status, header="Exporting your events...")
+    path = None
+    try:
+        # Written window by window, only one window of events is in memory
+        descriptor, path = tempfile.mkstemp(suffix=".ics")
+        with open(descriptor, "w", encoding="utf-8", newline="") as file:
+            exported, truncated = await export_calendar(composio, connected_account_id, file, now - timedelta(days=30), now + timedelta(days=max(1, min(days, 3650))), on_progress=progress.update, calendar_id=calendar_id)
+        note = f"\n⚠️ {truncated} one-hour ranges had more events than one search returns, some of them may be missing." if truncated else ""
+        await progress.finish(f"Exported {exported} events 📤{note}")
+        await ctx.send(file=discord.File(path, filename="calendar.ics"))
+    except ComposioError as e:
+        print(f"Export of {user_id} failed: {e!r}")
+        await progress.finish("Something went wrong while exporting your events. Please try again.")
+    except discord.HTTPException as e:
+        print(f"Sending the export of {user_id} failed: {e}")
+        await ctx.send("The export is too large to be sent here, try `!calendar_export` with fewer days.")
+    except Exception as e:
+        print(f"Export of {user_id} failed: {e!r}")
+        await progress.finish("Something went wrong while exporting your events. Please try again.")
+    finally:
+        transfers.discard(user_id)
+        if path is not None:
+            os.remove(path)
 
 
 @bot.command(name='calendar')
@@ -126,28 +396,48 @@ async def _calendar(ctx, *, message: str):
     user_id = ctx.author.id
 
     # Check if the user has an account
-    Account = Query()
-    is_account = user_db.search(Account.user_id == user_id)
+    with span("account_lookup"):
+        connected_account_id = accounts.get_account(user_id)
 
-    if not is_account:
-        is_temp_account = temp_user_db.search(Account.user_id == user_id)
+        if connected_account_id is None:
+            pending = accounts.get_pending(user_id)
+            if pending is None:
+                await ctx.send("You don't have an account yet. Please create one using `!create_account`.")
+                return
 
-        if not is_temp_account:
-            await ctx.send("You don't have an account yet. Please create one using `!create_account`.")
-            return
+            # The background poller may not have seen the connection yet
+            connected_account_id = await onboarding.check(user_id, pending, notify=False)
+            if connected_account_id is None:
+                await ctx.send("Your account isn't connected yet. Please finish connecting it with the link I sent you.")
+                return
 
-        else:
-            # Move the temporary account to the main database
-            user_db.insert(is_temp_account[0])
-            temp_user_db.remove(Account.user_id == user_id)
+    # Mentions and known names get their emails here, so the agent doesn't have to look them up
+    guild_id = ctx.guild.id if ctx.guild else None
+    if guild_id is not None:
+        contacts.add_account_guild(connected_account_id, guild_id)
+    message = contacts.annotate_prompt(connected_account_id, guild_id, message, {member.id: member.display_name for member in ctx.message.mentions})
+
+    status = await ctx.send("Processing your request...")
+    progress = ProgressMessage(status, header="Processing your request...")
+
+    async def report_position(position, depth):
+        progress.set_header(f"You are number {position} in the queue ({depth} requests waiting). I will get to it soon!")
 
-    await ctx.send("Processing your request...")
+    async def report_started():
+        progress.set_header("Processing your request...")
 
-    connected_account_id = user_db.search(Account.user_id == user_id)[0]["connected_account_id"]
+    progress.update("🤔 Thinking...")
 
-    response = manage_events(connected_account_id, message)
-    await ctx.send(response)
+    try:
+        response = await agent_executor.run(user_id, guild_id, AGENT_FUNCTION, connected_account_id, message, on_queued=report_position, on_started=report_started, on_progress=progress.update)
+    except QueueFullError:
+        response = "I am handling too many requests right now. Please try again in a minute."
+    except Exception as e:
+        print(f"Request of {user_id} failed: {e!r}")
+        response = "Something went wrong. Please try again."
 
+    await progress.finish(response)
 
 
-bot.run(DISCORD_BOT_TOKEN)
+if __name__ == "__main__":
+    bot.run(settings.discord_bot_token)
@@ -1,17 +1,118 @@
+from datetime import datetime
 from crewai_tools import tool
-import requests
-import dotenv
-import os
-from utils.calendar import get_calendar_by_connectedAccountId
+from google.auth.exceptions import RefreshError
+from googleapiclient.errors import HttpError
+from utils.calendar import get_calendar_by_connectedAccountId, invalidate_calendar, list_calendars
+from utils.calendar_search import search_calendars
+from utils.composio import composio, ComposioError
+from utils.event_index import event_indexes, event_from_api, parse_event_time
+from utils.batch import run_batch
+from utils.progress import report_progress
+from utils.metrics import traced
+from utils.response_cache import response_cache, record_failure
+from utils.session_memory import sessions
+from utils.formatting import format_events
+from utils.free_busy import query_free_busy, find_free_slots as compute_free_slots, merge_intervals, overlaps
+from utils.outbox import execute_mutation
+from utils.contacts import get_contacts, contact_lookups
+
+
+AUTH_EXPIRED_MESSAGE = "Your account's authentication credentials is expired. Please re authenticate again by using `!authenticate` command."
+RATE_LIMITED_MESSAGE = "Google Calendar is receiving too many requests right now. Please try again in a minute."
+PENDING_CREATE_NOTE = " It's being added to Google Calendar in the background and has no event ID yet, so don't look it up or change it in this request."
+BATCH_REQUEST_SIZE = 50 # Requests sent in one batch request of the Google API (it accepts up to 1000, 50 is the recommended size)
+
+
+def error_message(connectedAccountId: str, error: ComposioError, message: str) -> str:
+    """
+        Get the message to return for a failed action. Expired credentials also drop the cached calendar of the account.
+        Rate limited calls get their own message, so the agent doesn't retry them right away.
+    """
+
+    record_failure() # Don't cache a response built on a failed action
+
+    if error.is_auth_error:
+        invalidate_calendar(connectedAccountId)
+        return AUTH_EXPIRED_MESSAGE
+
+    if error.is_rate_limited:
+        return RATE_LIMITED_MESSAGE
+
+    return message
+
+
+def google_error_message(connectedAccountId: str, error: Exception, message: str) -> str:
+    """
+        Get the message to return for a failed direct Google Calendar API call (`RefreshError`, `HttpError` or `ComposioError`).
+    """
+
+    if isinstance(error, RefreshError):
+        record_failure()
+        invalidate_calendar(connectedAccountId)
+        return AUTH_EXPIRED_MESSAGE
+
+    if isinstance(error, HttpError):
+        error = ComposioError(str(error), status=error.resp.status)
+    return error_message(connectedAccountId, error, message)
 
 
-dotenv.load_dotenv()
-COMPOSIO_API_KEY = os.environ["COMPOSIO_API_KEY"] # Get the API key from composio
+def overlap_note(connectedAccountId: str, start, end, event_id: str | None = None) -> str:
+    """
+        Note about the events of the account overlapping [start, end), from its event index if it has one in memory (no API call).
+    """
+
+    index = event_indexes.peek(connectedAccountId)
+    if index is None or start is None or end is None:
+        return ""
+
+    others = [event for event in index.between(start, end) if event.event_id != event_id]
+    if not others:
+        return ""
+    return " Note: it overlaps with " + ", ".join(f"`{event.title}` ({event.start:%H:%M}-{event.end:%H:%M})" for event in others[:3]) + "."
+
+
+def index_event(connectedAccountId: str, response_data: dict, calendar_id: str | None = None):
+    """
+        Write a created event through to the event index of the account (if it has one in memory) and its session.
+    """
+
+    response_cache.invalidate(connectedAccountId)
+
+    calendar_id = calendar_id or "primary"
+    event = response_data.get("response_data", response_data)
+    event = event_from_api(event, calendar_id) if isinstance(event, dict) and "id" in event else None
+    if event is not None:
+        sessions.remember_event(connectedAccountId, event.event_id, event.title, event.start) # For follow-ups like "move it to 4pm"
+
+    index = event_indexes.peek(connectedAccountId)
+    if index is None or (calendar_id != "primary" and calendar_id not in index.sync_tokens):
+        return
+
+    if event is None:
+        index.stale = True # Unknown response, the next lookup picks the event up with a sync
+    else:
+        index.upsert(event)
+
+
+def invalid_times(start_datetime: str | None, end_datetime: str | None) -> str | None:
+    """
+        Check the times of a change before it's made. With the outbox the change is confirmed before Google Calendar sees it.
+    """
+
+    try:
+        start, end = parse_event_time(start_datetime), parse_event_time(end_datetime)
+    except ValueError:
+        return "Give the start and the end in ISO 8601 format."
+    if start is not None and end is not None and end <= start:
+        return "The end of the event must be after its start."
+    return None
+
 
 # calendar = GoogleCalendar(credentials_path='./.credentials/credentials.json')
 
 
 @tool("Create Event")
+@traced("tool", tool="create_event")
 def create_event(connectedAccountId: str, start_datetime: str, end_datetime: str, title: str | None = None, description: str | None = None, eventType: str | None = None, create_meeting_room: bool | None = None, guestsCanSeeOtherGuests: bool | None = None, guestsCanInviteOthers: bool | None = None, location: str | None = None, visibility: str | None = None, attendees: list | None = None, send_updates: bool | None = None, guests_can_modify: bool | None = None, calendar_id: str | None = None) -> str:
     """
         Create a new event in a Google Calendar.
@@ -44,9 +145,11 @@ def create_event(connectedAccountId: str, start_datetime: str, end_datetime: str
         :param optional calendar_id: ID of the Google Calendar. primary for interacting with primary calendar.
     """
 
-    print("\n\nCreating event\n\n")
+    report_progress("Creating event")
 
-    url = "https://backend.composio.dev/api/v1/actions/googlecalendar_create_event/execute"
+    invalid = invalid_times(start_datetime, end_datetime)
+    if invalid is not None:
+        return invalid
 
     # Build the payload
     input_data = {
@@ -78,34 +181,64 @@ def create_event(connectedAccountId: str, start_datetime: str, end_datetime: str
     if calendar_id is not None:
         input_data["calendar_id"] = calendar_id
 
-    payload = {
-        "connectedAccountId": connectedAccountId,
-        "appName": "googlecalendar",
-        "input": input_data
-    }
+    result = execute_mutation(connectedAccountId, "googlecalendar_create_event", input_data)
 
-    headers = {
-        "X-API-Key": COMPOSIO_API_KEY,
-        "Content-Type": "application/json"
-    }
+    if result.ok:
+        note = overlap_note(connectedAccountId, parse_event_time(start_datetime), parse_event_time(end_datetime)) if calendar_id in (None, "primary") else ""
+        index_event(connectedAccountId, result.data, calendar_id)
+        return "Created the event successfully!" + note + (PENDING_CREATE_NOTE if result.data.get("queued") else "")
 
-    response = requests.post(url, json=payload, headers=headers)
-    response_json = response.json()
+    return error_message(connectedAccountId, result.error, "Something went wrong in creating the event.")
 
-    if response_json["executed"]:
-        return "Created the event successfully!"
 
-    elif not response_json["executed"]:
-        if int(response_json["response"]["error"]["code"]) == 401:
-            return "Your account's authentication credentials is expired. Please re authenticate again by using `!authenticate` command."
+def search_events(connectedAccountId: str, input_data: dict) -> list | str:
+    """
+        Run `googlecalendar_find_event` and return the found events, or an error message if it failed.
+    """
 
-        return "Something went wrong in creating the event."
+    result = composio.execute_action("googlecalendar_find_event", connectedAccountId, input_data)
+    if not result.ok:
+        return error_message(connectedAccountId, result.error, "Something went wrong in finding the event.")
 
-    else:
-        return "Failed to create event"
+    events = result.data.get("event_data") or []
+    get_contacts().record_attendees(connectedAccountId, events) # Their emails can be found by name later
+    return events
+
+
+def search_all_events(connectedAccountId: str, input_data: dict) -> tuple[list, list] | str:
+    """
+        Search every calendar of the user (see `list_calendars`) at once, the events are merged by start time.
+        Returns `(events, IDs of the calendars which failed)`, or an error message if none could be searched.
+    """
+
+    try:
+        calendars = [calendar["id"] for calendar in list_calendars(connectedAccountId)]
+    except (ComposioError, RefreshError, HttpError) as e:
+        print(f"Could not list the calendars of {connectedAccountId}, searching the primary one: {e!r}")
+        calendars = ["primary"]
+
+    if len(calendars) == 1:
+        events = search_events(connectedAccountId, input_data)
+        return events if isinstance(events, str) else (events, [])
+
+    events, errors = search_calendars(connectedAccountId, input_data, calendars, input_data.get("max_results"))
+    get_contacts().record_attendees(connectedAccountId, events)
+    if len(errors) == len(calendars):
+        return error_message(connectedAccountId, next(iter(errors.values())), "Something went wrong in finding the event.")
+    if errors:
+        record_failure() # Incomplete, don't cache a response built on it
+        print(f"Could not search {len(errors)} calendars of {connectedAccountId}: {errors!r}")
+    return events, list(errors)
+
+
+def unsearched_note(calendars: list) -> str:
+    if not calendars:
+        return ""
+    return "\nCould not search the calendars " + ", ".join(calendars) + ", some events may be missing."
 
 
 @tool("Find Events")
+@traced("tool", tool="find_events")
 def find_events(connectedAccountId: str, query: str | None = None, max_results: int | None = None, time_max: str | None = None, time_min: str | None = None, event_types: str | None = None, calendar_id: str | None = None) -> str:
     """
         Find events in a Google Calendar.
@@ -117,12 +250,10 @@ def find_events(connectedAccountId: str, query: str | None = None, max_results:
         :param optional time_min: Lower bound (exclusive) for an event's end time to filter by. Must be an RFC3339 timestamp with mandatory time zone offset.
         The start of the interval for the query formatted as per RFC3339.
         :param optional event_types: Event types to return. Acceptable values are 'default', 'focusTime', 'outOfOffice', 'workingLocation'.
-        :param optional calendar_id: The ID of the calendar to search in.
+        :param optional calendar_id: The ID of the calendar to search in. Leave it empty to search all the calendars of the user.
     """
 
-    print("\n\nFinding events\n\n")
-
-    url = "https://backend.composio.dev/api/v1/actions/googlecalendar_find_event/execute"
+    report_progress("Finding events")
 
     # Build the input dictionary dynamically
     input_data = {}
@@ -136,47 +267,117 @@ def find_events(connectedAccountId: str, query: str | None = None, max_results:
         input_data["time_min"] = time_min
     if event_types is not None:
         input_data["event_types"] = event_types
+
     if calendar_id is not None:
         input_data["calendar_id"] = calendar_id
+        found = search_events(connectedAccountId, input_data)
+        found = found if isinstance(found, str) else (found, [])
+    else:
+        found = search_all_events(connectedAccountId, input_data)
 
-    payload = {
-        "connectedAccountId": connectedAccountId,
-        "appName": "googlecalendar",
-        "input": input_data
-    }
+    if isinstance(found, str):
+        return found
+    events, failed = found
+    if not events:
+        return "No events found" + unsearched_note(failed)
 
-    headers = {
-        "X-API-Key": COMPOSIO_API_KEY,
-        "Content-Type": "application/json"
-    }
+    # IDs and times are included so the agent doesn't have to look the events up again
+    return format_events(events) + unsearched_note(failed)
+
+
+def busy_calendars(connectedAccountId: str, time_min: str, time_max: str, attendees: list | None) -> tuple | str:
+    """
+        Parse the range and get the busy intervals of the user and the attendees with one freebusy request.
+        Returns `(start, end, busy, errors)` (see `query_free_busy`), or an error message.
+    """
+
+    start, end = parse_event_time(time_min), parse_event_time(time_max)
+    if start is None or end is None or end <= start:
+        return "Give the start and the end as RFC3339 timestamps, the end after the start."
+
+    calendars = ["primary"] + [email for email in dict.fromkeys(attendees or []) if isinstance(email, str) and "@" in email]
+    try:
+        busy, errors = query_free_busy(connectedAccountId, start, end, calendars)
+    except (ComposioError, RefreshError, HttpError) as e:
+        return google_error_message(connectedAccountId, e, "Something went wrong in getting the free/busy times.")
+    return start, end, busy, errors
 
-    response = requests.post(url, json=payload, headers=headers)
-    # print(payload, "\n\n")
-    # print(response.json())
-    response_json = response.json()
-
-    if response_json["executed"]:
-        events = response_json["response"]["event_data"]
-        if events:
-            event_list = [] # List to store the event summaries
-            for event in events:
-                try:
-                    if event["summary"]:
-                        event_list.append(f'`{event["summary"]}`')
-                except KeyError:
-                    pass
-            print(f"Found events successfully! \nThe events are: {', '.join(event_list)}")
-            return f"Found events successfully! \nThe events are: {', '.join(event_list)}"
-        else:
-            return "No events found"
-    else:
-        if int(response_json["response"]["error"]["code"]) == 401:
-            return "Your account's authentication credentials is expired. Please re authenticate again by using `!authenticate` command."
 
-        return "Something went wrong in finding the event."
+def unreadable_note(errors: dict) -> str:
+    if not errors:
+        return ""
+    return "\nCould not see the calendar of " + ", ".join(f"{calendar} ({reason})" for calendar, reason in errors.items()) + ", they may be busy then."
+
+
+@tool("Find Free Slots")
+@traced("tool", tool="find_free_slots")
+def find_free_slots(connectedAccountId: str, time_min: str, time_max: str, duration_minutes: int = 60, attendees: list | None = None, include_weekends: bool = False, max_results: int = 5) -> str:
+    """
+        Find times when the user and the attendees are all free, best first. Use it to answer "find a free hour with alice and bob next week" before creating the event.
+
+        :param required connectedAccountId: The ID of the connected account.
+        :param required time_min: Start of the range to search, as an RFC3339 timestamp with time zone offset.
+        :param required time_max: End of the range to search, as an RFC3339 timestamp with time zone offset.
+        :param optional duration_minutes: Length of the slot in minutes. Defaults to 60.
+        :param optional attendees: List of mails of the people who must be free too. Example ['email1@gmail.com','email2@icloud.com'].
+        :param optional include_weekends: Whether to search on Saturdays and Sundays. Defaults to False.
+        :param optional max_results: The maximum number of slots to return. Defaults to 5.
+    """
+
+    report_progress("Looking for free time")
+
+    found = busy_calendars(connectedAccountId, time_min, time_max, attendees)
+    if isinstance(found, str):
+        return found
+    start, end, busy, errors = found
+
+    intervals = [interval for calendar in busy.values() for interval in calendar]
+    slots = compute_free_slots(intervals, start, end, int(duration_minutes) * 60, weekends=bool(include_weekends), max_results=int(max_results))
+    if not slots:
+        return f"No free slot of {duration_minutes} minutes in the working hours between {start:%Y-%m-%d %H:%M} and {end:%Y-%m-%d %H:%M}." + unreadable_note(errors)
+
+    tz = start.tzinfo
+    lines = [f"Free slots of {duration_minutes} minutes for everyone, best first:"]
+    for slot_start, slot_end in slots:
+        slot_start, slot_end = datetime.fromtimestamp(slot_start, tz), datetime.fromtimestamp(slot_end, tz)
+        lines.append(f"- {slot_start:%a %Y-%m-%d %H:%M}-{slot_end:%H:%M} (start_datetime {slot_start.isoformat()}, end_datetime {slot_end.isoformat()})")
+    return "\n".join(lines) + unreadable_note(errors)
+
+
+@tool("Check Conflicts")
+@traced("tool", tool="check_conflicts")
+def check_conflicts(connectedAccountId: str, start_datetime: str, end_datetime: str, attendees: list | None = None) -> str:
+    """
+        Check whether the user and the attendees are free at a time. Use it before creating or moving an event.
+
+        :param required connectedAccountId: The ID of the connected account.
+        :param required start_datetime: The start date and time in ISO 8601 format.
+        :param required end_datetime: The end date and time in ISO 8601 format.
+        :param optional attendees: List of mails of the attendees. Example ['email1@gmail.com','email2@icloud.com'].
+    """
+
+    report_progress("Checking conflicts")
+
+    found = busy_calendars(connectedAccountId, start_datetime, end_datetime, attendees)
+    if isinstance(found, str):
+        return found
+    start, end, busy, errors = found
+
+    tz = start.tzinfo
+    lines = []
+    for calendar, intervals in busy.items():
+        clashes = overlaps(merge_intervals(intervals), start.timestamp(), end.timestamp())
+        if clashes:
+            times = ", ".join(f"{datetime.fromtimestamp(clash_start, tz):%H:%M}-{datetime.fromtimestamp(clash_end, tz):%H:%M}" for clash_start, clash_end in clashes)
+            lines.append(f"- {'you' if calendar == 'primary' else calendar}: busy {times}")
+
+    if not lines:
+        return f"Everyone is free from {start:%Y-%m-%d %H:%M} to {end:%H:%M}." + unreadable_note(errors)
+    return "Conflicts:\n" + "\n".join(lines) + unreadable_note(errors)
 
 
 @tool("Delete Event")
+@traced("tool", tool="delete_event")
 def delete_event(connectedAccountId: str, event_id: str, calendar_id: str | None = None) -> str:
     """
         Delete an event from a Google Calendar.
@@ -187,9 +388,14 @@ def delete_event(connectedAccountId: str, event_id: str, calendar_id: str | None
         :param optional calendar_id: The ID of the calendar to delete the event from.
     """
 
-    print("\n\nDeleting event\n\n")
+    report_progress("Deleting event")
+    return apply_delete(connectedAccountId, event_id, calendar_id)[1]
+
 
-    url = "https://backend.composio.dev/api/v1/actions/googlecalendar_delete_event/execute"
+def apply_delete(connectedAccountId: str, event_id: str, calendar_id: str | None = None) -> tuple[bool, str]:
+    """
+        Delete an event. Returns `(ok, message)`, also used by the batch tool.
+    """
 
     # Build the payload
     input_data = {
@@ -198,35 +404,22 @@ def delete_event(connectedAccountId: str, event_id: str, calendar_id: str | None
     if calendar_id is not None:
         input_data["calendar_id"] = calendar_id
 
-    payload = {
-        "connectedAccountId": connectedAccountId,
-        "appName": "googlecalendar",
-        "input": input_data
-    }
+    result = execute_mutation(connectedAccountId, "googlecalendar_delete_event", input_data, event_id)
 
-    headers = {
-        "X-API-Key": COMPOSIO_API_KEY,
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(url, json=payload, headers=headers)
-    response_json = response.json()
-
-    print(response)
-    print(response_json)
+    if result.ok:
+        response_cache.invalidate(connectedAccountId)
+        sessions.forget_event(connectedAccountId, event_id)
+        index = event_indexes.peek(connectedAccountId)
+        if index is not None:
+            index.remove(event_id)
+        return True, "The event is deleted successfully! "
 
-    if response_json["executed"]:
-        return "The event is deleted successfully! "
-        
-    else:
-        if int(response_json["response"]["error"]["code"]) == 401:
-            return "Your account's authentication credentials is expired. Please re authenticate again by using `!authenticate` command."
-
-        return "Something went wrong in deleting the event."
+    return False, error_message(connectedAccountId, result.error, "Something went wrong in deleting the event.")
 
 
 @tool("Update Event")
-def update_event(connectedAccountId: str, event_id: str, start_datetime: str | None = None, end_datetime: str | None = None, title: str | None = None, description: str | None = None) -> str:
+@traced("tool", tool="update_event")
+def update_event(connectedAccountId: str, event_id: str, start_datetime: str | None = None, end_datetime: str | None = None, title: str | None = None, description: str | None = None, attendees: list | None = None, calendar_id: str | None = None) -> str:
     """
         Update an existing event in a Google Calendar.
         Event ID can be obtained by using the `Get Event ID via Title` tool.
@@ -237,11 +430,22 @@ def update_event(connectedAccountId: str, event_id: str, start_datetime: str | N
         :param optional end_datetime: The new end date and time of the event in ISO 8601 format.
         :param optional title: The new title of the event.
         :param optional description: The new description of the event.
+        :param optional attendees: The complete new list of attendee emails, it replaces the current attendees. Example ['email1@gmail.com','email2@icloud.com'].
+        :param optional calendar_id: The ID of the calendar of the event, if it's not the primary one.
     """
 
-    print("\n\nUpdating event\n\n")
+    report_progress("Updating event")
+    return apply_update(connectedAccountId, event_id, start_datetime, end_datetime, title, description, attendees, calendar_id)[1]
 
-    url = "https://backend.composio.dev/api/v1/actions/googlecalendar_update_event/execute"
+
+def apply_update(connectedAccountId: str, event_id: str, start_datetime: str | None = None, end_datetime: str | None = None, title: str | None = None, description: str | None = None, attendees: list | None = None, calendar_id: str | None = None) -> tuple[bool, str]:
+    """
+        Update an event. Returns `(ok, message)`, also used by the batch tool.
+    """
+
+    invalid = invalid_times(start_datetime, end_datetime)
+    if invalid is not None:
+        return False, invalid
 
     # Build the payload
     input_data = {
@@ -255,34 +459,30 @@ def update_event(connectedAccountId: str, event_id: str, start_datetime: str | N
         input_data["summary"] = title
     if description is not None:
         input_data["description"] = description
+    if attendees is not None:
+        input_data["attendees"] = attendees
+    if calendar_id is not None:
+        input_data["calendar_id"] = calendar_id
 
-    payload = {
-        "connectedAccountId": connectedAccountId,
-        "appName": "googlecalendar",
-        "input": input_data
-    }
-
-    headers = {
-        "X-API-Key": COMPOSIO_API_KEY,
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(url, json=payload, headers=headers)
-    response_json = response.json()
-    print(response)
-    print(response_json)
-
-    if response_json["executed"]:
-        return "Event updated successfully"
+    result = execute_mutation(connectedAccountId, "googlecalendar_update_event", input_data, event_id)
 
-    else:
-        if int(response_json["response"]["error"]["code"]) == 401:
-            return "Your account's authentication credentials is expired. Please re authenticate again by using `!authenticate` command."
+    if result.ok:
+        response_cache.invalidate(connectedAccountId)
+        index = event_indexes.peek(connectedAccountId)
+        if index is not None:
+            index.update(event_id, title=title, start=parse_event_time(start_datetime), end=parse_event_time(end_datetime), attendees=tuple(attendees) if attendees is not None else None)
+            indexed = index.events.get(event_id)
+            if indexed is not None:
+                sessions.remember_event(connectedAccountId, event_id, indexed.title, indexed.start)
+                if start_datetime is not None or end_datetime is not None:
+                    return True, "Event updated successfully" + overlap_note(connectedAccountId, indexed.start, indexed.end, event_id)
+        return True, "Event updated successfully"
 
-        return "Something went wrong in updating the event."
+    return False, error_message(connectedAccountId, result.error, "Something went wrong in updating the event.")
 
 
 @tool("Remove Attendee from Event")
+@traced("tool", tool="remove_attendee_event")
 def remove_attendee_event(connectedAccountId: str, event_id: str, attendee_email: str, calendar_id: str | None = None) -> str:
     """
         Remove an attendee from an existing event in a Google Calendar.
@@ -294,9 +494,14 @@ def remove_attendee_event(connectedAccountId: str, event_id: str, attendee_email
         :param optional calendar_id: The ID of the calendar to remove the attendee from.
     """
 
-    print("\n\nRemoving attendee from event\n\n")
+    report_progress("Removing attendee from event")
+    return apply_remove_attendee(connectedAccountId, event_id, attendee_email, calendar_id)[1]
+
 
-    url = "https://backend.composio.dev/api/v1/actions/googlecalendar_remove_attendee/execute"
+def apply_remove_attendee(connectedAccountId: str, event_id: str, attendee_email: str, calendar_id: str | None = None) -> tuple[bool, str]:
+    """
+        Remove an attendee from an event. Returns `(ok, message)`, also used by the batch tool.
+    """
 
     # Build the payload
     input_data = {
@@ -307,30 +512,20 @@ def remove_attendee_event(connectedAccountId: str, event_id: str, attendee_email
     if calendar_id is not None:
         input_data["calendar_id"] = calendar_id
 
-    payload = {
-        "connectedAccountId": connectedAccountId,
-        "appName": "googlecalendar",
-        "input": input_data
-    }
-
-    headers = {
-        "X-API-Key": COMPOSIO_API_KEY,
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(url, json=payload, headers=headers)
-    response_json = response.json()
+    result = execute_mutation(connectedAccountId, "googlecalendar_remove_attendee", input_data, event_id)
 
-    if response_json["executed"]:
-        return "Attendee removed successfully"
-    else:
-        if int(response_json["response"]["error"]["code"]) == 401:
-            return "Your account's authentication credentials is expired. Please re authenticate again by using `!authenticate` command."
+    if result.ok:
+        response_cache.invalidate(connectedAccountId)
+        index = event_indexes.peek(connectedAccountId)
+        if index is not None:
+            index.remove_attendee(event_id, attendee_email)
+        return True, "Attendee removed successfully"
 
-        return "Something went wrong in removing the attendee from the event."
+    return False, error_message(connectedAccountId, result.error, "Something went wrong in removing the attendee from the event.")
     
 
 @tool("Quick Add Event")
+@traced("tool", tool="quick_add_event")
 def quick_add_event(connectionAccountId: str, calendar_id: str | None = None, text: str | None = None, send_updates: str | None = None) -> str:
     """
         Create a new event in a Google Calendar based on a simple text string like 'Appointment at Somewhere on June 3rd 10am-10:25am' You can only give title and timeslot here. No recurring meetings and no attendee can be added here. This is not a preferred endpoint. Only use this if no other endpoint is possible.
@@ -341,9 +536,7 @@ def quick_add_event(connectionAccountId: str, calendar_id: str | None = None, te
         :param optional send_updates: Guests who should receive notifications about the creation of the new event. Acceptable values are: 'all': Notifications are sent to all guests. 'externalOnly': Notifications are sent to non-Google Calendar guests only. 'none': No notifications are sent.
     """
 
-    print("\n\nQuick adding event\n\n")
-
-    url = "https://backend.composio.dev/api/v1/actions/googlecalendar_quick_add/execute"
+    report_progress("Quick adding event")
 
     # Build the payload
     input_data = {}
@@ -354,30 +547,17 @@ def quick_add_event(connectionAccountId: str, calendar_id: str | None = None, te
     if send_updates is not None:
         input_data["send_updates"] = send_updates
 
-    payload = {
-        "connectedAccountId": connectionAccountId,
-        "appName": "googlecalendar",
-        "input": input_data
-    }
-
-    headers = {
-        "X-API-Key": COMPOSIO_API_KEY,
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(url, json=payload, headers=headers)
-    response_json = response.json()
+    result = execute_mutation(connectionAccountId, "googlecalendar_quick_add", input_data)
 
-    if response_json["executed"]:
-        return "Quick event created successfully"
+    if result.ok:
+        index_event(connectionAccountId, result.data, calendar_id)
+        return "Quick event created successfully" + (PENDING_CREATE_NOTE if result.data.get("queued") else "")
     else:
-        if int(response_json["response"]["error"]["code"]) == 401:
-            return "Your account's authentication credentials is expired. Please re authenticate again by using `!authenticate` command."
-
-        return "Something went wrong in creating a quick event."
+        return error_message(connectionAccountId, result.error, "Something went wrong in creating a quick event.")
     
 
 @tool("Get Event ID via Title")
+@traced("tool", tool="get_event_id_by_title")
 def get_event_id_by_title(connectionAccountId: str, title: str) -> str:
     """
         Get the event ID by title in a Google Calendar.
@@ -386,24 +566,235 @@ def get_event_id_by_title(connectionAccountId: str, title: str) -> str:
         :param required title: The title of the event.
 
         You can use this event ID to perform other actions on the event like updating, deleting, etc.
+        If several events match, the first line is the ID of the next upcoming one and the other matches are listed below it.
+        All the calendars of the user are searched, the events of other calendars than the primary one come with their calendar_id.
     """
 
-    print("\n\nGetting event ID by title\n\n")
-
-    calendar = get_calendar_by_connectedAccountId(connectionAccountId)
+    report_progress("Getting event ID by title")
 
-    events = list(calendar.get_events(
-        calendar_id="primary",
-        single_events=True,
-        order_by="startTime",
-        query=title
-    ))
+    try:
+        index = event_indexes.sync(connectionAccountId)
+    except (ComposioError, RefreshError, HttpError) as e:
+        return google_error_message(connectionAccountId, e, "Something went wrong in getting the event ID.")
     
+    events = index.find(title)
     if not events:
         return "No events found with the given title."
-    
-    event = events[0]
-    return event.event_id
 
+    sessions.remember_event(connectionAccountId, events[0].event_id, events[0].title, events[0].start)
 
-    
+    def with_calendar(event) -> str:
+        # Events of other calendars need their calendar_id to be changed
+        return event.event_id if event.calendar_id == "primary" else f"{event.event_id} (calendar_id {event.calendar_id})"
+
+    if len(events) == 1:
+        return with_calendar(events[0])
+
+    others = ", ".join(f"`{event.title}` on {event.start:%Y-%m-%d %H:%M} (ID {with_calendar(event)})" for event in events[1:5])
+    return f"{with_calendar(events[0])}\nOther events matching this title: {others}"
+
+
+@tool("Find Contact")
+@traced("tool", tool="find_contact")
+def find_contact(connectedAccountId: str, name: str) -> str:
+    """
+        Find the email of a person from their name (or the start of it), to add or remove them as an attendee.
+        Use it instead of searching events when the prompt names people without their email.
+
+        :param required connectedAccountId: The ID of the connected account.
+        :param required name: The name of the person, e.g. "Alice" or "alice sm".
+    """
+
+    report_progress("Finding contact")
+
+    found = get_contacts().find(connectedAccountId, name)
+    if not found:
+        contact_lookups.inc(result="miss", caller="tool")
+        return f"No contact found for `{name}`. Ask the user for the email."
+
+    contact_lookups.inc(result=("exact", "prefix", "fuzzy")[found[0][0]], caller="tool")
+    lines = [f"{contact.name or contact.email}: {contact.email}" + (" (member of the server)" if contact.source == "member" else "") for _, contact in found]
+    if len(found) > 1 and found[0][0] == found[1][0]:
+        lines.insert(0, "Several contacts match, ask the user which one they mean if the prompt doesn't tell:")
+    return "\n".join(lines)
+
+
+def select_events(connectedAccountId: str, event_ids: list | None, query: str | None, time_min: str | None, time_max: str | None, calendar_id: str | None) -> list | str:
+    """
+        Get the events targeted by a batch tool as `{"id": ..., "summary": ..., "attendees": [...]}` dicts,
+        either from explicit event IDs or from a filter. Returns an error message instead if they can't be resolved.
+    """
+
+    if event_ids:
+        index = event_indexes.peek(connectedAccountId)
+        events = []
+        for event_id in event_ids:
+            indexed = index.events.get(event_id) if index is not None else None
+            if indexed is None:
+                events.append({"id": event_id})
+            else:
+                events.append({"id": event_id, "summary": indexed.title, "attendees": [{"email": email} for email in indexed.attendees]})
+        return events
+
+    if query is None and time_min is None and time_max is None:
+        return "Give either a list of event IDs or a filter (query, time_min and/or time_max)."
+
+    input_data = {"max_results": 250}
+    if query is not None:
+        input_data["query"] = query
+    if time_min is not None:
+        input_data["time_min"] = time_min
+    if time_max is not None:
+        input_data["time_max"] = time_max
+    if calendar_id is not None:
+        input_data["calendar_id"] = calendar_id
+
+    events = search_events(connectedAccountId, input_data)
+    if isinstance(events, str):
+        return events
+
+    return [event for event in events if "id" in event]
+
+
+def fetch_attendees(connectedAccountId: str, event_ids: list, calendar_id: str | None = None) -> dict:
+    """
+        Get the current attendee emails of events from Google Calendar, with one batch request per 50 events
+        (the client of the Google API can't be shared by the threads of `run_batch`, so they're fetched before).
+        Returns `{event_id: [emails]}`, the events which couldn't be read map to the error instead.
+        Raises the errors of the Google API (`HttpError`, `RefreshError`) and `ComposioError`.
+    """
+
+    service = get_calendar_by_connectedAccountId(connectedAccountId).service
+    found = {}
+
+    def store(event_id, response, exception):
+        found[event_id] = exception if exception is not None else [attendee["email"] for attendee in response.get("attendees", []) if "email" in attendee]
+
+    event_ids = list(dict.fromkeys(event_ids))
+    for position in range(0, len(event_ids), BATCH_REQUEST_SIZE):
+        batch = service.new_batch_http_request(callback=store)
+        for event_id in event_ids[position:position + BATCH_REQUEST_SIZE]:
+            batch.add(service.events().get(calendarId=calendar_id or "primary", eventId=event_id, fields="attendees(email)"), request_id=event_id)
+        batch.execute()
+    return found
+
+
+def batch_report(events: list, results: list) -> str:
+    """
+        Summarize the per-event `(ok, message)` results of a batch tool.
+    """
+
+    lines = []
+    succeeded = 0
+    for event, result in zip(events, results):
+        if isinstance(result, Exception):
+            message = f"Failed: {result}"
+        else:
+            ok, message = result
+            succeeded += ok
+        lines.append(f"- `{event.get('summary') or event['id']}` (ID {event['id']}): {message}")
+
+    return f"{succeeded} of {len(events)} events done.\n" + "\n".join(lines)
+
+
+@tool("Batch Delete Events")
+@traced("tool", tool="batch_delete_events")
+def batch_delete_events(connectedAccountId: str, event_ids: list | None = None, query: str | None = None, time_min: str | None = None, time_max: str | None = None, calendar_id: str | None = None) -> str:
+    """
+        Delete several events at once. Give either the list of event IDs or a filter which selects the events.
+        Use this instead of calling `Delete Event` several times.
+
+        :param required connectedAccountId: The ID of the connected account.
+        :param optional event_ids: List of the IDs of the events to delete.
+        :param optional query: Delete the events matching these search terms.
+        :param optional time_min: Delete the events ending after this RFC3339 timestamp.
+        :param optional time_max: Delete the events starting before this RFC3339 timestamp.
+        :param optional calendar_id: The ID of the calendar of the events.
+    """
+
+    report_progress("Batch deleting events")
+
+    events = select_events(connectedAccountId, event_ids, query, time_min, time_max, calendar_id)
+    if isinstance(events, str):
+        return events
+    if not events:
+        return "No events found"
+
+    results = run_batch(lambda event: apply_delete(connectedAccountId, event["id"], calendar_id), events)
+    return batch_report(events, results)
+
+
+@tool("Batch Update Events")
+@traced("tool", tool="batch_update_events")
+def batch_update_events(connectedAccountId: str, event_ids: list | None = None, query: str | None = None, time_min: str | None = None, time_max: str | None = None, title: str | None = None, description: str | None = None, add_attendees: list | None = None, calendar_id: str | None = None) -> str:
+    """
+        Update several events at once, for example to invite someone to every standup of the week.
+        Give either the list of event IDs or a filter which selects the events.
+        Use this instead of calling `Update Event` several times.
+
+        :param required connectedAccountId: The ID of the connected account.
+        :param optional event_ids: List of the IDs of the events to update.
+        :param optional query: Update the events matching these search terms.
+        :param optional time_min: Update the events ending after this RFC3339 timestamp.
+        :param optional time_max: Update the events starting before this RFC3339 timestamp.
+        :param optional title: The new title of the events.
+        :param optional description: The new description of the events.
+        :param optional add_attendees: List of emails to invite to the events. Example ['email1@gmail.com','email2@icloud.com'].
+        :param optional calendar_id: The ID of the calendar of the events.
+    """
+
+    report_progress("Batch updating events")
+
+    events = select_events(connectedAccountId, event_ids, query, time_min, time_max, calendar_id)
+    if isinstance(events, str):
+        return events
+    if not events:
+        return "No events found"
+
+    # The update replaces the attendees, so the current ones are read from Google Calendar rather than from a possibly stale index
+    current = {}
+    if add_attendees:
+        try:
+            current = fetch_attendees(connectedAccountId, [event["id"] for event in events], calendar_id)
+        except (ComposioError, RefreshError, HttpError) as e:
+            return google_error_message(connectedAccountId, e, "Something went wrong in reading the attendees of the events.")
+
+    def update(event):
+        attendees = None
+        if add_attendees:
+            emails = current.get(event["id"])
+            if not isinstance(emails, list):
+                record_failure()
+                return False, "Failed: could not read its current attendees, it was not changed."
+            attendees = emails + [email for email in add_attendees if email not in emails]
+        return apply_update(connectedAccountId, event["id"], title=title, description=description, attendees=attendees, calendar_id=calendar_id)
+
+    results = run_batch(update, events)
+    return batch_report(events, results)
+
+
+@tool("Batch Remove Attendee")
+@traced("tool", tool="batch_remove_attendee")
+def batch_remove_attendee(connectedAccountId: str, attendee_email: str, event_ids: list | None = None, query: str | None = None, time_min: str | None = None, time_max: str | None = None, calendar_id: str | None = None) -> str:
+    """
+        Remove an attendee from several events at once. Give either the list of event IDs or a filter which selects the events.
+
+        :param required connectedAccountId: The ID of the connected account.
+        :param required attendee_email: The email of the attendee to remove.
+        :param optional event_ids: List of the IDs of the events.
+        :param optional query: Select the events matching these search terms.
+        :param optional time_min: Select the events ending after this RFC3339 timestamp.
+        :param optional time_max: Select the events starting before this RFC3339 timestamp.
+        :param optional calendar_id: The ID of the calendar of the events.
+    """
+
+    report_progress("Batch removing attendee")
+
+    events = select_events(connectedAccountId, event_ids, query, time_min, time_max, calendar_id)
+    if isinstance(events, str):
+        return events
+    if not events:
+        return "No events found"
+
+    results = run_batch(lambda event: apply_remove_attendee(connectedAccountId, event["id"], attendee_email, calendar_id), events)
+    return batch_report(events, results)
@@ -0,0 +1,273 @@
+import os
+import sqlite3
+import threading
+import time
+from utils.cache import LRUCache
+
+
+class AccountStore:
+    """
+        Interface of the account store.
+
+        An account maps a Discord user ID to the Composio connected account ID. Accounts whose connection
+        was initiated but not used yet are kept as pending accounts until they are promoted.
+    """
+
+    def get_account(self, user_id: int) -> str | None:
+        """
+            Get the connected account ID of the user, or None if the user has no account.
+        """
+        raise NotImplementedError
+
+    def save_account(self, user_id: int, connected_account_id: str):
+        raise NotImplementedError
+
+    def get_user(self, connected_account_id: str) -> int | None:
+        """
+            Get the user of a connected account, or None if no user has it.
+        """
+        raise NotImplementedError
+
+    def get_pending(self, user_id: int) -> str | None:
+        raise NotImplementedError
+
+    def save_pending(self, user_id: int, connected_account_id: str):
+        raise NotImplementedError
+
+    def promote(self, user_id: int, connected_account_id: str | None = None) -> str | None:
+        """
+            Move the pending account of the user to the accounts and return its connected account ID, or None if there is no pending account.
+            With `connected_account_id`, only that pending account is promoted (not a newer one).
+        """
+        raise NotImplementedError
+
+    def list_pending(self) -> list[tuple[int, str, float]]:
+        """
+            Get all pending accounts as `(user_id, connected_account_id, created_at)`, oldest first.
+        """
+        raise NotImplementedError
+
+    def remove_pending(self, user_id: int, connected_account_id: str) -> bool:
+        """
+            Delete a pending account. Returns False if the user has no such pending account anymore.
+        """
+        raise NotImplementedError
+
+    def list_accounts(self, reminders_only: bool = False) -> list[tuple[int, str]]:
+        """
+            Get all accounts as `(user_id, connected_account_id)`. With `reminders_only`, the users who turned the reminders off are left out.
+        """
+        raise NotImplementedError
+
+    def set_reminders(self, user_id: int, enabled: bool):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteAccountStore(AccountStore):
+    """
+        Account store backed by SQLite in WAL mode, so readers never block the writer.
+
+        :param required path: Path of the database file.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        # user_id is the primary key, so every lookup by user goes through its index
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                user_id INTEGER PRIMARY KEY,
+                connected_account_id TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pending_accounts (
+                user_id INTEGER PRIMARY KEY,
+                connected_account_id TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS reminder_opt_outs (
+                user_id INTEGER PRIMARY KEY
+            );
+            CREATE INDEX IF NOT EXISTS accounts_connected_account ON accounts (connected_account_id);
+        """)
+
+    def get_account(self, user_id: int) -> str | None:
+        return self._fetch_one("SELECT connected_account_id FROM accounts WHERE user_id = ?", user_id)
+
+    def save_account(self, user_id: int, connected_account_id: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO accounts (user_id, connected_account_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET connected_account_id = excluded.connected_account_id, updated_at = excluded.updated_at",
+                (user_id, connected_account_id, time.time())
+            )
+
+    def get_user(self, connected_account_id: str) -> int | None:
+        return self._fetch_one("SELECT user_id FROM accounts WHERE connected_account_id = ?", connected_account_id)
+
+    def get_pending(self, user_id: int) -> str | None:
+        return self._fetch_one("SELECT connected_account_id FROM pending_accounts WHERE user_id = ?", user_id)
+
+    def save_pending(self, user_id: int, connected_account_id: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pending_accounts (user_id, connected_account_id, created_at) VALUES (?, ?, ?)",
+                (user_id, connected_account_id, time.time())
+            )
+
+    def promote(self, user_id: int, connected_account_id: str | None = None) -> str | None:
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                row = cursor.execute("SELECT connected_account_id FROM pending_accounts WHERE user_id = ?", (user_id,)).fetchone()
+                if row is not None and connected_account_id is not None and row[0] != connected_account_id:
+                    row = None # The user started another connection since
+                if row is not None:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO accounts (user_id, connected_account_id, updated_at) VALUES (?, ?, ?)",
+                        (user_id, row[0], time.time())
+                    )
+                    cursor.execute("DELETE FROM pending_accounts WHERE user_id = ?", (user_id,))
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+        return row[0] if row is not None else None
+
+    def list_pending(self) -> list[tuple[int, str, float]]:
+        with self._lock:
+            return self._connection.execute("SELECT user_id, connected_account_id, created_at FROM pending_accounts ORDER BY created_at").fetchall()
+
+    def remove_pending(self, user_id: int, connected_account_id: str) -> bool:
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM pending_accounts WHERE user_id = ? AND connected_account_id = ?", (user_id, connected_account_id))
+        return cursor.rowcount > 0
+
+    def list_accounts(self, reminders_only: bool = False) -> list[tuple[int, str]]:
+        query = "SELECT user_id, connected_account_id FROM accounts"
+        if reminders_only:
+            query += " WHERE user_id NOT IN (SELECT user_id FROM reminder_opt_outs)"
+        with self._lock:
+            return self._connection.execute(query).fetchall()
+
+    def set_reminders(self, user_id: int, enabled: bool):
+        with self._lock:
+            if enabled:
+                self._connection.execute("DELETE FROM reminder_opt_outs WHERE user_id = ?", (user_id,))
+            else:
+                self._connection.execute("INSERT OR IGNORE INTO reminder_opt_outs (user_id) VALUES (?)", (user_id,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _fetch_one(self, query: str, *params):
+        with self._lock:
+            row = self._connection.execute(query, params).fetchone()
+        return row[0] if row is not None else None
+
+
+class CachedAccountStore(AccountStore):
+    """
+        Read-through LRU cache in front of another account store. Only existing accounts are cached.
+
+        :param required store: The account store to wrap.
+        :param optional maxsize: Maximum number of cached accounts.
+        :param optional ttl: Seconds an account stays cached (None to cache until evicted).
+    """
+
+    def __init__(self, store: AccountStore, maxsize: int = 10000, ttl: float | None = None):
+        self.store = store
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get_account(self, user_id: int) -> str | None:
+        connected_account_id = self.cache.get(user_id)
+        if connected_account_id is None:
+            connected_account_id = self.store.get_account(user_id)
+            if connected_account_id is not None:
+                self.cache.set(user_id, connected_account_id)
+        return connected_account_id
+
+    def save_account(self, user_id: int, connected_account_id: str):
+        self.store.save_account(user_id, connected_account_id)
+        self.cache.set(user_id, connected_account_id)
+
+    def get_user(self, connected_account_id: str) -> int | None:
+        return self.store.get_user(connected_account_id)
+
+    def get_pending(self, user_id: int) -> str | None:
+        return self.store.get_pending(user_id)
+
+    def save_pending(self, user_id: int, connected_account_id: str):
+        self.store.save_pending(user_id, connected_account_id)
+
+    def promote(self, user_id: int, connected_account_id: str | None = None) -> str | None:
+        connected_account_id = self.store.promote(user_id, connected_account_id)
+        if connected_account_id is not None:
+            self.cache.set(user_id, connected_account_id)
+        return connected_account_id
+
+    def list_pending(self) -> list[tuple[int, str, float]]:
+        return self.store.list_pending()
+
+    def remove_pending(self, user_id: int, connected_account_id: str) -> bool:
+        return self.store.remove_pending(user_id, connected_account_id)
+
+    def list_accounts(self, reminders_only: bool = False) -> list[tuple[int, str]]:
+        return self.store.list_accounts(reminders_only)
+
+    def set_reminders(self, user_id: int, enabled: bool):
+        self.store.set_reminders(user_id, enabled)
+
+    def close(self):
+        self.store.close()
+
+
+def migrate_from_tinydb(store: AccountStore, user_db_path: str, temp_user_db_path: str) -> int:
+    """
+        Copy the accounts of the old TinyDB files into the store and rename the files to `*.migrated`.
+        Returns the number of migrated accounts.
+
+        :param required store: The account store to migrate to.
+        :param required user_db_path: Path of the TinyDB file with the accounts.
+        :param required temp_user_db_path: Path of the TinyDB file with the pending accounts.
+    """
+
+    count = 0
+    for path, save in ((user_db_path, store.save_account), (temp_user_db_path, store.save_pending)):
+        if not os.path.exists(path):
+            continue
+
+        if os.path.getsize(path) > 0:
+            from tinydb import TinyDB # Only needed for the migration
+
+            db = TinyDB(path)
+            for document in db.all():
+                save(document["user_id"], document["connected_account_id"])
+                count += 1
+            db.close()
+
+        os.replace(path, path + ".migrated")
+
+    return count
+
+
+def open_account_store(path: str, cache_size: int = 10000, cache_ttl: float | None = None) -> AccountStore:
+    """
+        Open the SQLite account store at `path` with an LRU cache in front of it.
+    """
+
+    return CachedAccountStore(SQLiteAccountStore(path), maxsize=cache_size, ttl=cache_ttl)
@@ -0,0 +1,76 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+
+class AgentPool:
+    """
+        Thread-safe pool of prebuilt agents.
+
+        Agents are built lazily with `factory` (at most `size` of them) and reused across requests.
+        An agent keeps per-run state while it executes a task, so a borrowed agent is never shared
+        by two threads at the same time.
+
+        :param required factory: Function that builds a new agent.
+        :param optional size: Maximum number of agents (should match the number of worker threads).
+    """
+
+    def __init__(self, factory, size: int = 4):
+        self.factory = factory
+        self.size = size
+        self._idle = queue.LifoQueue() # LIFO keeps the most recently used agents warm
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @property
+    def created(self) -> int:
+        return self._created
+
+    def warm_up(self, count: int | None = None):
+        """
+            Build `count` agents (all of them by default) ahead of the first request.
+        """
+
+        for _ in range(min(count or self.size, self.size)):
+            agent = self._build()
+            if agent is None:
+                break
+            self._idle.put(agent)
+
+    @contextmanager
+    def acquire(self, timeout: float | None = None):
+        """
+            Borrow an agent for the duration of the `with` block.
+        """
+
+        agent = self._get(timeout)
+        try:
+            yield agent
+        finally:
+            self._idle.put(agent)
+
+    def _get(self, timeout: float | None):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        agent = self._build()
+        if agent is not None:
+            return agent
+
+        # Every agent is busy, wait for one to be returned
+        return self._idle.get(timeout=timeout)
+
+    def _build(self):
+        with self._lock:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
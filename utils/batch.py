@@ -0,0 +1,32 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+
+def run_batch(func, items: list, max_concurrency: int = BATCH_MAX_CONCURRENCY, executor: ThreadPoolExecutor | None = None) -> list:
+    """
+        Call `func(item)` for every item with at most `max_concurrency` calls running at once.
+        Returns the results in the order of the items. An exception raised by a call is returned in place of its result.
+
+        :param required func: The blocking function to call.
+        :param required items: The items to call it with.
+        :param optional max_concurrency: Maximum number of concurrent calls.
+        :param optional executor: A long-lived pool to run the calls in instead of a new one, its size bounds the concurrency.
+    """
+
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            return e
+
+    if len(items) <= 1:
+        return [call(item) for item in items]
+
+    if executor is not None:
+        return list(executor.map(call, items))
+
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(items))) as pool:
+        return list(pool.map(call, items))
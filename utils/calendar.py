@@ -1,44 +1,122 @@
+import os
+import threading
+from datetime import datetime, timedelta
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
 from gcsa.google_calendar import GoogleCalendar
-import requests
-import dotenv
-import os
+from utils.cache import LRUCache
+from utils.composio import composio
+
+
+CALENDAR_CACHE_SIZE = int(os.getenv("CALENDAR_CACHE_SIZE", "1000"))
+CALENDAR_CACHE_TTL = float(os.getenv("CALENDAR_CACHE_TTL", "900")) # Seconds before the connected account is fetched again
+TOKEN_REFRESH_MARGIN = timedelta(seconds=int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))) # Refresh access tokens this long before they expire
+CALENDAR_LIST_TTL = float(os.getenv("CALENDAR_LIST_TTL", "3600")) # Seconds before the calendar list of an account is fetched again
+CALENDAR_SEARCH_MAX = int(os.getenv("CALENDAR_SEARCH_MAX", "10")) # Calendars of an account which are searched, the primary one first
+
+
+class _CachedCalendar:
+    __slots__ = ("calendar", "credentials", "lock")
+
+    def __init__(self, calendar: GoogleCalendar, credentials: Credentials):
+        self.calendar = calendar
+        self.credentials = credentials
+        self.lock = threading.Lock()
 
 
-dotenv.load_dotenv()
-COMPOSIO_API_KEY = os.environ["COMPOSIO_API_KEY"] # Get the API key from composio
+# connectedAccountId -> _CachedCalendar
+_calendars = LRUCache(maxsize=CALENDAR_CACHE_SIZE, ttl=CALENDAR_CACHE_TTL)
+
+# connectedAccountId -> list of the searched calendars
+_calendar_lists = LRUCache(maxsize=CALENDAR_CACHE_SIZE, ttl=CALENDAR_LIST_TTL)
 
 
 def get_calendar_by_connectedAccountId(connectedAccountId: str) -> GoogleCalendar:
     """
         Get the calendar by connectedAccountId.
+        Calendars are cached per connected account and their access token is refreshed ahead of expiry.
+        Raises `ComposioError` if the connected account can't be fetched.
+
+        :param required connectedAccountId: The ID of the connected account of the user.
+    """
+
+    entry = _calendars.get(connectedAccountId)
+    if entry is None:
+        entry = _build_calendar(connectedAccountId)
+        _calendars.set(connectedAccountId, entry)
+
+    credentials = entry.credentials
+    if credentials.expiry is not None and credentials.expiry - TOKEN_REFRESH_MARGIN <= datetime.utcnow():
+        with entry.lock:
+            # Another thread may have refreshed it while we were waiting
+            if credentials.expiry - TOKEN_REFRESH_MARGIN <= datetime.utcnow():
+                credentials.refresh(Request())
+
+    return entry.calendar
+
+
+def invalidate_calendar(connectedAccountId: str):
+    """
+        Drop the cached calendar of the connected account, e.g. after its credentials were rejected.
+    """
+
+    _calendars.pop(connectedAccountId)
+    _calendar_lists.pop(connectedAccountId)
+
+
+def list_calendars(connectedAccountId: str) -> list[dict]:
+    """
+        Get the calendars of the connected account which are searched, as `{"id": ..., "summary": ...}` dicts:
+        the primary one (with the ID `primary`) and the other calendars shown in the user's Google Calendar, at most `CALENDAR_SEARCH_MAX`.
+        The list is cached for `CALENDAR_LIST_TTL` seconds. Raises the errors of the Google API (`HttpError`, `RefreshError`) and `ComposioError`.
 
         :param required connectedAccountId: The ID of the connected account of the user.
     """
 
-    url = f"https://backend.composio.dev/api/v1/connectedAccounts/{connectedAccountId}"
+    calendars = _calendar_lists.get(connectedAccountId)
+    if calendars is not None:
+        return calendars
+
+    service = get_calendar_by_connectedAccountId(connectedAccountId).service
+    primary, others = [{"id": "primary", "summary": "primary"}], []
+    page_token = None
+    while True:
+        response = service.calendarList().list(minAccessRole="reader", pageToken=page_token).execute()
+        for item in response.get("items", []):
+            if item.get("primary"):
+                primary[0]["summary"] = item.get("summary") or "primary"
+            elif item.get("selected") and not item.get("deleted"):
+                others.append({"id": item["id"], "summary": item.get("summaryOverride") or item.get("summary") or item["id"]})
+        page_token = response.get("nextPageToken")
+        if page_token is None:
+            break
 
-    headers = {
-        "X-API-Key": COMPOSIO_API_KEY,
-        "Content-Type": "application/json"
-    }
+    calendars = (primary + others)[:CALENDAR_SEARCH_MAX]
+    _calendar_lists.set(connectedAccountId, calendars)
+    return calendars
 
-    response = requests.get(url, headers=headers)
-    response_json = response.json()
 
-    if not response.status_code == 200:
-        print(response_json)
-        return "Something went wrong. Please try again."
+def calendar_cache_stats() -> dict:
+    return _calendars.stats()
+
+
+def _build_calendar(connectedAccountId: str) -> _CachedCalendar:
+    response_json = composio.get_connected_account(connectedAccountId)
+    connection_params = response_json['connectionParams']
 
     token = Credentials(
-        token=response_json['connectionParams']['access_token'],
-        refresh_token=response_json['connectionParams']['refresh_token'],
-        client_id=response_json['connectionParams']['client_id'],
-        client_secret=response_json['connectionParams']['client_secret'],
+        token=connection_params['access_token'],
+        refresh_token=connection_params['refresh_token'],
+        client_id=connection_params['client_id'],
+        client_secret=connection_params['client_secret'],
         scopes=['https://www.googleapis.com/auth/calendar'],
         token_uri='https://oauth2.googleapis.com/token'
     )
 
+    # google-auth expects a naive UTC datetime
+    if connection_params.get('expires_in'):
+        token.expiry = datetime.utcnow() + timedelta(seconds=int(connection_params['expires_in']))
+
     calendar = GoogleCalendar(credentials=token)
 
-    return calendar
\ No newline at end of file
+    return _CachedCalendar(calendar, token)
@@ -0,0 +1,76 @@
+import heapq
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from utils.batch import run_batch
+from utils.composio import composio, ComposioError
+from utils.formatting import parse_event_time
+
+
+CALENDAR_SEARCH_MAX_CALLS = int(os.getenv("CALENDAR_SEARCH_MAX_CALLS", "16")) # Calendar searches running at once, all requests included
+
+# Shared by all the searches, so a search doesn't start and stop threads
+_searches = ThreadPoolExecutor(max_workers=CALENDAR_SEARCH_MAX_CALLS, thread_name_prefix="calendar-search")
+
+
+def start_key(event: dict) -> float:
+    start = parse_event_time(event.get("start"))
+    return start.timestamp() if start is not None else math.inf
+
+
+def merge_events(results: list[list], max_results: int | None = None) -> list:
+    """
+        Merge the events of several calendars, each list ordered by start time, into one list ordered by start time.
+        The lists are merged lazily, so only the first `max_results` events are ever compared.
+        An event found on several calendars (e.g. an invitation on a shared calendar) is kept once, from the first list.
+    """
+
+    merged, seen = [], set()
+    for event in heapq.merge(*results, key=start_key):
+        if event.get("id") in seen:
+            continue
+        seen.add(event.get("id"))
+        merged.append(event)
+        if len(merged) == max_results:
+            break
+    return merged
+
+
+def search_calendars(connectedAccountId: str, input_data: dict, calendars: list[str], max_results: int | None = None) -> tuple[list, dict]:
+    """
+        Run `googlecalendar_find_event` on several calendars at once and merge the found events by start time.
+        Events of other calendars than `primary` get a `calendar_id` key. Returns `(events, {calendar_id: ComposioError})`.
+
+        :param required connectedAccountId: The ID of the connected account.
+        :param required input_data: The input of the action, without `calendar_id`.
+        :param required calendars: The IDs of the calendars to search.
+        :param optional max_results: The maximum number of events, per calendar and in total.
+    """
+
+    def search(calendar_id: str) -> list:
+        data = dict(input_data, calendar_id=calendar_id)
+        if max_results is not None:
+            # No calendar needs to return more than the merged list keeps, as long as it returns its first events
+            data.update(max_results=max_results, order_by="startTime", single_events=True)
+
+        result = composio.execute_action("googlecalendar_find_event", connectedAccountId, data)
+        if not result.ok:
+            raise result.error
+
+        events = [event for event in result.data.get("event_data") or [] if isinstance(event, dict)]
+        if calendar_id != "primary":
+            events = [dict(event, calendar_id=calendar_id) for event in events]
+        return sorted(events, key=start_key)
+
+    # The calendars are searched concurrently, so the search takes as long as the slowest calendar
+    results = run_batch(search, calendars, executor=_searches)
+
+    found, errors = [], {}
+    for calendar_id, result in zip(calendars, results):
+        if isinstance(result, ComposioError):
+            errors[calendar_id] = result
+        elif isinstance(result, Exception):
+            errors[calendar_id] = ComposioError(str(result))
+        else:
+            found.append(result)
+    return merge_events(found, max_results), errors
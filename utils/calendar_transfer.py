@@ -0,0 +1,263 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from utils.composio import ComposioClient
+from utils.formatting import parse_event_time
+from utils.ics import IcsParser, IcsEvent, ICS_HEADER, ICS_FOOTER, format_ics_event
+from utils.metrics import registry
+
+
+ICS_IMPORT_CHUNK = int(os.getenv("ICS_IMPORT_CHUNK", "100")) # Parsed events held at once, checked for duplicates together
+ICS_IMPORT_CONCURRENCY = int(os.getenv("ICS_IMPORT_CONCURRENCY", "4")) # Events created at once (Composio also rate limits every account)
+ICS_MAX_SIZE = int(os.getenv("ICS_MAX_SIZE_MB", "20")) * 1024 * 1024 # Largest imported file
+ICS_EXPORT_WINDOW = timedelta(days=int(os.getenv("ICS_EXPORT_WINDOW_DAYS", "30"))) # Range of the calendar fetched by one search of an export
+
+PROGRESS_INTERVAL = 5 # Seconds between two progress reports
+DOWNLOAD_CHUNK = 64 * 1024
+MAX_LISTED_FAILURES = 5
+SEARCH_MAX_RESULTS = 2500 # Most events one search can return
+MIN_EXPORT_WINDOW = timedelta(hours=1) # A full window is split in halves down to this size
+
+transfer_events = registry.counter("calendar_transfer_events_total", "Events of the ICS imports and exports by outcome (created, duplicate, skipped, failed, exported).")
+
+
+class ImportReport:
+    """
+        Outcome of an import.
+    """
+
+    __slots__ = ("created", "duplicates", "skipped", "failed", "failures")
+
+    def __init__(self):
+        self.created = 0
+        self.duplicates = 0
+        self.skipped = 0 # All-day and recurring events, which the create action can't make
+        self.failed = 0
+        self.failures = [] # Titles and errors of the first failed events
+
+    @property
+    def processed(self) -> int:
+        return self.created + self.duplicates + self.skipped + self.failed
+
+    def summary(self) -> str:
+        lines = [f"Import finished: {self.created} events created, {self.duplicates} already in your calendar, {self.skipped} skipped, {self.failed} failed."]
+        if self.skipped:
+            lines.append("All-day and recurring events are skipped, add them from Google Calendar's own import.")
+        for failure in self.failures:
+            lines.append(f"- {failure}")
+        if self.failed > len(self.failures):
+            lines.append(f"...and {self.failed - len(self.failures)} more failures.")
+        return "\n".join(lines)
+
+
+def event_key(title: str, start: datetime) -> tuple[str, float]:
+    """
+        What makes two events duplicates of each other: the same title at the same time.
+    """
+
+    return " ".join(title.lower().split()), start.timestamp()
+
+
+def month_window(value: datetime) -> tuple[datetime, datetime]:
+    start = value.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+class CalendarImport:
+    """
+        Import the events of an ICS stream into the primary calendar of an account, without the LLM.
+
+        The file is parsed as it's downloaded and handled `chunk_size` events at a time, so memory doesn't grow with the file.
+        Events already in the calendar (same title and start) are skipped: the existing events of every month touched by
+        the file are fetched once and only their keys are kept. The other events are created with at most `concurrency`
+        calls at once, attendees are not notified.
+
+        :param required client: The Composio client.
+        :param required connected_account_id: The connected account to import into.
+        :param optional on_progress: Function called with a short description of the progress.
+        :param optional chunk_size: Parsed events handled together.
+        :param optional concurrency: Events created at once.
+    """
+
+    def __init__(self, client: ComposioClient, connected_account_id: str, on_progress=None, chunk_size: int = ICS_IMPORT_CHUNK, concurrency: int = ICS_IMPORT_CONCURRENCY):
+        self.client = client
+        self.connected_account_id = connected_account_id
+        self.on_progress = on_progress
+        self.chunk_size = chunk_size
+        self.report = ImportReport()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._existing = set() # event_key of the events in the calendar and of the created ones
+        self._months = set() # Start of the months whose events are in `_existing`
+        self._reported_at = 0.0
+
+    async def run(self, chunks) -> ImportReport:
+        """
+            Import the events of an async iterable of byte chunks (e.g. the body of the download of the file).
+        """
+
+        parser = IcsParser()
+        pending = []
+        async for data in chunks:
+            pending.extend(parser.feed(data))
+            while len(pending) >= self.chunk_size:
+                await self._import(pending[:self.chunk_size])
+                del pending[:self.chunk_size]
+
+        pending.extend(parser.close())
+        for position in range(0, len(pending), self.chunk_size):
+            await self._import(pending[position:position + self.chunk_size])
+
+        self._report(force=True)
+        return self.report
+
+    async def _import(self, events: list[IcsEvent]):
+        creatable = []
+        for event in events:
+            if event.all_day or event.recurring or event.end < event.start:
+                self.report.skipped += 1
+                transfer_events.inc(outcome="skipped")
+            else:
+                creatable.append(event)
+
+        # The existing events of the months of this chunk which weren't fetched yet
+        months = {month_window(event.start)[0] for event in creatable} - self._months
+        await asyncio.gather(*(self._fetch_month(month) for month in months))
+
+        batch = []
+        for event in creatable:
+            if month_window(event.start)[0] not in self._months:
+                self._fail(event, "could not check whether it's already in your calendar") # Rather than risk a duplicate
+                continue
+
+            key = event_key(event.summary, event.start)
+            if key in self._existing:
+                self.report.duplicates += 1
+                transfer_events.inc(outcome="duplicate")
+                continue
+            self._existing.add(key) # Also dedupes the events repeated in the file
+            batch.append(event)
+
+        await asyncio.gather(*(self._create(event) for event in batch))
+        self._report()
+
+    async def _fetch_month(self, month: datetime):
+        start, end = month_window(month)
+        input_data = {"time_min": start.isoformat(), "time_max": end.isoformat(), "max_results": SEARCH_MAX_RESULTS}
+        async with self._slots:
+            result = await self.client.aexecute_action("googlecalendar_find_event", self.connected_account_id, input_data)
+        if not result.ok:
+            # Not marked as fetched, the next chunk of that month tries again
+            print(f"Could not fetch the events of {start:%Y-%m} for the import of {self.connected_account_id}: {result.error!r}")
+            return
+
+        self._months.add(start)
+        for event in result.data.get("event_data") or []:
+            event_start = parse_event_time(event.get("start")) if isinstance(event, dict) else None
+            if event_start is not None:
+                self._existing.add(event_key(event.get("summary") or "", event_start))
+
+    async def _create(self, event: IcsEvent):
+        input_data = {
+            "start_datetime": event.start.isoformat(),
+            "end_datetime": event.end.isoformat(),
+            "summary": event.summary,
+            "send_updates": False,
+        }
+        if event.description:
+            input_data["description"] = event.description
+        if event.location:
+            input_data["location"] = event.location
+        if event.attendees:
+            input_data["attendees"] = event.attendees
+
+        async with self._slots:
+            result = await self.client.aexecute_action("googlecalendar_create_event", self.connected_account_id, input_data)
+
+        if result.ok:
+            self.report.created += 1
+            transfer_events.inc(outcome="created")
+            return
+
+        self._fail(event, result.error.message)
+
+    def _fail(self, event: IcsEvent, reason: str):
+        self.report.failed += 1
+        transfer_events.inc(outcome="failed")
+        if len(self.report.failures) < MAX_LISTED_FAILURES:
+            self.report.failures.append(f"`{event.summary or '(no title)'}` on {event.start:%Y-%m-%d %H:%M}: {reason}")
+
+    def _report(self, force: bool = False):
+        now = time.monotonic()
+        if self.on_progress is None or (not force and now - self._reported_at < PROGRESS_INTERVAL):
+            return
+        self._reported_at = now
+        self.on_progress(f"📥 {self.report.processed} events read: {self.report.created} created, {self.report.duplicates} duplicates, {self.report.skipped} skipped, {self.report.failed} failed")
+
+
+async def export_calendar(client: ComposioClient, connected_account_id: str, file, time_min: datetime, time_max: datetime, on_progress=None, calendar_id: str | None = None) -> tuple[int, int]:
+    """
+        Write the events of a calendar between `time_min` and `time_max` to a text file as an ICS calendar.
+        The range is fetched one `ICS_EXPORT_WINDOW` at a time and every window is written before the next one is fetched.
+        A window returning as many events as a search can is split in halves, so busy calendars aren't cut short.
+        Returns `(exported events, windows which were still full at MIN_EXPORT_WINDOW and may miss events)`.
+        Raises `ComposioError` if a search fails.
+
+        :param required client: The Composio client.
+        :param required connected_account_id: The connected account to export.
+        :param required file: The text file to write to (opened with `newline=""`).
+        :param required time_min: Start of the exported range (aware).
+        :param required time_max: End of the exported range (aware).
+        :param optional on_progress: Function called with a short description of the progress.
+        :param optional calendar_id: The calendar to export, the primary one by default.
+    """
+
+    file.write(ICS_HEADER)
+    exported = truncated = 0
+    carried = set() # IDs of the events of the previous window reaching into the next one, found by both searches
+    stamp = datetime.now(timezone.utc)
+
+    window_start = time_min
+    window_size = ICS_EXPORT_WINDOW
+    while window_start < time_max:
+        window_end = min(window_start + window_size, time_max)
+        input_data = {"time_min": window_start.isoformat(), "time_max": window_end.isoformat(), "max_results": SEARCH_MAX_RESULTS}
+        if calendar_id is not None:
+            input_data["calendar_id"] = calendar_id
+        result = await client.aexecute_action("googlecalendar_find_event", connected_account_id, input_data)
+        if not result.ok:
+            raise result.error
+
+        events = result.data.get("event_data") or []
+        if len(events) >= SEARCH_MAX_RESULTS:
+            if window_end - window_start > MIN_EXPORT_WINDOW:
+                window_size = max(timedelta(seconds=(window_end - window_start).total_seconds() // 2), MIN_EXPORT_WINDOW)
+                continue # The search was cut short, fetch half of the window
+            truncated += 1
+            print(f"The export of {connected_account_id} may miss events between {window_start:%Y-%m-%d %H:%M} and {window_end:%H:%M}")
+
+        reaching = set()
+        for event in events:
+            if not isinstance(event, dict):
+                continue
+            end = parse_event_time(event.get("end"))
+            if end is not None and end > window_end:
+                reaching.add(event.get("id")) # Also when already written, events can span more than two windows
+            if event.get("id") in carried:
+                continue
+            text = format_ics_event(event, stamp)
+            if not text:
+                continue
+            file.write(text)
+            exported += 1
+        carried = reaching
+
+        if on_progress is not None:
+            on_progress(f"📤 {exported} events exported, up to {window_end:%Y-%m-%d}")
+        window_start = window_end
+        window_size = ICS_EXPORT_WINDOW
+
+    file.write(ICS_FOOTER)
+    transfer_events.inc(exported, outcome="exported")
+    return exported, truncated
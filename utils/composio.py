@@ -0,0 +1,364 @@
+import asyncio
+import json
+import os
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
+from urllib3.exceptions import NewConnectionError
+from utils.settings import get_settings
+from utils.metrics import span, composio_errors, stage_duration
+from utils.rate_limit import RateLimiter, RateLimitedError, SingleFlight, AsyncSingleFlight
+
+
+COMPOSIO_API_KEY = get_settings().require("composio_api_key")
+COMPOSIO_BASE_URL = os.getenv("COMPOSIO_BASE_URL", "https://backend.composio.dev/api/v1") # Point it to a stub server for local testing
+
+COMPOSIO_RATE = float(os.getenv("COMPOSIO_RATE", "50")) # Action calls per second of the whole process
+COMPOSIO_BURST = float(os.getenv("COMPOSIO_BURST", "100"))
+COMPOSIO_ACCOUNT_RATE = float(os.getenv("COMPOSIO_ACCOUNT_RATE", "5")) # Action calls per second of one connected account
+COMPOSIO_ACCOUNT_BURST = float(os.getenv("COMPOSIO_ACCOUNT_BURST", "10"))
+COMPOSIO_MAX_WAIT = float(os.getenv("COMPOSIO_MAX_WAIT", "30")) # Seconds a throttled call waits before it fails
+COMPOSIO_MAX_RETRY_AFTER = float(os.getenv("COMPOSIO_MAX_RETRY_AFTER", "10")) # Longest Retry-After waited for, a longer one fails the call right away
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Actions which don't change anything, identical calls running at the same time share one response
+READ_ACTIONS = {"googlecalendar_find_event", "googlecalendar_list_calendars", "googlecalendar_get_calendar", "googlecalendar_find_free_slots"}
+
+
+class ComposioError(Exception):
+    """
+        An error returned by Composio, either by the HTTP layer or by the executed action.
+
+        :param required message: Human readable description of the error.
+        :param optional status: HTTP status code of the response, if there was one.
+        :param optional code: Error code reported by the action (for example the Google API status).
+    """
+
+    def __init__(self, message: str, status: int | None = None, code: int | None = None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.code = code
+
+    @property
+    def is_auth_error(self) -> bool:
+        return self.code == 401 or self.status == 401
+
+    @property
+    def is_rate_limited(self) -> bool:
+        return self.code == 429 or self.status == 429
+
+    def __repr__(self):
+        return f"ComposioError(status={self.status}, code={self.code}, message={self.message!r})"
+
+
+class ActionResult:
+    """
+        The outcome of an executed action. `data` holds the action's response when `ok` is True, else `error` is set.
+    """
+
+    __slots__ = ("ok", "data", "error")
+
+    def __init__(self, ok: bool, data: dict | None = None, error: ComposioError | None = None):
+        self.ok = ok
+        self.data = data or {}
+        self.error = error
+
+
+class ComposioClient:
+    """
+        Shared client for the Composio REST API with keep-alive connection pooling.
+
+        Every method has a blocking version (for the agent tools) and an `a`-prefixed asyncio version (for the bot).
+        Idempotent requests (reads) failing with 429/5xx or a network error are retried with exponential backoff and full jitter.
+        Other requests (e.g. creating an event) are only retried when they can't have been applied: the connection
+        couldn't be opened, or the server refused them with a 429, or a 503 with a Retry-After.
+        Executed actions go through a global and per-account rate limiter, and identical read actions running
+        at the same time are coalesced into one request.
+
+        :param required api_key: The Composio API key.
+        :param optional base_url: Base URL of the API.
+        :param optional timeout: Timeout in seconds of a single HTTP request.
+        :param optional max_retries: How many times a failed request is retried.
+        :param optional backoff: Base delay in seconds between retries.
+        :param optional max_retry_after: Longest delay in seconds waited before a retry, a longer Retry-After fails the call.
+        :param optional pool_size: Maximum number of kept-alive connections.
+        :param optional limiter: The rate limiter of the actions, keyed by connected account.
+    """
+
+    def __init__(self, api_key: str, base_url: str = COMPOSIO_BASE_URL, timeout: float = 30, max_retries: int = 3, backoff: float = 0.5, pool_size: int = 20, limiter: RateLimiter | None = None, max_retry_after: float = COMPOSIO_MAX_RETRY_AFTER):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self.pool_size = pool_size
+        self.headers = {
+            "X-API-Key": api_key,
+            "Content-Type": "application/json"
+        }
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update(self.headers)
+
+        self._async_session = None
+        self._async_loop = None
+
+        self.limiter = limiter or RateLimiter(COMPOSIO_RATE, COMPOSIO_BURST, COMPOSIO_ACCOUNT_RATE, COMPOSIO_ACCOUNT_BURST, max_wait=COMPOSIO_MAX_WAIT)
+        self._flights = SingleFlight()
+        self._async_flights = AsyncSingleFlight()
+
+    # ---- Blocking interface ----
+
+    def request(self, method: str, path: str, payload: dict | None = None, idempotent: bool | None = None) -> dict:
+        """
+            Send a request and return the decoded JSON body. Raises `ComposioError` if it ultimately fails.
+
+            :param optional idempotent: Whether the request may be sent again after an ambiguous failure. Defaults to True for GET and the other idempotent methods.
+        """
+
+        idempotent = method in IDEMPOTENT_METHODS if idempotent is None else idempotent
+        url = f"{self.base_url}{path}"
+        with span("composio_request", endpoint=self._endpoint(path)):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = self._session.request(method, url, json=payload, timeout=self.timeout)
+                except requests.RequestException as e:
+                    if attempt == self.max_retries or not (idempotent or self._not_sent(e)):
+                        composio_errors.inc(kind="network")
+                        raise ComposioError(f"Request to Composio failed: {e}") from e
+                    time.sleep(self._delay(attempt))
+                    continue
+
+                if self._retryable(response.status_code, response.headers.get("Retry-After"), idempotent) and attempt < self.max_retries:
+                    delay = self._delay(attempt, response.headers.get("Retry-After"))
+                    if delay is not None:
+                        time.sleep(delay)
+                        continue
+
+                return self._decode(response.status_code, response.text)
+
+    def execute_action(self, action: str, connected_account_id: str, input_data: dict, idempotent: bool | None = None) -> ActionResult:
+        """
+            Execute a Composio action (e.g. `googlecalendar_create_event`) for a connected account.
+            Only the read actions are retried after an ambiguous failure, unless `idempotent` says otherwise.
+        """
+
+        idempotent = action in READ_ACTIONS if idempotent is None else idempotent
+        if action in READ_ACTIONS:
+            return self._flights.do(self._flight_key(action, connected_account_id, input_data), lambda: self._execute_action(action, connected_account_id, input_data, idempotent))
+        return self._execute_action(action, connected_account_id, input_data, idempotent)
+
+    def _execute_action(self, action: str, connected_account_id: str, input_data: dict, idempotent: bool) -> ActionResult:
+        try:
+            self._throttle(connected_account_id)
+            response_json = self.request("POST", f"/actions/{action}/execute", self._action_payload(connected_account_id, input_data), idempotent=idempotent)
+        except ComposioError as e:
+            return ActionResult(False, error=e)
+        return self._action_result(response_json)
+
+    def create_connection(self, integration_id: str) -> dict:
+        """
+            Initiate a new connection for the integration. The response contains `connectedAccountId` and `redirectUrl`.
+        """
+
+        return self.request("POST", "/connectedAccounts", {"integrationId": integration_id})
+
+    def get_connected_account(self, connected_account_id: str) -> dict:
+        return self.request("GET", f"/connectedAccounts/{connected_account_id}")
+
+    def in_flight(self) -> dict:
+        """
+            Coalescing of the read actions: `running` distinct calls now, `coalesced` calls which shared the response of an identical one so far.
+        """
+
+        return {
+            "running": len(self._flights) + len(self._async_flights),
+            "coalesced": self._flights.coalesced + self._async_flights.coalesced,
+        }
+
+    def close(self):
+        self._session.close()
+
+    # ---- Asyncio interface ----
+
+    async def arequest(self, method: str, path: str, payload: dict | None = None, idempotent: bool | None = None) -> dict:
+        """
+            Asyncio version of `request`.
+        """
+
+        idempotent = method in IDEMPOTENT_METHODS if idempotent is None else idempotent
+        session = self._get_async_session()
+        url = f"{self.base_url}{path}"
+        with span("composio_request", endpoint=self._endpoint(path)):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with session.request(method, url, json=payload) as response:
+                        status = response.status
+                        text = await response.text()
+                        retry_after = response.headers.get("Retry-After")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.max_retries or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                        composio_errors.inc(kind="network")
+                        raise ComposioError(f"Request to Composio failed: {e!r}") from e
+                    await asyncio.sleep(self._delay(attempt))
+                    continue
+
+                if self._retryable(status, retry_after, idempotent) and attempt < self.max_retries:
+                    delay = self._delay(attempt, retry_after)
+                    if delay is not None:
+                        await asyncio.sleep(delay)
+                        continue
+
+                return self._decode(status, text)
+
+    async def aexecute_action(self, action: str, connected_account_id: str, input_data: dict, idempotent: bool | None = None) -> ActionResult:
+        idempotent = action in READ_ACTIONS if idempotent is None else idempotent
+        if action in READ_ACTIONS:
+            return await self._async_flights.do(self._flight_key(action, connected_account_id, input_data), lambda: self._aexecute_action(action, connected_account_id, input_data, idempotent))
+        return await self._aexecute_action(action, connected_account_id, input_data, idempotent)
+
+    async def _aexecute_action(self, action: str, connected_account_id: str, input_data: dict, idempotent: bool) -> ActionResult:
+        try:
+            await self._athrottle(connected_account_id)
+            response_json = await self.arequest("POST", f"/actions/{action}/execute", self._action_payload(connected_account_id, input_data), idempotent=idempotent)
+        except ComposioError as e:
+            return ActionResult(False, error=e)
+        return self._action_result(response_json)
+
+    async def acreate_connection(self, integration_id: str) -> dict:
+        return await self.arequest("POST", "/connectedAccounts", {"integrationId": integration_id})
+
+    async def aget_connected_account(self, connected_account_id: str) -> dict:
+        return await self.arequest("GET", f"/connectedAccounts/{connected_account_id}")
+
+    async def aclose(self):
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    # ---- Helpers ----
+
+    def _get_async_session(self) -> aiohttp.ClientSession:
+        # An aiohttp session is bound to the loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session.closed or self._async_loop is not loop:
+            self._async_session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+            )
+            self._async_loop = loop
+        return self._async_session
+
+    def _throttle(self, connected_account_id: str):
+        try:
+            wait = self.limiter.acquire(connected_account_id)
+        except RateLimitedError as e:
+            raise self._rate_limited(e)
+        if wait:
+            stage_duration.observe(wait, stage="rate_limit")
+
+    async def _athrottle(self, connected_account_id: str):
+        try:
+            wait = await self.limiter.aacquire(connected_account_id)
+        except RateLimitedError as e:
+            raise self._rate_limited(e)
+        if wait:
+            stage_duration.observe(wait, stage="rate_limit")
+
+    @staticmethod
+    def _rate_limited(error: RateLimitedError) -> ComposioError:
+        composio_errors.inc(kind="rate_limited")
+        return ComposioError(str(error), status=429)
+
+    @staticmethod
+    def _flight_key(action: str, connected_account_id: str, input_data: dict) -> tuple:
+        return (action, connected_account_id, json.dumps(input_data, sort_keys=True, default=str))
+
+    @staticmethod
+    def _retryable(status: int, retry_after: str | None, idempotent: bool) -> bool:
+        """
+            Whether a response may be retried: any 429/5xx for idempotent requests, otherwise only the refusals
+            which mean the request wasn't processed (429, or 503 with a Retry-After).
+        """
+
+        if idempotent:
+            return status in RETRY_STATUSES
+        return status == 429 or (status == 503 and retry_after is not None)
+
+    @staticmethod
+    def _not_sent(error: requests.RequestException) -> bool:
+        # The connection couldn't be opened, so the server never saw the request
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+    def _delay(self, attempt: int, retry_after: str | None = None) -> float | None:
+        """
+            Seconds to wait before the next attempt, or None when the server asks to wait longer than `max_retry_after`
+            (the call then fails right away instead of holding a worker thread).
+        """
+
+        if retry_after is not None:
+            try:
+                delay = max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            else:
+                return delay if delay <= self.max_retry_after else None
+        return min(random.uniform(0, self.backoff * (2 ** attempt)), self.max_retry_after)
+
+    @staticmethod
+    def _endpoint(path: str) -> str:
+        # Low-cardinality name of the endpoint for the metrics (no IDs)
+        parts = path.strip("/").split("/")
+        return parts[1] if parts[0] == "actions" and len(parts) > 1 else parts[0]
+
+    @staticmethod
+    def _decode(status: int, text: str) -> dict:
+        try:
+            response_json = json.loads(text)
+        except ValueError:
+            composio_errors.inc(kind="http")
+            raise ComposioError(f"Composio returned an invalid response: {text[:200]}", status=status)
+
+        if status >= 400:
+            composio_errors.inc(kind="auth" if status == 401 else "http")
+            message = response_json.get("message", text[:200]) if isinstance(response_json, dict) else text[:200]
+            raise ComposioError(message, status=status)
+
+        return response_json
+
+    @staticmethod
+    def _action_payload(connected_account_id: str, input_data: dict) -> dict:
+        return {
+            "connectedAccountId": connected_account_id,
+            "appName": "googlecalendar",
+            "input": input_data
+        }
+
+    @staticmethod
+    def _action_result(response_json: dict) -> ActionResult:
+        if response_json.get("executed"):
+            return ActionResult(True, data=response_json.get("response"))
+
+        error = (response_json.get("response") or {}).get("error") or {}
+        try:
+            code = int(error.get("code"))
+        except (TypeError, ValueError):
+            code = None
+        composio_errors.inc(kind="auth" if code == 401 else "action")
+        return ActionResult(False, error=ComposioError(error.get("message", "The action was not executed."), code=code))
+
+
+# Shared client of the process
+composio = ComposioClient(COMPOSIO_API_KEY)
@@ -0,0 +1,372 @@
+import bisect
+import difflib
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from utils.cache import LRUCache
+from utils.metrics import registry
+from utils.settings import get_settings
+
+
+CONTACT_INDEX_SIZE = int(os.getenv("CONTACT_INDEX_SIZE", "1000")) # Guild and account indexes kept in memory
+CONTACT_INDEX_TTL = float(os.getenv("CONTACT_INDEX_TTL", "300")) # Seconds before an index is read again (other processes add contacts too)
+CONTACT_MAX_SEEN = int(os.getenv("CONTACT_MAX_SEEN", "2000")) # Attendees remembered per account, the least recently seen are dropped
+CONTACT_FUZZY_CUTOFF = float(os.getenv("CONTACT_FUZZY_CUTOFF", "0.75")) # Similarity of a misspelled name to a known one
+
+MAX_PROMPT_CONTACTS = 5 # Contacts added to a prompt
+EMAIL = re.compile(r"[^@\s<>]+@[^@\s<>]+\.[^@\s<>]+")
+NAME_WORD = re.compile(r"[A-Z][\w'-]+") # Capitalized words of a prompt which may be names
+
+contact_lookups = registry.counter("contact_lookups_total", "Names looked up in the contact directory by result (exact, prefix, fuzzy, miss) and by caller (prompt, tool).")
+
+
+class Contact:
+    """
+        A person whose email is known: a member of a guild who linked it, or an attendee of the user's events.
+    """
+
+    __slots__ = ("name", "email", "source")
+
+    def __init__(self, name: str, email: str, source: str):
+        self.name = name
+        self.email = email
+        self.source = source # "member" or "attendee"
+
+    def __repr__(self):
+        return f"{self.name} <{self.email}>" if self.name else self.email
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def contact_keys(name: str, email: str) -> set[str]:
+    """
+        What a contact can be looked up by: its full name, every word of it, and the local part of its email
+        with its words (`alice.smith@x.com` gives "alice smith", "alice" and "smith").
+    """
+
+    keys = set()
+    for text in (name, email.split("@")[0].replace(".", " ").replace("_", " ").replace("-", " ")):
+        text = normalize(text)
+        if text:
+            keys.add(text)
+            keys.update(text.split())
+    return keys
+
+
+class ContactIndex:
+    """
+        In-memory index of the contacts of one guild or one account, updated in place as contacts are added.
+        The keys are kept sorted, so the contacts starting with a prefix are found by bisection.
+    """
+
+    def __init__(self, contacts=()):
+        self._keys = [] # Sorted (key, email)
+        self._contacts = {} # email -> Contact
+        for contact in contacts:
+            self.add(contact)
+
+    def __len__(self):
+        return len(self._contacts)
+
+    def add(self, contact: Contact):
+        existing = self._contacts.get(contact.email)
+        if existing is not None:
+            if existing.name == contact.name or not contact.name:
+                return
+            self.remove(contact.email)
+
+        self._contacts[contact.email] = contact
+        for key in contact_keys(contact.name, contact.email):
+            bisect.insort(self._keys, (key, contact.email))
+
+    def remove(self, email: str):
+        contact = self._contacts.pop(email, None)
+        if contact is None:
+            return
+        for key in contact_keys(contact.name, contact.email):
+            position = bisect.bisect_left(self._keys, (key, email))
+            if position < len(self._keys) and self._keys[position] == (key, email):
+                del self._keys[position]
+
+    def exact(self, name: str) -> list[Contact]:
+        key = normalize(name)
+        position = bisect.bisect_left(self._keys, (key, ""))
+        found = []
+        while position < len(self._keys) and self._keys[position][0] == key:
+            found.append(self._contacts[self._keys[position][1]])
+            position += 1
+        return found
+
+    def find(self, name: str, limit: int = 5) -> list[tuple[int, Contact]]:
+        """
+            Find the contacts matching a name: exact matches first (rank 0), then the keys starting with it (rank 1),
+            then the similar keys for misspelled names (rank 2). Returns `(rank, contact)` pairs.
+        """
+
+        key = normalize(name)
+        if not key:
+            return []
+
+        found = {}
+        position = bisect.bisect_left(self._keys, (key, ""))
+        while position < len(self._keys) and self._keys[position][0].startswith(key) and len(found) < limit:
+            indexed, email = self._keys[position]
+            found.setdefault(email, 0 if indexed == key else 1)
+            position += 1
+
+        if not found:
+            keys = sorted({indexed for indexed, _ in self._keys})
+            for similar in difflib.get_close_matches(key, keys, n=limit, cutoff=CONTACT_FUZZY_CUTOFF):
+                for contact in self.exact(similar):
+                    found.setdefault(contact.email, 2)
+
+        ranked = sorted(found.items(), key=lambda item: item[1])[:limit]
+        return [(rank, self._contacts[email]) for email, rank in ranked]
+
+
+class ContactDirectory:
+    """
+        Emails of the people the users work with, so the agent gets attendees from names and mentions.
+
+        Members of a guild link their own email with `!link_email`, every member of the guild can then invite them.
+        Attendees of the events found by a user are only visible to that user. The contacts of every guild and of
+        every account are indexed in memory on first use and the index is updated as contacts are added.
+
+        :param required path: Path of the database file, shared by the processes of one machine.
+        :param optional maxsize: Number of guild and account indexes kept in memory.
+        :param optional ttl: Seconds after which an index is read from the database again.
+    """
+
+    def __init__(self, path: str, maxsize: int = CONTACT_INDEX_SIZE, ttl: float = CONTACT_INDEX_TTL):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._indexes = LRUCache(maxsize=maxsize, ttl=ttl) # ("guild", guild_id) or ("account", connected_account_id) -> ContactIndex
+        self._known_guilds = set() # (connected_account_id, guild_id) already recorded by this process
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS member_links (
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                email TEXT NOT NULL,
+                linked_at REAL NOT NULL,
+                PRIMARY KEY (guild_id, user_id)
+            );
+            CREATE TABLE IF NOT EXISTS seen_attendees (
+                connected_account_id TEXT NOT NULL,
+                email TEXT NOT NULL,
+                name TEXT NOT NULL DEFAULT '',
+                seen_at REAL NOT NULL,
+                PRIMARY KEY (connected_account_id, email)
+            );
+            CREATE INDEX IF NOT EXISTS seen_attendees_recent ON seen_attendees (connected_account_id, seen_at);
+            CREATE TABLE IF NOT EXISTS account_guilds (
+                connected_account_id TEXT NOT NULL,
+                guild_id INTEGER NOT NULL,
+                PRIMARY KEY (connected_account_id, guild_id)
+            );
+        """)
+
+    def link(self, guild_id: int, user_id: int, name: str, email: str):
+        """
+            Link the email of a member of a guild, replacing the one they linked before.
+        """
+
+        previous = self.get_link(guild_id, user_id)
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO member_links (guild_id, user_id, name, email, linked_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (guild_id, user_id) DO UPDATE SET name = excluded.name, email = excluded.email, linked_at = excluded.linked_at",
+                (guild_id, user_id, name, email, time.time())
+            )
+
+        index = self._indexes.get(("guild", guild_id))
+        if index is not None:
+            if previous is not None:
+                index.remove(previous.email)
+            index.add(Contact(name, email, "member"))
+
+    def unlink(self, guild_id: int, user_id: int) -> bool:
+        """
+            Remove the email linked by a member of a guild. Returns False if they hadn't linked one.
+        """
+
+        previous = self.get_link(guild_id, user_id)
+        if previous is None:
+            return False
+
+        with self._lock:
+            self._connection.execute("DELETE FROM member_links WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        self._indexes.pop(("guild", guild_id)) # Another member may have linked the same email, read the guild again
+        return True
+
+    def get_link(self, guild_id: int, user_id: int) -> Contact | None:
+        with self._lock:
+            row = self._connection.execute("SELECT name, email FROM member_links WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)).fetchone()
+        return Contact(row[0], row[1], "member") if row is not None else None
+
+    def add_account_guild(self, connected_account_id: str, guild_id: int):
+        """
+            Record that an account is used in a guild, its tools can then look up the members of the guild.
+        """
+
+        if (connected_account_id, guild_id) in self._known_guilds:
+            return
+        with self._lock:
+            self._connection.execute("INSERT OR IGNORE INTO account_guilds (connected_account_id, guild_id) VALUES (?, ?)", (connected_account_id, guild_id))
+        self._known_guilds.add((connected_account_id, guild_id))
+
+    def record_attendees(self, connected_account_id: str, events: list):
+        """
+            Remember the attendees of events found for an account (the user and meeting rooms are skipped).
+        """
+
+        attendees = {}
+        for event in events:
+            for attendee in event.get("attendees") or [] if isinstance(event, dict) else []:
+                if not isinstance(attendee, dict) or attendee.get("self") or attendee.get("resource"):
+                    continue
+                email = (attendee.get("email") or "").lower()
+                if EMAIL.fullmatch(email):
+                    attendees[email] = attendee.get("displayName") or attendees.get(email) or ""
+        if not attendees:
+            return
+
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.executemany(
+                    "INSERT INTO seen_attendees (connected_account_id, email, name, seen_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (connected_account_id, email) DO UPDATE SET name = CASE WHEN excluded.name != '' THEN excluded.name ELSE name END, seen_at = excluded.seen_at",
+                    [(connected_account_id, email, name, now) for email, name in attendees.items()]
+                )
+                cursor.execute(
+                    "DELETE FROM seen_attendees WHERE connected_account_id = ? AND seen_at < ("
+                    "SELECT seen_at FROM seen_attendees WHERE connected_account_id = ? ORDER BY seen_at DESC LIMIT 1 OFFSET ?)",
+                    (connected_account_id, connected_account_id, CONTACT_MAX_SEEN - 1)
+                )
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+        index = self._indexes.get(("account", connected_account_id))
+        if index is not None:
+            for email, name in attendees.items():
+                index.add(Contact(name, email, "attendee"))
+
+    def guild_index(self, guild_id: int) -> ContactIndex:
+        index = self._indexes.get(("guild", guild_id))
+        if index is None:
+            with self._lock:
+                rows = self._connection.execute("SELECT name, email FROM member_links WHERE guild_id = ?", (guild_id,)).fetchall()
+            index = ContactIndex(Contact(name, email, "member") for name, email in rows)
+            self._indexes.set(("guild", guild_id), index)
+        return index
+
+    def account_index(self, connected_account_id: str) -> ContactIndex:
+        index = self._indexes.get(("account", connected_account_id))
+        if index is None:
+            with self._lock:
+                rows = self._connection.execute("SELECT name, email FROM seen_attendees WHERE connected_account_id = ?", (connected_account_id,)).fetchall()
+            index = ContactIndex(Contact(name, email, "attendee") for name, email in rows)
+            self._indexes.set(("account", connected_account_id), index)
+        return index
+
+    def indexes(self, connected_account_id: str, guild_id: int | None = None) -> list[ContactIndex]:
+        """
+            The indexes visible to an account: the guild it's used in (or every guild it was used in) and its own attendees.
+        """
+
+        if guild_id is not None:
+            guilds = [guild_id]
+        else:
+            with self._lock:
+                guilds = [row[0] for row in self._connection.execute("SELECT guild_id FROM account_guilds WHERE connected_account_id = ?", (connected_account_id,))]
+        return [self.guild_index(guild) for guild in guilds] + [self.account_index(connected_account_id)]
+
+    def find(self, connected_account_id: str, name: str, guild_id: int | None = None, limit: int = 5) -> list[tuple[int, Contact]]:
+        """
+            Find the contacts matching a name among the ones visible to an account, best matches first.
+            Linked members come before attendees of the same rank.
+        """
+
+        found = {}
+        for index in self.indexes(connected_account_id, guild_id):
+            for rank, contact in index.find(name, limit):
+                if contact.email not in found or (rank, contact.source != "member") < found[contact.email][0]:
+                    found[contact.email] = ((rank, contact.source != "member"), contact)
+        ranked = sorted(found.values(), key=lambda item: item[0])[:limit]
+        return [(order[0], contact) for order, contact in ranked]
+
+    def resolve_name(self, connected_account_id: str, name: str, guild_id: int | None = None) -> Contact | None:
+        """
+            The only contact known by exactly this name, None if there is none or several.
+        """
+
+        found = {contact.email: contact for index in self.indexes(connected_account_id, guild_id) for contact in index.exact(name)}
+        return next(iter(found.values())) if len(found) == 1 else None
+
+    def annotate_prompt(self, connected_account_id: str, guild_id: int | None, prompt: str, mentions: dict) -> str:
+        """
+            Replace the Discord mentions of a prompt by the names of the members and add the emails of the people
+            it names, so the agent can invite them without looking them up. Names are only resolved when they match
+            exactly one contact.
+
+            :param required connected_account_id: The connected account of the author.
+            :param required guild_id: The guild of the message, None in direct messages.
+            :param required prompt: The prompt of the user.
+            :param required mentions: Display names of the members mentioned in the message by user ID.
+        """
+
+        resolved = {}
+        for user_id, display_name in mentions.items():
+            prompt = re.sub(rf"<@!?{user_id}>", lambda match: f"@{display_name}", prompt)
+            contact = self.get_link(guild_id, user_id) if guild_id is not None else None
+            if contact is not None:
+                resolved[display_name] = contact
+                contact_lookups.inc(result="exact", caller="prompt")
+
+        words = NAME_WORD.findall(prompt)
+        candidates = [f"{first} {second}" for first, second in zip(words, words[1:])] + words
+        for candidate in candidates:
+            if len(resolved) >= MAX_PROMPT_CONTACTS:
+                break
+            if candidate in resolved or any(candidate in name.split() for name in resolved):
+                continue
+            contact = self.resolve_name(connected_account_id, candidate, guild_id)
+            if contact is not None and contact.email not in (known.email for known in resolved.values()):
+                resolved[candidate] = contact
+                contact_lookups.inc(result="exact", caller="prompt")
+
+        if not resolved:
+            return prompt
+        known = ", ".join(f"{name} is {contact.email}" for name, contact in resolved.items())
+        return f"{prompt}\n(Emails of the people mentioned: {known}.)"
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_contacts() -> ContactDirectory:
+    """
+        The contact directory of the process, opened on first use.
+    """
+
+    return ContactDirectory(get_settings().contact_db_path)
@@ -0,0 +1,294 @@
+import bisect
+import difflib
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from googleapiclient.errors import HttpError
+from utils.cache import LRUCache
+from utils.calendar import get_calendar_by_connectedAccountId, list_calendars
+from utils.formatting import parse_event_time
+
+
+EVENT_INDEX_SIZE = int(os.getenv("EVENT_INDEX_SIZE", "1000")) # Number of connected accounts with an index in memory
+EVENT_INDEX_SYNC_INTERVAL = float(os.getenv("EVENT_INDEX_SYNC_INTERVAL", "60")) # Seconds before an index is synced again
+EVENT_INDEX_HORIZON = timedelta(days=int(os.getenv("EVENT_INDEX_HORIZON_DAYS", "365"))) # Events further away are not indexed
+EVENT_INDEX_HORIZON_STEP = timedelta(hours=float(os.getenv("EVENT_INDEX_HORIZON_STEP_HOURS", "24"))) # How far the horizon moves before a calendar is listed again
+
+FUZZY_CUTOFF = 0.75
+
+
+class IndexedEvent:
+    __slots__ = ("event_id", "title", "start", "end", "attendees", "calendar_id")
+
+    def __init__(self, event_id: str, title: str, start: datetime, end: datetime, attendees: tuple, calendar_id: str = "primary"):
+        self.event_id = event_id
+        self.title = title
+        self.start = start
+        self.end = end
+        self.attendees = attendees
+        self.calendar_id = calendar_id
+
+    def __repr__(self):
+        return f"IndexedEvent({self.event_id!r}, {self.title!r}, {self.start.isoformat()})"
+
+
+def normalize_title(title: str) -> str:
+    return " ".join(title.lower().split())
+
+
+def event_from_api(event: dict, calendar_id: str = "primary") -> IndexedEvent | None:
+    """
+        Build an `IndexedEvent` from a Google Calendar API event resource. Returns None if it has no start time.
+    """
+
+    start = parse_event_time(event.get("start"))
+    if start is None:
+        return None
+    end = parse_event_time(event.get("end")) or start
+
+    attendees = tuple(attendee["email"] for attendee in event.get("attendees", []) if "email" in attendee)
+    return IndexedEvent(event["id"], event.get("summary") or "", start, end, attendees, calendar_id)
+
+
+class EventIndex:
+    """
+        In-memory index of the events of the searched calendars of one connected account (see `list_calendars`).
+
+        Events are kept in a sorted list of `(normalized title, start, event ID)` so exact and prefix title
+        lookups are a binary search. Lookups fall back to word and fuzzy matching, and matches are ordered
+        by how well they match, then upcoming events first by start time.
+    """
+
+    def __init__(self):
+        self.events = {} # event_id -> IndexedEvent
+        self._titles = [] # sorted (normalized title, start timestamp, event_id)
+        self.sync_tokens = {} # calendar_id -> sync token of the calendar, None until its first sync
+        self.horizons = {} # calendar_id -> end of the window listed by the last full sync of the calendar
+        self.synced_at = 0.0
+        self.stale = True
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def upsert(self, event: IndexedEvent):
+        with self.lock:
+            self.remove(event.event_id)
+            self.events[event.event_id] = event
+            bisect.insort(self._titles, (normalize_title(event.title), event.start.timestamp(), event.event_id))
+
+    def remove(self, event_id: str):
+        with self.lock:
+            event = self.events.pop(event_id, None)
+            if event is None:
+                return
+
+            key = (normalize_title(event.title), event.start.timestamp(), event.event_id)
+            position = bisect.bisect_left(self._titles, key)
+            if position < len(self._titles) and self._titles[position] == key:
+                del self._titles[position]
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self._titles.clear()
+
+    def remove_calendar(self, calendar_id: str):
+        """
+            Drop the events of a calendar, e.g. before it's synced again from scratch.
+        """
+
+        with self.lock:
+            for event_id in [event.event_id for event in self.events.values() if event.calendar_id == calendar_id]:
+                self.remove(event_id)
+            self.sync_tokens.pop(calendar_id, None)
+            self.horizons.pop(calendar_id, None)
+
+    def update(self, event_id: str, title: str | None = None, start: datetime | None = None, end: datetime | None = None, attendees: tuple | None = None):
+        """
+            Apply the known fields of a modified event.
+        """
+
+        with self.lock:
+            event = self.events.get(event_id)
+            if event is None:
+                return
+
+            self.upsert(IndexedEvent(
+                event_id,
+                title if title is not None else event.title,
+                start or event.start,
+                end or event.end,
+                attendees if attendees is not None else event.attendees,
+                event.calendar_id,
+            ))
+
+    def remove_attendee(self, event_id: str, email: str):
+        with self.lock:
+            event = self.events.get(event_id)
+            if event is not None:
+                self.update(event_id, attendees=tuple(attendee for attendee in event.attendees if attendee.lower() != email.lower()))
+
+    def find(self, title: str, now: datetime | None = None) -> list[IndexedEvent]:
+        """
+            Find the events matching the title, best match first.
+        """
+
+        query = normalize_title(title)
+        if not query:
+            return []
+
+        now = now or datetime.now(timezone.utc)
+
+        with self.lock:
+            # Exact and prefix matches are a contiguous range of the sorted titles
+            position = bisect.bisect_left(self._titles, (query,))
+            exact, prefix = [], []
+            while position < len(self._titles) and self._titles[position][0].startswith(query):
+                entry = self._titles[position]
+                (exact if entry[0] == query else prefix).append(self.events[entry[2]])
+                position += 1
+
+            ranked = [exact, prefix]
+            if not exact and not prefix:
+                words = set(query.split())
+                ranked.append([event for event in self.events.values() if words <= set(normalize_title(event.title).split()) or query in normalize_title(event.title)])
+
+                if not ranked[-1]:
+                    titles = {normalize_title(event.title) for event in self.events.values()}
+                    close = set(difflib.get_close_matches(query, titles, n=5, cutoff=FUZZY_CUTOFF))
+                    ranked.append([event for event in self.events.values() if normalize_title(event.title) in close])
+
+        matches = []
+        for group in ranked:
+            upcoming = sorted((event for event in group if event.end >= now), key=lambda event: event.start)
+            past = sorted((event for event in group if event.end < now), key=lambda event: event.start, reverse=True)
+            matches.extend(upcoming + past)
+        return matches
+
+    def between(self, time_min: datetime, time_max: datetime) -> list[IndexedEvent]:
+        """
+            Get the events overlapping [time_min, time_max), ordered by start time.
+        """
+
+        with self.lock:
+            events = [event for event in self.events.values() if event.start < time_max and event.end > time_min]
+        return sorted(events, key=lambda event: event.start)
+
+
+class EventIndexRegistry:
+    """
+        Event indexes of the connected accounts, kept up to date with Google Calendar sync tokens.
+    """
+
+    def __init__(self, maxsize: int = EVENT_INDEX_SIZE, sync_interval: float = EVENT_INDEX_SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self._indexes = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, connectedAccountId: str) -> EventIndex:
+        index = self._indexes.get(connectedAccountId)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(connectedAccountId)
+                if index is None:
+                    index = EventIndex()
+                    self._indexes.set(connectedAccountId, index)
+        return index
+
+    def peek(self, connectedAccountId: str) -> EventIndex | None:
+        """
+            Get the index of the account without creating one.
+        """
+
+        return self._indexes.get(connectedAccountId)
+
+    def sync(self, connectedAccountId: str, force: bool = False) -> EventIndex:
+        """
+            Get the index of the account, syncing it first if it's stale.
+            The first sync of a calendar lists its events from yesterday to the horizon, the next ones only fetch the changes
+            since its last sync token. Events past the horizon only show up in the changes once modified, so the calendar is
+            listed again from scratch whenever the horizon has moved by `EVENT_INDEX_HORIZON_STEP`.
+        """
+
+        index = self.get(connectedAccountId)
+        if not force and not index.stale and time.monotonic() - index.synced_at < self.sync_interval:
+            return index
+
+        with index.lock:
+            if not force and not index.stale and time.monotonic() - index.synced_at < self.sync_interval:
+                return index # Synced by another thread
+
+            calendar = get_calendar_by_connectedAccountId(connectedAccountId)
+            calendar_ids = [calendar_info["id"] for calendar_info in list_calendars(connectedAccountId)]
+            for calendar_id in [calendar_id for calendar_id in index.sync_tokens if calendar_id not in calendar_ids]:
+                index.remove_calendar(calendar_id) # Hidden or unsubscribed since the last sync
+
+            # One after the other, the client of the Google API can't be shared by threads
+            horizon = datetime.now(timezone.utc) + EVENT_INDEX_HORIZON
+            for calendar_id in calendar_ids:
+                if calendar_id in index.horizons and index.horizons[calendar_id] + EVENT_INDEX_HORIZON_STEP <= horizon:
+                    index.remove_calendar(calendar_id) # Move the window forward
+                try:
+                    self._pull(calendar.service, index, calendar_id)
+                except HttpError as e:
+                    if e.resp.status != 410:
+                        raise
+                    # The sync token expired, start over with a full sync of that calendar
+                    index.remove_calendar(calendar_id)
+                    self._pull(calendar.service, index, calendar_id)
+
+            index.synced_at = time.monotonic()
+            index.stale = False
+
+        return index
+
+    def mark_stale(self, connectedAccountId: str):
+        index = self.peek(connectedAccountId)
+        if index is not None:
+            index.stale = True
+
+    @staticmethod
+    def _pull(service, index: EventIndex, calendar_id: str = "primary"):
+        now = datetime.now(timezone.utc)
+        oldest, newest = now - timedelta(days=1), now + EVENT_INDEX_HORIZON
+
+        page_token = None
+        while True:
+            params = {"calendarId": calendar_id, "singleEvents": True, "maxResults": 2500}
+            full = index.sync_tokens.get(calendar_id) is None
+            if full:
+                # Sync tokens can't be combined with a time range, only the full sync is bounded
+                params["timeMin"], params["timeMax"] = oldest.isoformat(), newest.isoformat()
+            else:
+                params["syncToken"] = index.sync_tokens[calendar_id]
+            if page_token is not None:
+                params["pageToken"] = page_token
+
+            response = service.events().list(**params).execute()
+            for item in response.get("items", []):
+                indexed = index.events.get(item["id"])
+                if indexed is not None and indexed.calendar_id != calendar_id:
+                    continue # The same event on an earlier calendar (e.g. an invitation also on a shared calendar), indexed once
+
+                if item.get("status") == "cancelled":
+                    index.remove(item["id"])
+                    continue
+
+                event = event_from_api(item, calendar_id)
+                if event is None or event.end < oldest or event.start > newest:
+                    index.remove(item["id"])
+                else:
+                    index.upsert(event)
+
+            page_token = response.get("nextPageToken")
+            if page_token is None:
+                index.sync_tokens[calendar_id] = response.get("nextSyncToken")
+                if full:
+                    index.horizons[calendar_id] = newest
+                return
+
+
+# Shared indexes of the process
+event_indexes = EventIndexRegistry()
@@ -0,0 +1,246 @@
+import asyncio
+import functools
+import importlib
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.2")) # Seconds between two looks at a job handed to the workers
+
+
+class QueueFullError(Exception):
+    """
+        Raised when the executor already holds `max_queue` waiting jobs.
+    """
+
+
+class _Job:
+    __slots__ = ("job_id", "user_id", "guild_id")
+
+    def __init__(self, job_id: int, user_id: int, guild_id: int | None):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.guild_id = guild_id
+
+
+class AgentExecutor:
+    """
+        Run blocking agent calls off the event loop.
+
+        Jobs of the same user run one after another in submission order, while the number of jobs
+        running at once is capped globally (`max_workers`) and per guild (`max_per_guild`).
+
+        :param optional max_workers: Size of the worker pool and the global in-flight cap.
+        :param optional max_per_guild: How many jobs of a single guild can run at the same time.
+        :param optional use_processes: Use a process pool instead of a thread pool. The function and its arguments must be picklable then.
+        :param optional max_queue: How many jobs can wait before new ones are rejected with `QueueFullError`.
+    """
+
+    def __init__(self, max_workers: int = 4, max_per_guild: int = 2, use_processes: bool = False, max_queue: int = 100):
+        pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self._pool = pool_class(max_workers=max_workers)
+        self.use_processes = use_processes
+        self.max_workers = max_workers
+        self.max_per_guild = max_per_guild
+        self.max_queue = max_queue
+
+        self._ids = itertools.count(1)
+        self._waiting = deque() # Jobs which are not running yet, in submission order
+        self._running = 0
+        self._global_slots = asyncio.Semaphore(max_workers)
+        self._guild_slots = {} # guild_id -> [semaphore, number of jobs using it]
+        self._user_locks = {} # user_id -> [lock, number of jobs using it]
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def position(self, user_id: int) -> int | None:
+        """
+            Get the 1-based position of the first waiting job of the user, or None if the user has no waiting job.
+        """
+
+        for index, job in enumerate(self._waiting):
+            if job.user_id == user_id:
+                return index + 1
+        return None
+
+    async def run(self, user_id: int, guild_id: int | None, func, *args, on_queued=None, on_started=None, on_progress=None):
+        """
+            Run `func(*args)` in the worker pool and return its result.
+
+            :param required user_id: The ID of the user who submitted the job.
+            :param required guild_id: The ID of the guild the job comes from (None for direct messages).
+            :param required func: The blocking function to run, or its `module:function` name to import it in the worker on first use.
+            :param optional on_queued: Coroutine function called with `(position, queue_depth)` if the job has to wait for a free slot.
+            :param optional on_started: Coroutine function called when a job which had to wait starts running.
+            :param optional on_progress: Thread-safe function passed to `func` as `on_progress`. Ignored with a process pool, as it can't be sent to another process.
+        """
+
+        if isinstance(func, str):
+            func = functools.partial(call_function, func)
+        if on_progress is not None and not self.use_processes:
+            func = functools.partial(func, on_progress=on_progress)
+
+        if len(self._waiting) >= self.max_queue:
+            raise QueueFullError(f"{len(self._waiting)} jobs are already waiting")
+
+        job = _Job(next(self._ids), user_id, guild_id)
+        self._waiting.append(job)
+
+        user_lock = self._acquire_ref(self._user_locks, user_id, asyncio.Lock)
+        guild_slots = self._acquire_ref(self._guild_slots, guild_id, lambda: asyncio.Semaphore(self.max_per_guild))
+
+        try:
+            queued = user_lock.locked() or guild_slots.locked() or self._global_slots.locked()
+            if queued and on_queued is not None:
+                await on_queued(self._waiting.index(job) + 1, len(self._waiting))
+
+            async with user_lock:
+                async with guild_slots:
+                    async with self._global_slots:
+                        self._waiting.remove(job)
+                        self._running += 1
+                        try:
+                            if queued and on_started is not None:
+                                await on_started()
+                            loop = asyncio.get_running_loop()
+                            return await loop.run_in_executor(self._pool, functools.partial(func, *args))
+                        finally:
+                            self._running -= 1
+
+        finally:
+            if job in self._waiting: # The job was cancelled while waiting
+                self._waiting.remove(job)
+            self._release_ref(self._user_locks, user_id)
+            self._release_ref(self._guild_slots, guild_id)
+
+    async def warm_up(self, name: str):
+        """
+            Import the function `name` in the pool ahead of the first job. Only warms the parent process with a process pool.
+        """
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None if self.use_processes else self._pool, resolve_function, name)
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+    @staticmethod
+    def _acquire_ref(registry: dict, key, factory):
+        entry = registry.get(key)
+        if entry is None:
+            entry = registry[key] = [factory(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    @staticmethod
+    def _release_ref(registry: dict, key):
+        entry = registry[key]
+        entry[1] -= 1
+        if entry[1] == 0: # Nobody is waiting on it anymore
+            del registry[key]
+
+
+def function_name(func) -> str:
+    """
+        Get the `module:function` name of a module-level function, which another process can resolve with `resolve_function`.
+    """
+
+    return f"{func.__module__}:{func.__qualname__}"
+
+
+def resolve_function(name: str):
+    module, _, qualname = name.partition(":")
+    return functools.reduce(getattr, qualname.split("."), importlib.import_module(module))
+
+
+def call_function(name: str, *args, **kwargs):
+    """
+        Import the function `name` (`module:function`) and call it, so heavy modules are only loaded by the worker which needs them.
+    """
+
+    return resolve_function(name)(*args, **kwargs)
+
+
+class RemoteAgentExecutor:
+    """
+        Hand agent calls to the worker processes (`worker.py`) through a job queue shared by the processes of the machine.
+
+        Has the same interface as `AgentExecutor`, but the function must be a module-level function and its
+        arguments must be JSON-serialisable. Ordering per user and the per-guild cap are enforced by the queue.
+
+        :param required queue: The job queue shared with the workers, e.g. a `SQLiteJobQueue`.
+        :param optional max_queue: How many jobs can wait before new ones are rejected with `QueueFullError`.
+        :param optional poll_interval: Seconds between two looks at the status of a job.
+    """
+
+    use_processes = True
+
+    def __init__(self, queue, max_queue: int = 100, poll_interval: float = JOB_POLL_INTERVAL):
+        self.queue = queue
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.depth()
+
+    @property
+    def running(self) -> int:
+        return self.queue.running()
+
+    async def run(self, user_id: int, guild_id: int | None, func, *args, on_queued=None, on_started=None, on_progress=None):
+        """
+            Submit `func(*args)` to the workers and wait for its result. See `AgentExecutor.run` for the parameters,
+            `on_progress` is called on the event loop with the progress reported by the worker.
+        """
+
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, self.queue.depth) >= self.max_queue:
+            raise QueueFullError(f"{self.max_queue} jobs are already waiting")
+
+        payload = {"func": func if isinstance(func, str) else function_name(func), "args": list(args), "progress": on_progress is not None}
+        job_id = await loop.run_in_executor(None, self.queue.submit, user_id, guild_id, payload)
+
+        position = None
+        queued = False
+        progress_lines = 0
+        while True:
+            status = await loop.run_in_executor(None, self.queue.status, job_id)
+
+            if status.status == "queued":
+                # The first place is normal, a worker picks the job up on its next look
+                if status.position != position and status.position > 1 and on_queued is not None:
+                    await on_queued(status.position, await loop.run_in_executor(None, self.queue.depth))
+                    queued = True
+                position = status.position
+            elif queued:
+                queued = False
+                if on_started is not None:
+                    await on_started()
+
+            if status.progress and on_progress is not None:
+                lines = status.progress.split("\n")
+                for line in lines[progress_lines:]:
+                    on_progress(line)
+                progress_lines = len(lines)
+
+            if status.finished:
+                if status.status == "failed":
+                    raise RuntimeError(status.result or f"Job {job_id} failed")
+                return status.result
+
+            await asyncio.sleep(self.poll_interval)
+
+    async def warm_up(self, name: str):
+        pass # The workers import the agent when they start
+
+    def shutdown(self, wait: bool = True):
+        self.queue.close()
@@ -0,0 +1,134 @@
+import os
+import re
+from datetime import datetime
+
+
+TOOL_RESULT_MAX_EVENTS = int(os.getenv("TOOL_RESULT_MAX_EVENTS", "20")) # Events listed in a tool result, the rest is counted
+TOOL_RESULT_TITLE_LENGTH = int(os.getenv("TOOL_RESULT_TITLE_LENGTH", "60"))
+TOOL_SCHEMA_MODE = os.getenv("TOOL_SCHEMA_MODE", "lean") # "full" sends the whole docstrings as tool descriptions
+LEAN_PARAM_LENGTH = 70 # Characters kept of the description of every parameter in lean mode
+
+
+def parse_event_time(value: dict | str | None) -> datetime | None:
+    """
+        Parse a Google Calendar `start`/`end` value (`{"dateTime": ...}` or `{"date": ...}`) into an aware datetime.
+    """
+
+    if isinstance(value, dict):
+        value = value.get("dateTime") or value.get("date")
+    if not value:
+        return None
+
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None: # All-day events
+        parsed = parsed.astimezone()
+    return parsed
+
+
+def estimate_tokens(text: str) -> int:
+    """
+        Rough number of tokens of a text (about 4 characters per token for English).
+    """
+
+    return len(text) // 4 + 1
+
+
+def shorten(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _all_day(event: dict) -> bool:
+    start = event.get("start")
+    return isinstance(start, dict) and "date" in start and "dateTime" not in start
+
+
+def _when(event: dict) -> str:
+    start = parse_event_time(event.get("start"))
+    end = parse_event_time(event.get("end"))
+    if start is None:
+        return "no time"
+    if _all_day(event):
+        return f"{start:%Y-%m-%d} all day"
+    if end is None:
+        return f"{start:%Y-%m-%d %H:%M}"
+    if end.date() == start.date():
+        return f"{start:%Y-%m-%d %H:%M}-{end:%H:%M}"
+    return f"{start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}"
+
+
+def format_events(events: list, limit: int = TOOL_RESULT_MAX_EVENTS, title_length: int = TOOL_RESULT_TITLE_LENGTH) -> str:
+    """
+        Format Google Calendar API events for the agent, one short line per event with everything needed to act on it:
+        `- <id> | <start>-<end> | <title> | <n> attendees | calendar <calendar_id>` (the calendar only for events not on the primary one).
+
+        :param required events: The events as returned by the API.
+        :param optional limit: Maximum number of listed events, the others are only counted.
+        :param optional title_length: Maximum length of a title.
+    """
+
+    lines = [f"Found {len(events)} events (ID | time | title | attendees):"]
+    for event in events[:limit]:
+        line = f"- {event.get('id', '?')} | {_when(event)} | {shorten(event.get('summary') or '(no title)', title_length)}"
+        attendees = len(event.get("attendees") or [])
+        if attendees:
+            line += f" | {attendees} attendees"
+        if event.get("calendar_id"):
+            line += f" | calendar {event['calendar_id']}"
+        lines.append(line)
+
+    if len(events) > limit:
+        lines.append(f"... and {len(events) - limit} more, narrow the search with time_min/time_max or query to see them.")
+
+    return "\n".join(lines)
+
+
+def format_agenda(events: list, limit: int = TOOL_RESULT_MAX_EVENTS) -> str:
+    """
+        Format events for the user, without the IDs.
+    """
+
+    lines = []
+    for event in events[:limit]:
+        start = parse_event_time(event.get("start"))
+        if start is None:
+            when = "no time"
+        elif _all_day(event):
+            when = f"{start:%a %d %b} (all day)"
+        else:
+            when = f"{start:%a %d %b, %H:%M}"
+        lines.append(f"- **{event.get('summary') or '(no title)'}** {when}")
+
+    if len(events) > limit:
+        lines.append(f"...and {len(events) - limit} more.")
+
+    return "\n".join(lines)
+
+
+def lean_description(tool) -> str:
+    """
+        Build a short description of a tool: the first paragraph of its docstring and a clipped description of every argument.
+    """
+
+    doc = tool.func.__doc__ or ""
+    summary, _, params = doc.partition(":param")
+    summary = " ".join(summary.split())
+
+    arguments = []
+    for match in re.finditer(r"(?:^|:param)\s*(required|optional)\s+(\w+):\s*(.*?)(?=:param|\Z)", ":param" + params, re.S):
+        required, name, description = match.groups()
+        if name in ("connectedAccountId", "connectionAccountId"):
+            arguments.append(f"{name} (required)")
+            continue
+        description = shorten(" ".join(description.split()).split(". ")[0].rstrip(".\\ "), LEAN_PARAM_LENGTH)
+        arguments.append(f"{name} ({required}): {description}")
+
+    return f"Tool Name: {tool.name}\nTool Description: {summary}\nTool Arguments: " + "; ".join(arguments)
+
+
+def lean_tools(tools: list) -> list:
+    """
+        Copies of the tools with their descriptions shortened by `lean_description`.
+    """
+
+    return [tool.model_copy(update={"description": lean_description(tool)}) for tool in tools]
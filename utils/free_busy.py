@@ -0,0 +1,174 @@
+import bisect
+import math
+import os
+from datetime import datetime, timedelta
+from utils.calendar import get_calendar_by_connectedAccountId
+from utils.formatting import parse_event_time
+
+try:
+    import numpy as np
+except ImportError: # Optional, large merges fall back to the pure Python version
+    np = None
+
+
+FREE_SLOT_STEP = int(os.getenv("FREE_SLOT_STEP_MINUTES", "30")) * 60 # Free slots start on multiples of this many seconds
+WORKING_HOURS = os.getenv("WORKING_HOURS", "09:00-18:00") # Free slots are only searched in these local hours
+FREE_SLOT_BUFFER = int(os.getenv("FREE_SLOT_BUFFER_MINUTES", "15")) * 60 # Slots with this much free time around them rank first
+FREE_SLOTS_PER_DAY = 2 # Slots of one day in the results, so they cover several days
+
+FREEBUSY_MAX_CALENDARS = 50 # Calendars of one freebusy request (limit of the API)
+VECTORIZE_THRESHOLD = 512 # Intervals from which the merge uses numpy, if it's installed
+
+
+def parse_working_hours(value: str) -> tuple:
+    start, _, end = value.partition("-")
+    return datetime.strptime(start.strip(), "%H:%M").time(), datetime.strptime(end.strip(), "%H:%M").time()
+
+
+def merge_intervals(intervals: list) -> list[tuple[float, float]]:
+    """
+        Merge overlapping or touching `(start, end)` intervals (epoch seconds) into a sorted list of disjoint intervals.
+        Empty intervals are dropped.
+    """
+
+    if np is not None and len(intervals) >= VECTORIZE_THRESHOLD:
+        return _merge_vectorized(intervals)
+
+    merged = []
+    for start, end in sorted(intervals):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _merge_vectorized(intervals: list) -> list[tuple[float, float]]:
+    array = np.asarray(intervals, dtype=float).reshape(-1, 2)
+    array = array[array[:, 1] > array[:, 0]]
+    if not len(array):
+        return []
+
+    array = array[np.argsort(array[:, 0], kind="stable")]
+    ends = np.maximum.accumulate(array[:, 1])
+
+    # A new interval starts wherever a start is past every end before it
+    first = np.empty(len(array), dtype=bool)
+    first[0] = True
+    first[1:] = array[1:, 0] > ends[:-1]
+    starts = np.flatnonzero(first)
+    lasts = np.append(starts[1:] - 1, len(array) - 1)
+    return list(zip(array[starts, 0].tolist(), ends[lasts].tolist()))
+
+
+def overlaps(merged: list, start: float, end: float) -> list[tuple[float, float]]:
+    """
+        Get the intervals of a merged list overlapping [start, end).
+    """
+
+    position = bisect.bisect_right(merged, (start, math.inf))
+    if position and merged[position - 1][1] > start:
+        position -= 1
+
+    found = []
+    while position < len(merged) and merged[position][0] < end:
+        found.append(merged[position])
+        position += 1
+    return found
+
+
+def working_windows(time_min: datetime, time_max: datetime, working_hours: tuple, weekends: bool = False) -> list[tuple[float, float]]:
+    """
+        Get the working hours of every day between `time_min` and `time_max` (in the time zone of `time_min`) as epoch intervals.
+    """
+
+    tz = time_min.tzinfo
+    windows = []
+    day = time_min.date()
+    while day <= time_max.date():
+        if weekends or day.weekday() < 5:
+            start = max(datetime.combine(day, working_hours[0], tz), time_min)
+            end = min(datetime.combine(day, working_hours[1], tz), time_max)
+            if start < end:
+                windows.append((start.timestamp(), end.timestamp()))
+        day += timedelta(days=1)
+    return windows
+
+
+def find_free_slots(busy: list, time_min: datetime, time_max: datetime, duration: float, working_hours: tuple | None = None, weekends: bool = False,
+                    max_results: int = 5, step: float = FREE_SLOT_STEP, buffer: float = FREE_SLOT_BUFFER) -> list[tuple[float, float]]:
+    """
+        Find free slots of `duration` seconds between the busy intervals, best first.
+
+        Slots start on multiples of `step` within the working hours. Slots with `buffer` seconds free before and after
+        them rank before the ones right next to a meeting, then earlier slots first. At most `FREE_SLOTS_PER_DAY` slots
+        which don't overlap are kept per day. The result only depends on the input, so the same question always gets the same answer.
+
+        :param required busy: The busy `(start, end)` intervals in epoch seconds, of everybody, in any order.
+        :param required time_min: Start of the search range (aware).
+        :param required time_max: End of the search range (aware).
+        :param required duration: Length of a slot in seconds.
+        :param optional working_hours: `(start, end)` times of day, `WORKING_HOURS` by default.
+        :param optional weekends: Whether to search on Saturdays and Sundays.
+        :param optional max_results: Maximum number of slots returned.
+        :param optional step: Slots start on multiples of this many seconds.
+        :param optional buffer: Seconds of free time around a slot for it to rank first.
+    """
+
+    merged = merge_intervals(busy)
+    candidates = []
+    for day, (window_start, window_end) in enumerate(working_windows(time_min, time_max, working_hours or parse_working_hours(WORKING_HOURS), weekends)):
+        # The free gaps of the window are the space between its busy intervals
+        gap_start = window_start
+        for busy_start, busy_end in overlaps(merged, window_start, window_end) + [(window_end, window_end)]:
+            gap_end = min(busy_start, window_end)
+            start = math.ceil(gap_start / step) * step
+            while start + duration <= gap_end:
+                buffered = (start - gap_start >= buffer or gap_start == window_start) and (gap_end - start - duration >= buffer or gap_end == window_end)
+                candidates.append((not buffered, day, start))
+                start += step
+            gap_start = max(gap_start, busy_end)
+
+    slots = []
+    chosen = {} # day -> slots taken on that day
+    for _, day, start in sorted(candidates):
+        taken = chosen.setdefault(day, [])
+        if len(taken) >= FREE_SLOTS_PER_DAY or any(start < end and start + duration > other for other, end in taken):
+            continue # Overlapping slots are the same suggestion
+        taken.append((start, start + duration))
+        slots.append((start, start + duration))
+        if len(slots) == max_results:
+            break
+    return slots
+
+
+def query_free_busy(connectedAccountId: str, time_min: datetime, time_max: datetime, calendars: list) -> tuple[dict, dict]:
+    """
+        Get the busy intervals of several calendars (e.g. `primary` and the emails of the attendees) with one freebusy request.
+        Returns `({calendar: [(start, end), ...]}, {calendar: reason})`, the second dict holds the calendars which can't be read.
+        Raises the errors of the Google API (`HttpError`, `RefreshError`) and `ComposioError`.
+
+        :param required connectedAccountId: The ID of the connected account of the user.
+        :param required time_min: Start of the range (aware).
+        :param required time_max: End of the range (aware).
+        :param required calendars: The calendar IDs or emails.
+    """
+
+    service = get_calendar_by_connectedAccountId(connectedAccountId).service
+    busy, errors = {}, {}
+    for position in range(0, len(calendars), FREEBUSY_MAX_CALENDARS):
+        body = {
+            "timeMin": time_min.isoformat(),
+            "timeMax": time_max.isoformat(),
+            "items": [{"id": calendar} for calendar in calendars[position:position + FREEBUSY_MAX_CALENDARS]],
+        }
+        response = service.freebusy().query(body=body).execute()
+        for calendar, result in response.get("calendars", {}).items():
+            if result.get("errors"):
+                errors[calendar] = result["errors"][0].get("reason", "unknown")
+                continue
+            busy[calendar] = [(parse_event_time(interval["start"]).timestamp(), parse_event_time(interval["end"]).timestamp()) for interval in result.get("busy", [])]
+    return busy, errors
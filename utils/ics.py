@@ -0,0 +1,240 @@
+import codecs
+import re
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from utils.formatting import parse_event_time
+
+
+FOLD_LENGTH = 75 # Octets of a content line before it's folded (RFC 5545)
+ICS_HEADER = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Google Calendar Discord bot//EN\r\nCALSCALE:GREGORIAN\r\n"
+ICS_FOOTER = "END:VCALENDAR\r\n"
+
+DURATION = re.compile(r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?")
+
+
+class IcsEvent:
+    """
+        A VEVENT of an imported file, with the fields the bot can create.
+    """
+
+    __slots__ = ("uid", "summary", "start", "end", "description", "location", "attendees", "all_day", "recurring")
+
+    def __init__(self):
+        self.uid = None
+        self.summary = ""
+        self.start = None
+        self.end = None
+        self.description = None
+        self.location = None
+        self.attendees = []
+        self.all_day = False
+        self.recurring = False
+
+
+def unescape(value: str) -> str:
+    return re.sub(r"\\([\\;,nN])", lambda match: "\n" if match.group(1) in "nN" else match.group(1), value)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+
+
+def parse_duration(value: str) -> timedelta | None:
+    match = DURATION.fullmatch(value.strip())
+    if match is None:
+        return None
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0), minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == "-" else duration
+
+
+def parse_ics_time(value: str, params: dict) -> tuple[datetime | None, bool]:
+    """
+        Parse a DTSTART/DTEND value into an aware datetime. Returns `(datetime, all_day)`.
+        Times with a TZID are read in that zone, floating times and unknown zones in the local time zone.
+    """
+
+    value = value.strip()
+    try:
+        if params.get("VALUE") == "DATE" or len(value) == 8:
+            return datetime.strptime(value, "%Y%m%d").astimezone(), True
+        if value.endswith("Z"):
+            return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc), False
+        parsed = datetime.strptime(value, "%Y%m%dT%H%M%S")
+    except ValueError:
+        return None, False
+
+    try:
+        return parsed.replace(tzinfo=ZoneInfo(params["TZID"])) if "TZID" in params else parsed.astimezone(), False
+    except (ZoneInfoNotFoundError, ValueError): # e.g. Windows zone names
+        return parsed.astimezone(), False
+
+
+def parse_property(line: str) -> tuple[str, dict, str]:
+    """
+        Split a content line into `(NAME, {PARAM: value}, value)`.
+    """
+
+    # The value starts at the first colon which isn't inside a quoted parameter value
+    quoted = False
+    for position, character in enumerate(line):
+        if character == '"':
+            quoted = not quoted
+        elif character == ":" and not quoted:
+            break
+    else:
+        return line.upper(), {}, ""
+
+    name, *params = line[:position].split(";")
+    parameters = {}
+    for param in params:
+        key, _, value = param.partition("=")
+        parameters[key.upper()] = value.strip('"')
+    return name.upper(), parameters, line[position + 1:]
+
+
+class IcsParser:
+    """
+        Incremental parser of iCalendar data: `feed` it chunks of bytes as they arrive and it returns the events
+        completed by each chunk, so a file is never held in memory. Folded lines may be split across chunks.
+        Components nested in an event (alarms) are skipped, so are the other components (time zones, to-dos).
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._buffer = "" # Text after the last line break
+        self._line = None # Logical line waiting for its continuation lines
+        self._event = None
+        self._depth = 0 # Components open inside the current event
+
+    def feed(self, data: bytes) -> list[IcsEvent]:
+        return self._feed_text(self._decoder.decode(data))
+
+    def close(self) -> list[IcsEvent]:
+        events = self._feed_text(self._decoder.decode(b"", final=True) + "\n")
+        if self._line is not None:
+            events.extend(self._handle(self._line))
+            self._line = None
+        return events
+
+    def _feed_text(self, text: str) -> list[IcsEvent]:
+        events = []
+        lines = (self._buffer + text).split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            line = line.rstrip("\r")
+            if line[:1] in (" ", "\t"):
+                if self._line is not None:
+                    self._line += line[1:] # Unfold
+                continue
+            if self._line is not None:
+                events.extend(self._handle(self._line))
+            self._line = line
+        return events
+
+    def _handle(self, line: str) -> list[IcsEvent]:
+        if not line:
+            return []
+
+        name, params, value = parse_property(line)
+        if name == "BEGIN":
+            if self._event is not None:
+                self._depth += 1
+            elif value.upper() == "VEVENT":
+                self._event = IcsEvent()
+            return []
+
+        if self._event is None:
+            return []
+
+        if name == "END":
+            if self._depth:
+                self._depth -= 1
+                return []
+            event, self._event = self._event, None
+            return [event] if event.start is not None else []
+
+        if self._depth:
+            return [] # Property of an alarm
+
+        event = self._event
+        if name == "UID":
+            event.uid = value
+        elif name == "SUMMARY":
+            event.summary = unescape(value)
+        elif name == "DESCRIPTION":
+            event.description = unescape(value)
+        elif name == "LOCATION":
+            event.location = unescape(value)
+        elif name == "DTSTART":
+            event.start, event.all_day = parse_ics_time(value, params)
+            if event.end is None and event.start is not None:
+                event.end = event.start
+        elif name == "DTEND":
+            end, _ = parse_ics_time(value, params)
+            event.end = end or event.end
+        elif name == "DURATION" and event.start is not None:
+            duration = parse_duration(value)
+            if duration is not None:
+                event.end = event.start + duration
+        elif name in ("RRULE", "RDATE", "RECURRENCE-ID"):
+            event.recurring = True
+        elif name == "ATTENDEE" and value.lower().startswith("mailto:"):
+            event.attendees.append(value[7:])
+        return []
+
+
+def fold(line: str) -> str:
+    """
+        Fold a content line at 75 octets, without splitting a UTF-8 character.
+    """
+
+    encoded = line.encode()
+    if len(encoded) <= FOLD_LENGTH:
+        return line + "\r\n"
+
+    parts = []
+    limit = FOLD_LENGTH
+    while encoded:
+        cut = min(limit, len(encoded))
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80: # Continuation byte
+            cut -= 1
+        parts.append(encoded[:cut].decode())
+        encoded = encoded[cut:]
+        limit = FOLD_LENGTH - 1 # The leading space counts
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def format_ics_time(name: str, value: dict) -> str:
+    if "date" in value and "dateTime" not in value:
+        return f"{name};VALUE=DATE:{value['date'].replace('-', '')}"
+    return f"{name}:{parse_event_time(value).astimezone(timezone.utc):%Y%m%dT%H%M%SZ}"
+
+
+def format_ics_event(event: dict, stamp: datetime | None = None) -> str:
+    """
+        Format a Google Calendar API event as a VEVENT. Returns an empty string for events without a start.
+    """
+
+    if not isinstance(event.get("start"), dict) or parse_event_time(event["start"]) is None:
+        return ""
+
+    stamp = stamp or datetime.now(timezone.utc)
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{event.get('iCalUID') or event.get('id')}",
+        f"DTSTAMP:{stamp:%Y%m%dT%H%M%SZ}",
+        format_ics_time("DTSTART", event["start"]),
+    ]
+    if isinstance(event.get("end"), dict) and parse_event_time(event["end"]) is not None:
+        lines.append(format_ics_time("DTEND", event["end"]))
+    lines.append(f"SUMMARY:{escape(event.get('summary') or '')}")
+    if event.get("description"):
+        lines.append(f"DESCRIPTION:{escape(event['description'])}")
+    if event.get("location"):
+        lines.append(f"LOCATION:{escape(event['location'])}")
+    for attendee in event.get("attendees") or []:
+        if attendee.get("email"):
+            lines.append(f"ATTENDEE:mailto:{attendee['email']}")
+    lines.append("END:VEVENT")
+    return "".join(fold(line) for line in lines)
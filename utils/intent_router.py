@@ -0,0 +1,310 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from google.auth.exceptions import RefreshError
+from googleapiclient.errors import HttpError
+from tools import (
+    create_event,
+    search_all_events,
+    delete_event,
+    remove_attendee_event,
+    PENDING_CREATE_NOTE,
+)
+from utils.composio import ComposioError
+from utils.event_index import event_indexes, normalize_title
+from utils.session_memory import sessions
+from utils.formatting import format_agenda
+from utils.metrics import span
+
+
+# Building blocks which can be used as `{DATE}`, `{TIME}`, `{EMAIL}` and `{EMAILS}` in the grammar
+DATE = r"today|tonight|tomorrow|this week|next week|(?:next\s+)?(?:mon|tues|wednes|thurs|fri|satur|sun)day|\d{4}-\d{2}-\d{2}"
+TIME = r"\d{1,2}(?::\d{2})?\s*(?:am|pm)|\d{1,2}:\d{2}|noon"
+EMAIL = r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+EMAILS = r"{EMAIL}(?:\s*(?:,|and|,\s*and)\s*{EMAIL})*"
+
+# Regular expressions of every intent (case insensitive). The first matching pattern wins.
+DEFAULT_GRAMMAR = {
+    "default_duration_minutes": 60,
+    "intents": {
+        "list_events": [
+            r"^(?:what(?:'s| is)\s+(?:on|happening|planned|scheduled)|what do i have|what have i got|(?:show|list|get)(?:\s+me)?(?:\s+all)?(?:\s+my)?\s+(?:events|meetings|schedule|calendar|agenda)|(?:my\s+)?(?:agenda|schedule))(?:\s+(?:for|on))?\s+(?P<when>{DATE})\s*\??$",
+            r"^(?:any|do i have any)\s+(?:events|meetings)\s+(?:for\s+|on\s+)?(?P<when>{DATE})\s*\??$",
+        ],
+        "remove_attendee": [
+            r"^(?:remove|uninvite)\s+(?P<email>{EMAIL})\s+from\s+(?:the\s+|my\s+)?(?P<title>.+?)(?:\s+(?:event|meeting))?\s*[.!]?$",
+        ],
+        "delete_event": [
+            r"^(?:delete|cancel|remove)\s+(?:the\s+|my\s+)?(?P<title>.+?)(?:\s+(?:event|meeting))?\s*[.!]?$",
+        ],
+        "create_event": [
+            r"^(?:create|schedule|add|book|set up)\s+(?:an?\s+|the\s+)?(?P<title>.+?)\s+(?:on\s+)?(?P<when>{DATE})\s+at\s+(?P<time>{TIME})(?:\s+for\s+(?P<duration>\d+)\s*(?P<unit>minutes?|mins?|hours?|hrs?|h))?(?:\s+with\s+(?P<emails>{EMAILS}))?\s*[.!]?$",
+            r"^(?:create|schedule|add|book|set up)\s+(?:an?\s+|the\s+)?(?P<title>.+?)\s+at\s+(?P<time>{TIME})\s+(?:on\s+)?(?P<when>{DATE})(?:\s+for\s+(?P<duration>\d+)\s*(?P<unit>minutes?|mins?|hours?|hrs?|h))?(?:\s+with\s+(?P<emails>{EMAILS}))?\s*[.!]?$",
+        ],
+    },
+}
+
+# Words which make a title too vague to resolve without the agent
+AMBIGUOUS_TITLE_WORDS = {
+    "all", "every", "each", "events", "meetings", "everything", "it", "them", "that", "this", "recurring", "weekly", "daily", "from",
+    "event", "meeting", "call", "calls", "appointment", "appointments", "session", "sessions", "sync", "syncs", "thing",
+}
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+class Intent:
+    """
+        A recognised command with the values captured by the grammar.
+    """
+
+    __slots__ = ("name", "slots")
+
+    def __init__(self, name: str, slots: dict):
+        self.name = name
+        self.slots = slots
+
+    def __repr__(self):
+        return f"Intent({self.name!r}, {self.slots!r})"
+
+
+class IntentRouter:
+    """
+        Deterministic pre-parser in front of the agent.
+
+        Simple commands ("what's on today", "delete standup", ...) are parsed with a configurable grammar
+        and executed by calling the tools directly. Anything the grammar doesn't fully match is left to the agent.
+
+        :param optional grammar: The grammar to use, see `DEFAULT_GRAMMAR` for its shape.
+    """
+
+    def __init__(self, grammar: dict | None = None):
+        grammar = grammar or DEFAULT_GRAMMAR
+        self.default_duration = timedelta(minutes=grammar.get("default_duration_minutes", 60))
+
+        emails = EMAILS.replace("{EMAIL}", EMAIL)
+        self.patterns = []
+        for name, patterns in grammar["intents"].items():
+            for pattern in patterns:
+                pattern = pattern.replace("{DATE}", DATE).replace("{TIME}", TIME).replace("{EMAILS}", emails).replace("{EMAIL}", EMAIL)
+                self.patterns.append((name, re.compile(pattern, re.IGNORECASE)))
+
+        self.handlers = {
+            "list_events": self._list_events,
+            "delete_event": self._delete_event,
+            "remove_attendee": self._remove_attendee,
+            "create_event": self._create_event,
+        }
+
+        self.hits = 0
+        self.misses = 0
+        self.intent_hits = {}
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "intents": dict(self.intent_hits)}
+
+    def match(self, prompt: str) -> Intent | None:
+        """
+            Parse the prompt. Returns None if it isn't a simple command.
+        """
+
+        prompt = " ".join(prompt.strip().split())
+        for name, pattern in self.patterns:
+            match = pattern.match(prompt)
+            if match is None:
+                continue
+
+            slots = {key: value for key, value in match.groupdict().items() if value is not None}
+            title = slots.get("title")
+            if title is not None:
+                title = title.strip("\"'` ")
+                if not title or set(title.lower().split()) & AMBIGUOUS_TITLE_WORDS or re.search(EMAIL, title):
+                    return None
+                slots["title"] = title
+
+            return Intent(name, slots)
+
+        return None
+
+    def route(self, connectedAccountId: str, prompt: str, now: datetime | None = None) -> str | None:
+        """
+            Handle the prompt without the agent if possible.
+            Returns the response, or None if the prompt has to go to the agent.
+
+            :param required connectedAccountId: The ID of the connected account of the user.
+            :param required prompt: The prompt of the user.
+            :param optional now: The current local time (defaults to now).
+        """
+
+        intent = self.match(prompt)
+        response = None
+        if intent is not None:
+            response = self.handlers[intent.name](connectedAccountId, intent, now or datetime.now().astimezone())
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.intent_hits[intent.name] = self.intent_hits.get(intent.name, 0) + 1
+
+        return response
+
+    # ---- Handlers ----
+
+    def _list_events(self, connectedAccountId: str, intent: Intent, now: datetime) -> str | None:
+        time_min, time_max = self._window(intent.slots["when"], now)
+        with span("tool", tool="find_events"):
+            found = search_all_events(connectedAccountId, {"time_min": time_min.isoformat(), "time_max": time_max.isoformat()})
+
+        if isinstance(found, str): # Error message
+            return found
+        events, _ = found
+
+        when = " ".join(intent.slots["when"].lower().split())
+        if when not in ("today", "tonight", "tomorrow", "this week", "next week"):
+            when = f"on {when}"
+        if not events:
+            return f"You have nothing planned {when} 🎉"
+        return f"Here is what you have {when} 📅\n{format_agenda(events)}"
+
+    def _delete_event(self, connectedAccountId: str, intent: Intent, now: datetime) -> str | None:
+        event = self._event(connectedAccountId, intent.slots["title"])
+        if event is None:
+            return None
+
+        response = delete_event.run(connectedAccountId=connectedAccountId, event_id=event.event_id, calendar_id=self._calendar_id(event))
+        return f"{response} (`{intent.slots['title']}`)"
+
+    def _remove_attendee(self, connectedAccountId: str, intent: Intent, now: datetime) -> str | None:
+        event = self._event(connectedAccountId, intent.slots["title"])
+        if event is None:
+            return None
+
+        return remove_attendee_event.run(connectedAccountId=connectedAccountId, event_id=event.event_id, attendee_email=intent.slots["email"], calendar_id=self._calendar_id(event))
+
+    def _create_event(self, connectedAccountId: str, intent: Intent, now: datetime) -> str | None:
+        day, _ = self._window(intent.slots["when"], now)
+        if intent.slots["when"].lower() in ("this week", "next week"):
+            return None
+
+        start = self._at_time(day, intent.slots["time"])
+        if start is None:
+            return None
+
+        duration = self.default_duration
+        if "duration" in intent.slots:
+            amount = int(intent.slots["duration"])
+            duration = timedelta(hours=amount) if intent.slots["unit"].lower().startswith("h") else timedelta(minutes=amount)
+
+        attendees = re.findall(EMAIL, intent.slots.get("emails", "")) or None
+        title = intent.slots["title"]
+
+        response = create_event.run(
+            connectedAccountId=connectedAccountId,
+            start_datetime=start.isoformat(),
+            end_datetime=(start + duration).isoformat(),
+            title=title[0].upper() + title[1:],
+            attendees=attendees,
+        )
+        response = response.replace(PENDING_CREATE_NOTE, "") # Meant for the agent, the user only sees this answer
+        return f"{response} `{title}` on {start:%A %d %B at %H:%M}."
+
+    # ---- Helpers ----
+
+    @staticmethod
+    def _event(connectedAccountId: str, title: str):
+        """
+            The only event titled exactly `title`. None if there is none, several, or only approximate matches, the agent then asks.
+        """
+
+        try:
+            index = event_indexes.sync(connectedAccountId)
+        except (ComposioError, RefreshError, HttpError) as e:
+            print(f"Could not sync the events of {connectedAccountId} for the intent router: {e!r}")
+            return None # The agent reports the error
+
+        matches = [event for event in index.find(title) if normalize_title(event.title) == normalize_title(title)]
+        if len(matches) != 1:
+            return None
+
+        sessions.remember_event(connectedAccountId, matches[0].event_id, matches[0].title, matches[0].start)
+        return matches[0]
+
+    @staticmethod
+    def _calendar_id(event) -> str | None:
+        return event.calendar_id if event.calendar_id != "primary" else None
+
+    @staticmethod
+    def _window(when: str, now: datetime) -> tuple[datetime, datetime]:
+        """
+            Get the [start, end) interval described by a date expression.
+        """
+
+        when = " ".join(when.lower().split())
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        if when in ("today", "tonight"):
+            return today, today + timedelta(days=1)
+        if when == "tomorrow":
+            return today + timedelta(days=1), today + timedelta(days=2)
+        if when == "this week":
+            return now, today + timedelta(days=7 - today.weekday())
+        if when == "next week":
+            start = today + timedelta(days=7 - today.weekday())
+            return start, start + timedelta(days=7)
+
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", when):
+            day = datetime.strptime(when, "%Y-%m-%d").replace(tzinfo=now.tzinfo)
+            return day, day + timedelta(days=1)
+
+        weekday = WEEKDAYS.index(when.split()[-1])
+        days_ahead = (weekday - today.weekday()) % 7
+        if when.startswith("next") and days_ahead == 0:
+            days_ahead = 7
+        day = today + timedelta(days=days_ahead)
+        return day, day + timedelta(days=1)
+
+    @staticmethod
+    def _at_time(day: datetime, time: str) -> datetime | None:
+        time = time.lower().replace(" ", "")
+        if time == "noon":
+            return day.replace(hour=12)
+
+        match = re.fullmatch(r"(\d{1,2})(?::(\d{2}))?(am|pm)?", time)
+        hour, minute, meridiem = int(match.group(1)), int(match.group(2) or 0), match.group(3)
+        if meridiem is not None:
+            if not 1 <= hour <= 12:
+                return None
+            hour = hour % 12 + (12 if meridiem == "pm" else 0)
+        if hour > 23 or minute > 59:
+            return None
+        return day.replace(hour=hour, minute=minute)
+
+
+def load_grammar(path: str | None) -> dict:
+    """
+        Load the grammar from a JSON file, falling back to the default one. Intents missing from the file keep their default patterns.
+    """
+
+    if not path:
+        return DEFAULT_GRAMMAR
+
+    with open(path) as f:
+        custom = json.load(f)
+
+    return {
+        "default_duration_minutes": custom.get("default_duration_minutes", DEFAULT_GRAMMAR["default_duration_minutes"]),
+        "intents": {**DEFAULT_GRAMMAR["intents"], **custom.get("intents", {})},
+    }
+
+
+router = IntentRouter(load_grammar(os.getenv("INTENT_GRAMMAR_PATH")))
@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "./db/jobs.sqlite3")
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "120")) # Seconds without a heartbeat after which a running job's worker is considered dead
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "20")) # Seconds between two heartbeats of a running job
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600")) # Seconds finished jobs are kept
+
+
+class Job:
+    """
+        A job claimed by a worker.
+    """
+
+    __slots__ = ("job_id", "user_id", "guild_id", "payload", "attempts")
+
+    def __init__(self, job_id: int, user_id: int, guild_id: int | None, payload: dict, attempts: int):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.payload = payload
+        self.attempts = attempts
+
+
+class JobStatus:
+    """
+        Snapshot of a job as seen by the process which submitted it.
+    """
+
+    __slots__ = ("status", "progress", "result", "position")
+
+    def __init__(self, status: str, progress: str | None, result: str | None, position: int | None):
+        self.status = status
+        self.progress = progress
+        self.result = result
+        self.position = position
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+
+class SQLiteJobQueue:
+    """
+        Job queue shared by the gateway processes (producers) and the agent workers (consumers) of one machine.
+
+        Jobs are claimed in submission order, but a job is only handed out once the previous jobs of the same user
+        have finished (even when the older one waits for its guild) and while its guild runs less than `max_per_guild`
+        jobs, like the in-process `AgentExecutor`. Claiming runs in a `BEGIN IMMEDIATE` transaction, so a job is never
+        handed to two workers. Workers renew the lease of their running jobs with `heartbeat`, a job is only queued
+        again once its heartbeats stopped.
+
+        :param optional path: Path of the database file.
+        :param optional max_per_guild: How many jobs of a single guild can run at the same time.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, max_per_guild: int = 2):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.max_per_guild = max_per_guild
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                guild_id INTEGER,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                progress TEXT,
+                result TEXT,
+                worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                heartbeat_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, job_id);
+            CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, status, job_id);
+        """)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(jobs)")}
+        if "heartbeat_at" not in columns: # Queue created before the heartbeats
+            self._connection.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+
+    def submit(self, user_id: int, guild_id: int | None, payload: dict) -> int:
+        """
+            Add a job and return its ID.
+        """
+
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO jobs (user_id, guild_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, guild_id, json.dumps(payload), time.time())
+            )
+        return cursor.lastrowid
+
+    def claim(self, worker: str) -> Job | None:
+        """
+            Hand the next runnable job to a worker, or return None if there is none.
+        """
+
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                row = cursor.execute("""
+                    SELECT job_id, user_id, guild_id, payload, attempts FROM jobs AS j
+                    WHERE status = 'queued'
+                    AND user_id NOT IN (SELECT user_id FROM jobs WHERE status = 'running')
+                    AND NOT EXISTS (
+                        SELECT 1 FROM jobs AS earlier
+                        WHERE earlier.user_id = j.user_id AND earlier.status = 'queued' AND earlier.job_id < j.job_id
+                    )
+                    AND (guild_id IS NULL OR guild_id NOT IN (
+                        SELECT guild_id FROM jobs WHERE status = 'running' AND guild_id IS NOT NULL
+                        GROUP BY guild_id HAVING COUNT(*) >= ?
+                    ))
+                    ORDER BY job_id LIMIT 1
+                """, (self.max_per_guild,)).fetchone()
+                if row is not None:
+                    cursor.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE job_id = ?",
+                        (worker, time.time(), time.time(), row[0])
+                    )
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        return Job(row[0], row[1], row[2], json.loads(row[3]), row[4] + 1)
+
+    def heartbeat(self, job_id: int):
+        """
+            Renew the lease of a running job, so it isn't queued again while its worker is still on it.
+        """
+
+        with self._lock:
+            self._connection.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND status = 'running'", (time.time(), job_id))
+
+    def add_progress(self, job_id: int, text: str):
+        """
+            Append a progress line to a running job.
+        """
+
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET progress = CASE WHEN progress IS NULL THEN ? ELSE progress || char(10) || ? END WHERE job_id = ?",
+                (text, text, job_id)
+            )
+
+    def finish(self, job_id: int, result: str, failed: bool = False):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE job_id = ?",
+                ("failed" if failed else "done", result, time.time(), job_id)
+            )
+
+    def status(self, job_id: int) -> JobStatus | None:
+        """
+            Get the status of a job, with its 1-based position among the waiting jobs while it's queued.
+        """
+
+        with self._lock:
+            row = self._connection.execute("SELECT status, progress, result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            position = None
+            if row[0] == "queued":
+                position = self._connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND job_id <= ?", (job_id,)).fetchone()[0]
+        return JobStatus(row[0], row[1], row[2], position)
+
+    def depth(self) -> int:
+        """
+            Number of jobs waiting for a worker.
+        """
+
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def running(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+
+    def requeue_expired(self, timeout: float = JOB_TIMEOUT, max_attempts: int = 2) -> int:
+        """
+            Queue the running jobs without a heartbeat for more than `timeout` seconds again, their worker died.
+            Jobs which already had `max_attempts` attempts are failed instead. Returns the number of expired jobs.
+        """
+
+        deadline = time.time() - timeout
+        with self._lock:
+            failed = self._connection.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ? WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ? AND attempts >= ?",
+                (time.time(), deadline, max_attempts)
+            ).rowcount
+            requeued = self._connection.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ?",
+                (deadline,)
+            ).rowcount
+        return failed + requeued
+
+    def purge(self, retention: float = JOB_RETENTION) -> int:
+        """
+            Delete the jobs which finished more than `retention` seconds ago.
+        """
+
+        with self._lock:
+            return self._connection.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - retention,)
+            ).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from utils.cache import LRUCache
+from utils.metrics import registry
+
+
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "8")) # Seconds before a duplicate of a slow call is sent, 0 to never hedge
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60")) # Seconds before a call (and its duplicate) is given up
+LLM_MAX_CALLS = int(os.getenv("LLM_MAX_CALLS", "16")) # Model calls running at once, hedges included
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "memory") # "off", "memory", "record" (also writes LLM_CACHE_DIR) or "replay" (only reads it)
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./db/llm_cache")
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1000"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+
+llm_calls = registry.counter("llm_gateway_calls_total", "LLM calls by tier (fast, final) and result (ok, hedged, cached, timeout, error).")
+
+# Shared by all the gateways, the losing call of a hedge keeps its thread until it returns
+_calls = ThreadPoolExecutor(max_workers=LLM_MAX_CALLS, thread_name_prefix="llm")
+
+
+class ReplayMissError(Exception):
+    """
+        Raised in replay mode when a prompt has no recorded completion.
+    """
+
+
+class CompletionCache:
+    """
+        Content-addressed cache of completions: the key is a hash of the model, the messages and the stop words.
+
+        In `record` mode every completion is also written to `directory` (one JSON file per key), and in `replay`
+        mode completions are only read from there, so an offline run gives the same answers as the recorded one.
+
+        :param optional mode: "off", "memory", "record" or "replay".
+        :param optional directory: Directory of the recorded completions.
+        :param optional maxsize: Maximum number of completions kept in memory.
+        :param optional ttl: Seconds a completion stays in memory.
+    """
+
+    def __init__(self, mode: str = LLM_CACHE_MODE, directory: str = LLM_CACHE_DIR, maxsize: int = LLM_CACHE_SIZE, ttl: float = LLM_CACHE_TTL):
+        self.mode = mode
+        self.directory = directory
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        if mode == "record" and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @staticmethod
+    def key(model: str, messages: list, stop: list | None) -> str:
+        content = json.dumps([model, [[message.type, message.content] for message in messages], stop or []], sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        text = self.memory.get(key)
+        if text is not None or self.mode not in ("record", "replay"):
+            return text
+
+        path = os.path.join(self.directory, f"{key}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as file:
+            text = json.load(file)["text"]
+        self.memory.set(key, text)
+        return text
+
+    def set(self, key: str, text: str, model: str = ""):
+        if self.mode in ("off", "replay"):
+            return
+
+        self.memory.set(key, text)
+        if self.mode == "record":
+            path = os.path.join(self.directory, f"{key}.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as file:
+                json.dump({"model": model, "text": text}, file, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+
+
+def model_name(model: BaseChatModel) -> str:
+    return str(getattr(model, "model", None) or getattr(model, "model_name", None) or model._llm_type)
+
+
+class LLMGateway(BaseChatModel):
+    """
+        Chat model in front of the real models, used by the agent like any LangChain chat model.
+
+        - Tiering: steps without a tool result yet (planning, picking the first tool) go to the `fast` model,
+          steps which read tool results (and usually write the answer) go to the `final` model.
+        - Hedging: a call still running after `hedge_after` seconds gets a duplicate, the first answer wins.
+          A failed call is retried once the same way. Calls are given up after `timeout` seconds.
+        - Caching: identical prompts to the same model reuse the completion, see `CompletionCache`.
+    """
+
+    fast: BaseChatModel
+    final: BaseChatModel | None = None
+    hedge_after: float = LLM_HEDGE_AFTER
+    timeout: float = LLM_TIMEOUT
+    completions: Any = None # CompletionCache, `cache` is taken by LangChain
+
+    @property
+    def _llm_type(self) -> str:
+        return "gateway"
+
+    def route(self, messages: list) -> str:
+        """
+            Get the tier of a step: "final" once tool results are in the prompt, else "fast".
+        """
+
+        if self.final is not None and any("Observation:" in str(message.content) for message in messages):
+            return "final"
+        return "fast"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tier = self.route(messages)
+        model = self.final if tier == "final" else self.fast
+        name = model_name(model)
+
+        key = None
+        if self.completions is not None and self.completions.enabled:
+            key = self.completions.key(name, messages, stop)
+            text = self.completions.get(key)
+            if text is not None:
+                llm_calls.inc(tier=tier, result="cached")
+                # No tokens were spent on it
+                message = AIMessage(content=text, usage_metadata={"input_tokens": 0, "output_tokens": 0, "total_tokens": 0})
+                return ChatResult(generations=[ChatGeneration(message=message)])
+            if self.completions.mode == "replay":
+                raise ReplayMissError(f"No recorded completion of {name} for this prompt ({key})")
+
+        message = self._call_hedged(model, messages, stop, tier, **kwargs)
+        if key is not None:
+            self.completions.set(key, str(message.content), name)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _call_hedged(self, model: BaseChatModel, messages: list, stop: list | None, tier: str, **kwargs) -> AIMessage:
+        deadline = time.monotonic() + self.timeout
+        running = {_calls.submit(model.invoke, messages, stop=stop, **kwargs)}
+        hedged = False
+        error = None
+
+        while running:
+            # Wait for the hedge delay before the duplicate is sent, then until the deadline
+            budget = deadline - time.monotonic()
+            if not hedged and self.hedge_after > 0:
+                budget = min(budget, self.hedge_after)
+            done, running = wait(running, timeout=max(0.0, budget), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    message = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                llm_calls.inc(tier=tier, result="hedged" if hedged else "ok")
+                return message
+
+            if time.monotonic() >= deadline:
+                break
+            if not hedged and (self.hedge_after > 0 or error is not None):
+                hedged = True
+                running.add(_calls.submit(model.invoke, messages, stop=stop, **kwargs))
+
+        if running:
+            llm_calls.inc(tier=tier, result="timeout")
+            raise TimeoutError(f"{model_name(model)} did not answer within {self.timeout:g}s")
+
+        llm_calls.inc(tier=tier, result="error")
+        raise error
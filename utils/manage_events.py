@@ -1,68 +1,216 @@
 import os
-import dotenv
+import time
 from datetime import datetime
 from crewai import Agent, Task
 # from composio_crewai import App, ComposioToolSet
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.callbacks import BaseCallbackHandler
+from utils.settings import get_settings
+from utils.agent_pool import AgentPool
+from utils.intent_router import router
+from utils.progress import progress_callback, describe_step
+from utils.metrics import span, stage_duration, stage_errors, token_accounting, record_tokens
+from utils.formatting import estimate_tokens, lean_tools, TOOL_SCHEMA_MODE
+from utils.response_cache import response_cache, failure_tracking, RESPONSE_CACHE_ENABLED
+from utils.session_memory import sessions
+from utils.llm_gateway import LLMGateway, CompletionCache
 from tools import (
     create_event,
     find_events,
+    find_free_slots,
+    check_conflicts,
     update_event,
     delete_event,
     get_event_id_by_title,
+    find_contact,
     quick_add_event,
     remove_attendee_event,
+    batch_delete_events,
+    batch_update_events,
+    batch_remove_attendee,
 )
 
 
-# Load the environment variables
-dotenv.load_dotenv()
-google_api_key = os.environ["GOOGLE_API_KEY"] # Google API Key
+settings = get_settings()
+google_api_key = settings.require("google_api_key")
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "true").lower() == "true"
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "gemini-1.5-flash") # Plans and picks the first tool
+LLM_FINAL_MODEL = os.getenv("LLM_FINAL_MODEL", "gemini-pro") # Reads the tool results and writes the answer
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2")) # Retries of the client itself, the gateway hedges slow calls
 
-llm = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.1, google_api_key=google_api_key)
+
+
+class LLMTimingHandler(BaseCallbackHandler):
+    """
+        Record the duration of every LLM call in the `llm` stage of the metrics.
+    """
+
+    def __init__(self):
+        self._started = {} # run_id -> start time
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self._started.pop(run_id, None)
+        if start is not None:
+            stage_duration.observe(time.perf_counter() - start, stage="llm")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._started.pop(run_id, None)
+        stage_errors.inc(stage="llm")
+
+
+class LLMTokenHandler(BaseCallbackHandler):
+    """
+        Record the tokens of every LLM call, from the usage reported by the model or estimated from the text.
+    """
+
+    def __init__(self):
+        self._prompt_tokens = {} # run_id -> estimated prompt tokens
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._prompt_tokens[run_id] = sum(estimate_tokens(prompt) for prompt in prompts)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens = self._prompt_tokens.pop(run_id, 0)
+        completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    prompt_tokens = usage.get("input_tokens", prompt_tokens)
+                    completion_tokens += usage.get("output_tokens", 0)
+                else:
+                    completion_tokens += estimate_tokens(generation.text)
+        record_tokens(prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._prompt_tokens.pop(run_id, None)
+
+
+def gemini(model: str) -> ChatGoogleGenerativeAI:
+    return ChatGoogleGenerativeAI(model=model, temperature=0.1, google_api_key=google_api_key, max_retries=LLM_MAX_RETRIES)
+
+
+# The callbacks are on the gateway, so the timings include hedging and cached answers count no tokens
+llm = LLMGateway(
+    fast=gemini(LLM_FAST_MODEL),
+    final=gemini(LLM_FINAL_MODEL) if LLM_FINAL_MODEL != LLM_FAST_MODEL else None,
+    completions=CompletionCache(),
+    callbacks=[LLMTimingHandler(), LLMTokenHandler()],
+)
 
 # composio_toolset = ComposioToolSet()
 # tools = composio_toolset.get_tools(apps=[App.GOOGLECALENDAR])
 
-date = datetime.today().strftime("%Y-%m-%d")
-timezone = datetime.now().astimezone().tzinfo
+calendar_tools = [
+    get_event_id_by_title, create_event, find_events, find_free_slots, check_conflicts, update_event, delete_event, quick_add_event, remove_attendee_event,
+    batch_delete_events, batch_update_events, batch_remove_attendee, find_contact,
+]
+
+# The tool descriptions are sent on every step of the agent, the lean ones are a fraction of the docstrings
+agent_tools = lean_tools(calendar_tools) if TOOL_SCHEMA_MODE == "lean" else calendar_tools
 
 
-def manage_events(connectedAccountId: str, prompt: str) -> str:
+def build_calendar_agent() -> Agent:
+    """
+        Build the Google Calendar agent. It holds no per-user data, so it can be reused across requests.
+    """
+
+    with span("agent_construction"):
+        return Agent(
+            role="Google Calendar Agent",
+            goal="""You take action on Google Calendar using Google Calendar APIs""",
+            backstory="""You are an AI agent responsible for taking actions on Google Calendar on users' behalf.
+            You need to take action on Calendar using Google Calendar APIs. Use correct tools to run APIs from the given tool-set.""",
+            verbose=True,
+            tools=agent_tools,
+            llm=llm,
+        )
+
+
+# One agent per worker thread, built once per process
+agent_pool = AgentPool(build_calendar_agent, size=settings.agent_max_workers)
+
+
+def manage_events(connectedAccountId: str, prompt: str, on_progress=None) -> str:
     """
         Run the crew to manage events in Google Calendar.
         :param required connectedAccountId: The ID of the connected account of the user.
         :param required prompt: The prompt for the crew to follow.
+        :param optional on_progress: Function called with a short description of every step (tool used, tool finished, answer being written).
     """
 
+    # Repeated read-only queries are answered from the cache
+    cache_key = response_cache.key(connectedAccountId, prompt, router.match(prompt)) if RESPONSE_CACHE_ENABLED else None
+    if cache_key is not None:
+        response = response_cache.get(cache_key)
+        if response is not None:
+            sessions.record_turn(connectedAccountId, prompt, response)
+            return response
+
+    with failure_tracking() as failures, token_accounting():
+        response = answer(connectedAccountId, prompt, on_progress)
+
+    if not response:
+        return "Something went wrong. Please try again."
+
+    if cache_key is not None and not failures:
+        response_cache.set(cache_key, response)
+
+    sessions.record_turn(connectedAccountId, prompt, response) # Context of the next prompt
+    return response
+
+
+def answer(connectedAccountId: str, prompt: str, on_progress=None) -> str | None:
+    """
+        Answer the prompt with the intent router, or with the agent if the router can't handle it.
+    """
+
+    # Simple commands are handled without the LLM
+    if INTENT_ROUTER_ENABLED:
+        with span("intent_router"):
+            response = router.route(connectedAccountId, prompt)
+        if response is not None:
+            return response
+
     log = ""
 
-    calendar_agent = Agent(
-        role="Google Calendar Agent",
-        goal="""You take action on Google Calendar using Google Calendar APIs""",
-        backstory="""You are an AI agent responsible for taking actions on Google Calendar on users' behalf.
-        You need to take action on Calendar using Google Calendar APIs. Use correct tools to run APIs from the given tool-set.""",
-        verbose=True,
-        tools=[get_event_id_by_title, create_event, find_events, update_event, delete_event, quick_add_event, remove_attendee_event],
-        llm=llm,
-    )
+    # Computed per request, the process may run for days
+    date = datetime.today().strftime("%Y-%m-%d")
+    timezone = datetime.now().astimezone().tzinfo
+
+    # What the user did just before, so follow-ups like "move it to 4pm" don't start over
+    context = sessions.context(connectedAccountId)
+    if context:
+        context = f"\n{context}\n"
 
     def log_response(response):
         nonlocal log
         log += response + "\n"
 
-    task = Task(
-        description=f"""Manage events in Google Calendar based on: \n {prompt} \n 
-        Schedule it for given date. Today's date is {date} and make the timezone be {timezone}.
-        The connected account ID (connectedAccountId) is {connectedAccountId}.
-        """,
-        agent=calendar_agent,
-        expected_output="Successfully scheduled or found the events. Also your final answer should be a statement which fits the prompt dont say `Successfully scheduled the events` or `Successfully scheduled or found the events`, also give more human like response and add some emojis if necessary.",
-        on_result=log_response,
-    )
-
-    response = task.execute()
-    if response:
-        return response
-    else:
-        return "Something went wrong. Please try again."
\ No newline at end of file
+    def log_step(step):
+        description = describe_step(step)
+        if description is not None and on_progress is not None:
+            on_progress(description)
+
+    with agent_pool.acquire() as calendar_agent, progress_callback(on_progress):
+        calendar_agent.step_callback = log_step
+        task = Task(
+            description=f"""Manage events in Google Calendar based on: \n {prompt} \n
+            Schedule it for given date. Today's date is {date} and make the timezone be {timezone}.
+            The connected account ID (connectedAccountId) is {connectedAccountId}.
+            {context}""",
+            agent=calendar_agent,
+            expected_output="Successfully scheduled or found the events. Also your final answer should be a statement which fits the prompt dont say `Successfully scheduled the events` or `Successfully scheduled or found the events`, also give more human like response and add some emojis if necessary.",
+            on_result=log_response,
+        )
+
+        try:
+            with span("agent_run"):
+                response = task.execute()
+        finally:
+            calendar_agent.step_callback = None
+
+    return response
@@ -0,0 +1,319 @@
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # 0 disables the HTTP endpoint
+TRACE_LOG = os.getenv("TRACE_LOG", "false").lower() == "true" # Log every span as a JSON line
+
+# Bucket upper bounds in seconds, from a Composio round trip to a long agent run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+trace_logger = logging.getLogger("discord_ai_agent.trace")
+_local = threading.local()
+
+
+class _Metric:
+    def __init__(self, name: str, help: str, kind: str):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self._values = {} # sorted label items -> value
+        self._functions = {} # sorted label items -> function returning the value
+        self._lock = threading.Lock()
+
+    def _render_labels(self, labels: tuple, extra: str = "") -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def set_function(self, function, **labels):
+        self._functions[tuple(sorted(labels.items()))] = function
+
+    def render(self) -> list[str]:
+        for labels, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            with self._lock:
+                self._values[labels] = value
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{self._render_labels(labels)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """
+        A total which only goes up. `set_function` makes it read a total kept by another object when it's exported.
+    """
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, "counter")
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+
+class Gauge(_Metric):
+    """
+        A value which goes up and down. `set_function` makes it read its value when it's exported.
+    """
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, "gauge")
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(_Metric):
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, "histogram")
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0] # bucket counts, count, sum
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                entry[0][position] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def set_function(self, function, **labels):
+        self._functions[tuple(sorted(labels.items()))] = function
+
+    def render(self) -> list[str]:
+        for labels, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            with self._lock:
+                self._values[labels] = value
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, (counts, count, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    bucket_labels = self._render_labels(labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                bucket_labels = self._render_labels(labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                lines.append(f"{self.name}_count{self._render_labels(labels)} {count}")
+                lines.append(f"{self.name}_sum{self._render_labels(labels)} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, metric_class, name: str, help: str, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(name, help, **kwargs)
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_duration = registry.histogram("calendar_stage_duration_seconds", "Duration of every stage of a request.")
+stage_errors = registry.counter("calendar_stage_errors_total", "Stages which raised an exception.")
+composio_errors = registry.counter("composio_errors_total", "Failed Composio requests and actions by kind (auth, rate_limited, http, action).")
+llm_tokens = registry.counter("llm_tokens_total", "Tokens sent to and received from the LLM by kind (prompt, completion).")
+request_tokens = registry.histogram("request_llm_tokens", "LLM tokens (prompt and completion) used by one request.", buckets=TOKEN_BUCKETS)
+startup_seconds = registry.gauge("startup_phase_seconds", "Duration of every startup phase of the process.")
+
+STARTUP_STARTED = time.perf_counter() # The entry points import the metrics before the rest of the code
+
+
+class TokenUsage:
+    """
+        LLM usage of one request.
+    """
+
+    __slots__ = ("calls", "prompt_tokens", "completion_tokens")
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def __str__(self):
+        return f"{self.calls} LLM calls, {self.prompt_tokens} prompt + {self.completion_tokens} completion tokens"
+
+
+@contextmanager
+def token_accounting():
+    """
+        Add up the tokens recorded with `record_tokens` in the current thread during the `with` block.
+        The total is also recorded in `request_llm_tokens` if the LLM was called.
+    """
+
+    previous = getattr(_local, "usage", None)
+    _local.usage = usage = TokenUsage()
+    try:
+        yield usage
+    finally:
+        _local.usage = previous
+        if usage.calls:
+            request_tokens.observe(usage.total_tokens)
+            trace("llm_usage", calls=usage.calls, prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+def record_tokens(prompt_tokens: int, completion_tokens: int):
+    """
+        Record the tokens of one LLM call.
+    """
+
+    llm_tokens.inc(prompt_tokens, kind="prompt")
+    llm_tokens.inc(completion_tokens, kind="completion")
+
+    usage = getattr(_local, "usage", None)
+    if usage is not None:
+        usage.calls += 1
+        usage.prompt_tokens += prompt_tokens
+        usage.completion_tokens += completion_tokens
+
+
+@contextmanager
+def startup_phase(phase: str):
+    """
+        Time a startup phase (e.g. `import_agent`, `gateway`), print it and record it in `startup_phase_seconds`.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup(phase, time.perf_counter() - start)
+
+
+def record_startup(phase: str, duration: float):
+    startup_seconds.set(duration, phase=phase)
+    print(f"Startup: {phase} took {duration:.2f}s ({time.perf_counter() - STARTUP_STARTED:.2f}s since start)")
+
+
+@contextmanager
+def span(stage: str, **labels):
+    """
+        Time a stage of a request and record it in `calendar_stage_duration_seconds`.
+
+        :param required stage: Name of the stage, e.g. `command`, `account_lookup`, `llm`, `tool`, `composio_request`.
+        :param optional labels: Extra labels, e.g. `tool="create_event"`. Keep their values low-cardinality.
+    """
+
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        stage_errors.inc(stage=stage, **labels)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage=stage, **labels)
+        if TRACE_LOG:
+            record = {"stage": stage, "duration_ms": round(duration * 1000, 3), "thread": threading.current_thread().name, **labels}
+            if error is not None:
+                record["error"] = error
+            trace_logger.info(json.dumps(record))
+
+
+def trace(event: str, **fields):
+    """
+        Log an event of a request (e.g. a progress step) as a JSON line of the trace log, if it's enabled.
+    """
+
+    if TRACE_LOG:
+        trace_logger.info(json.dumps({"event": event, "thread": threading.current_thread().name, **fields}, default=str))
+
+
+def traced(stage: str, **labels):
+    """
+        Decorator version of `span`.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = "127.0.0.1") -> ThreadingHTTPServer | None:
+    """
+        Serve the metrics in the Prometheus text format on http://host:port/metrics from a background thread.
+    """
+
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
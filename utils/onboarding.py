@@ -0,0 +1,151 @@
+import asyncio
+import os
+import time
+from utils.account_store import AccountStore
+from utils.composio import ComposioClient, ComposioError
+from utils.metrics import registry
+
+
+ONBOARDING_POLL_INTERVAL = float(os.getenv("ONBOARDING_POLL_INTERVAL", "5")) # Seconds between two checks of a new connection
+ONBOARDING_MAX_POLL_INTERVAL = float(os.getenv("ONBOARDING_MAX_POLL_INTERVAL", "60")) # Older connections are checked less often
+ONBOARDING_CONCURRENCY = int(os.getenv("ONBOARDING_CONCURRENCY", "10")) # Status checks running at once
+ONBOARDING_PENDING_TTL = float(os.getenv("ONBOARDING_PENDING_TTL", "86400")) # Seconds before an unfinished connection is dropped
+
+FAILED_STATUSES = {"FAILED", "EXPIRED", "DELETED"}
+
+onboarding_events = registry.counter("onboarding_events_total", "Pending accounts by outcome (promoted, expired, failed).")
+
+
+class OnboardingService:
+    """
+        Background promotion of pending accounts.
+
+        Every pending connection is checked with Composio from the event loop, first every `poll_interval` seconds,
+        then less and less often up to `max_poll_interval`. Connections which became ACTIVE are promoted to
+        accounts, failed ones and the ones older than `pending_ttl` are dropped.
+
+        :param required store: The account store.
+        :param required client: The Composio client.
+        :param optional on_promoted: Coroutine function called with `(user_id, connected_account_id)` once an account is promoted.
+        :param optional on_expired: Coroutine function called with `(user_id, connected_account_id)` when a pending account is dropped.
+        :param optional poll_interval: Seconds between the first checks of a connection.
+        :param optional max_poll_interval: Maximum number of seconds between two checks of a connection.
+        :param optional concurrency: Maximum number of status checks running at once.
+        :param optional pending_ttl: Seconds after which an unfinished connection is dropped.
+    """
+
+    def __init__(self, store: AccountStore, client: ComposioClient, on_promoted=None, on_expired=None,
+                 poll_interval: float = ONBOARDING_POLL_INTERVAL, max_poll_interval: float = ONBOARDING_MAX_POLL_INTERVAL,
+                 concurrency: int = ONBOARDING_CONCURRENCY, pending_ttl: float = ONBOARDING_PENDING_TTL):
+        self.store = store
+        self.client = client
+        self.on_promoted = on_promoted
+        self.on_expired = on_expired
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.pending_ttl = pending_ttl
+        self._slots = asyncio.Semaphore(concurrency)
+        self._schedule = {} # connected_account_id -> (monotonic time of the next check, current interval)
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def watch(self, connected_account_id: str):
+        """
+            Check a new connection on the next round, e.g. right after the user got the link.
+        """
+
+        self._schedule[connected_account_id] = (time.monotonic() + self.poll_interval, self.poll_interval)
+        self._wake.set()
+
+    async def check(self, user_id: int, connected_account_id: str, notify: bool = True) -> str | None:
+        """
+            Check a pending account now. Returns the connected account ID if it was promoted.
+            `notify` False skips `on_promoted`, e.g. when the user is already using the account.
+        """
+
+        async with self._slots:
+            try:
+                account = await self.client.aget_connected_account(connected_account_id)
+            except ComposioError as e:
+                print(f"Could not check the connection of {user_id}: {e!r}")
+                return None
+
+        status = str(account.get("status", "")).upper()
+        if status == "ACTIVE":
+            return await self._promote(user_id, connected_account_id, notify)
+        if status in FAILED_STATUSES:
+            await self._drop(user_id, connected_account_id, "failed")
+        return None
+
+    async def poll(self):
+        """
+            Check the pending accounts which are due.
+        """
+
+        loop = asyncio.get_running_loop()
+        pending = await loop.run_in_executor(None, self.store.list_pending)
+        now = time.monotonic()
+        age_limit = time.time() - self.pending_ttl
+
+        due = []
+        for user_id, connected_account_id, created_at in pending:
+            if created_at < age_limit:
+                await self._drop(user_id, connected_account_id, "expired")
+                continue
+
+            next_check, interval = self._schedule.get(connected_account_id, (now, self.poll_interval))
+            if next_check <= now:
+                self._schedule[connected_account_id] = (now + interval, min(interval * 2, self.max_poll_interval))
+                due.append(self.check(user_id, connected_account_id))
+
+        # Forget the schedule of the connections which aren't pending anymore
+        known = {connected_account_id for _, connected_account_id, _ in pending}
+        for connected_account_id in list(self._schedule):
+            if connected_account_id not in known:
+                del self._schedule[connected_account_id]
+
+        if due:
+            await asyncio.gather(*due)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"Polling the pending accounts failed: {e!r}")
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _promote(self, user_id: int, connected_account_id: str, notify: bool = True) -> str | None:
+        loop = asyncio.get_running_loop()
+        promoted = await loop.run_in_executor(None, self.store.promote, user_id, connected_account_id)
+        self._schedule.pop(connected_account_id, None)
+        if promoted is None: # Promoted by another process, or replaced by a newer connection
+            return None
+
+        onboarding_events.inc(outcome="promoted")
+        if notify and self.on_promoted is not None:
+            await self.on_promoted(user_id, promoted)
+        return promoted
+
+    async def _drop(self, user_id: int, connected_account_id: str, outcome: str):
+        loop = asyncio.get_running_loop()
+        removed = await loop.run_in_executor(None, self.store.remove_pending, user_id, connected_account_id)
+        self._schedule.pop(connected_account_id, None)
+        if removed:
+            onboarding_events.inc(outcome=outcome)
+            if self.on_expired is not None:
+                await self.on_expired(user_id, connected_account_id)
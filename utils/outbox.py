@@ -0,0 +1,467 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from utils.account_store import AccountStore
+from utils.composio import composio, ActionResult, ComposioClient, ComposioError
+from utils.formatting import parse_event_time
+from utils.metrics import registry
+from utils.settings import get_settings
+
+
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "0.25")) # Seconds between two reads of the outbox while it's idle
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20")) # Mutations claimed at once
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8")) # Mutations applied at once
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6")) # Attempts before a mutation is dead-lettered
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "5")) # Seconds before the first retry, doubled on every attempt
+OUTBOX_DEDUPE_WINDOW = float(os.getenv("OUTBOX_DEDUPE_WINDOW", "600")) # Seconds an identical mutation waiting to be applied is not queued again
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", "86400")) # Seconds applied and dead mutations are kept
+
+MAX_RETRY_DELAY = 300
+CLAIM_TIMEOUT = 300 # Seconds after which a mutation claimed by a dead flusher is queued again
+PURGE_INTERVAL = 3600
+
+ACTION_NAMES = {
+    "googlecalendar_create_event": "create the event",
+    "googlecalendar_quick_add": "quick add the event",
+    "googlecalendar_update_event": "update the event",
+    "googlecalendar_delete_event": "delete the event",
+    "googlecalendar_remove_attendee": "remove the attendee from the event",
+}
+
+outbox_mutations = registry.counter("outbox_mutations_total", "Calendar mutations of the outbox by result (queued, duplicate, applied, retried, dead).")
+
+
+class Mutation:
+    """
+        A mutation claimed by the flusher.
+    """
+
+    __slots__ = ("mutation_id", "connected_account_id", "action", "input_data", "event_id", "attempts")
+
+    def __init__(self, mutation_id: int, connected_account_id: str, action: str, input_data: dict, event_id: str | None, attempts: int):
+        self.mutation_id = mutation_id
+        self.connected_account_id = connected_account_id
+        self.action = action
+        self.input_data = input_data
+        self.event_id = event_id
+        self.attempts = attempts
+
+    def describe(self) -> str:
+        name = ACTION_NAMES.get(self.action, self.action)
+        title = self.input_data.get("summary") or self.input_data.get("text") or self.event_id
+        return f"{name} `{title}`" if title else name
+
+
+def mutation_key(connected_account_id: str, action: str, input_data: dict) -> str:
+    """
+        Idempotency key of a mutation: the same action with the same input on the same account gets the same key.
+    """
+
+    content = json.dumps([connected_account_id, action, input_data], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class SQLiteOutbox:
+    """
+        Durable log of the calendar mutations waiting to be applied, shared by the processes of one machine.
+
+        A mutation is queued with its idempotency key, an identical one queued less than `dedupe_window` seconds
+        before and not applied yet is not queued again (the agent retrying a call after a timeout doesn't create a second event).
+        Mutations of the same event are claimed one at a time in the order they were queued, the others in any order.
+
+        :param required path: Path of the database file.
+        :param optional dedupe_window: Seconds an identical mutation waiting to be applied is not queued again.
+    """
+
+    def __init__(self, path: str, dedupe_window: float = OUTBOX_DEDUPE_WINDOW):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.dedupe_window = dedupe_window
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL") # A queued mutation survives a crash of the process
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS mutations (
+                mutation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL,
+                connected_account_id TEXT NOT NULL,
+                action TEXT NOT NULL,
+                input_data TEXT NOT NULL,
+                event_id TEXT,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                claimed_at REAL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS mutations_due ON mutations (status, next_attempt_at);
+            CREATE INDEX IF NOT EXISTS mutations_event ON mutations (connected_account_id, event_id, status);
+            CREATE INDEX IF NOT EXISTS mutations_key ON mutations (idempotency_key, created_at);
+        """)
+
+    def enqueue(self, connected_account_id: str, action: str, input_data: dict, event_id: str | None = None) -> tuple[int, bool]:
+        """
+            Queue a mutation. Returns `(mutation_id, duplicate)`, `duplicate` is True when an identical mutation was queued recently.
+
+            :param required connected_account_id: The connected account the mutation is applied to.
+            :param required action: The Composio action, e.g. `googlecalendar_update_event`.
+            :param required input_data: The input of the action.
+            :param optional event_id: The event changed by the mutation, its mutations are applied in order. None for new events.
+        """
+
+        key = mutation_key(connected_account_id, action, input_data)
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._pending_duplicate(cursor, key, connected_account_id, event_id, now)
+                if row is None:
+                    mutation_id = cursor.execute(
+                        "INSERT INTO mutations (idempotency_key, connected_account_id, action, input_data, event_id, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, connected_account_id, action, json.dumps(input_data), event_id, now, now)
+                    ).lastrowid
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+        if row is not None:
+            outbox_mutations.inc(result="duplicate")
+            return row[0], True
+        outbox_mutations.inc(result="queued")
+        return mutation_id, False
+
+    def _pending_duplicate(self, cursor, key: str, connected_account_id: str, event_id: str | None, now: float) -> tuple | None:
+        """
+            The identical mutation still waiting to be applied, if any. Applied mutations never match, so repeating a change
+            on purpose (e.g. creating an event again after deleting it) is queued. A change of an event only matches the
+            latest pending change of that event, so moving it from A to B and back to A keeps all three moves.
+        """
+
+        if event_id is None:
+            return cursor.execute(
+                "SELECT mutation_id FROM mutations WHERE idempotency_key = ? AND created_at > ? AND status IN ('queued', 'running') ORDER BY mutation_id DESC LIMIT 1",
+                (key, now - self.dedupe_window)
+            ).fetchone()
+
+        row = cursor.execute(
+            "SELECT mutation_id, idempotency_key, created_at FROM mutations WHERE connected_account_id = ? AND event_id = ? AND status IN ('queued', 'running') ORDER BY mutation_id DESC LIMIT 1",
+            (connected_account_id, event_id)
+        ).fetchone()
+        if row is None or row[1] != key or row[2] <= now - self.dedupe_window:
+            return None
+        return row[:1]
+
+    def claim(self, limit: int = OUTBOX_BATCH_SIZE) -> list[Mutation]:
+        """
+            Claim up to `limit` due mutations, skipping the ones waiting for an earlier mutation of the same event.
+        """
+
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                rows = cursor.execute("""
+                    SELECT mutation_id, connected_account_id, action, input_data, event_id, attempts FROM mutations AS m
+                    WHERE status = 'queued' AND next_attempt_at <= ?
+                    AND (event_id IS NULL OR NOT EXISTS (
+                        SELECT 1 FROM mutations AS earlier
+                        WHERE earlier.connected_account_id = m.connected_account_id AND earlier.event_id = m.event_id
+                        AND earlier.status IN ('queued', 'running') AND earlier.mutation_id < m.mutation_id
+                    ))
+                    ORDER BY mutation_id LIMIT ?
+                """, (now, limit)).fetchall()
+                cursor.executemany(
+                    "UPDATE mutations SET status = 'running', claimed_at = ?, attempts = attempts + 1 WHERE mutation_id = ?",
+                    [(now, row[0]) for row in rows]
+                )
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+        return [Mutation(row[0], row[1], row[2], json.loads(row[3]), row[4], row[5] + 1) for row in rows]
+
+    def record(self, applied: list[int], retries: list[tuple[int, float, str]], dead: list[tuple[int, str]]):
+        """
+            Record the outcomes of a batch in one transaction.
+
+            :param required applied: IDs of the applied mutations.
+            :param required retries: `(mutation_id, next attempt time, error)` of the mutations to retry.
+            :param required dead: `(mutation_id, error)` of the mutations which won't be retried.
+        """
+
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.executemany("UPDATE mutations SET status = 'done', error = NULL, finished_at = ? WHERE mutation_id = ?", [(now, mutation_id) for mutation_id in applied])
+                cursor.executemany("UPDATE mutations SET status = 'queued', next_attempt_at = ?, error = ? WHERE mutation_id = ?", [(at, error, mutation_id) for mutation_id, at, error in retries])
+                cursor.executemany("UPDATE mutations SET status = 'dead', error = ?, finished_at = ? WHERE mutation_id = ?", [(error, now, mutation_id) for mutation_id, error in dead])
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def requeue_expired(self, timeout: float = CLAIM_TIMEOUT) -> int:
+        """
+            Queue the mutations claimed more than `timeout` seconds ago again, their flusher most likely died.
+        """
+
+        with self._lock:
+            return self._connection.execute(
+                "UPDATE mutations SET status = 'queued' WHERE status = 'running' AND claimed_at < ?",
+                (time.time() - timeout,)
+            ).rowcount
+
+    def depth(self) -> int:
+        """
+            Number of mutations not applied yet.
+        """
+
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM mutations WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def dead(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM mutations WHERE status = 'dead'").fetchone()[0]
+
+    def purge(self, retention: float = OUTBOX_RETENTION) -> int:
+        """
+            Delete the mutations which were applied or dead-lettered more than `retention` seconds ago.
+        """
+
+        with self._lock:
+            return self._connection.execute(
+                "DELETE FROM mutations WHERE status IN ('done', 'dead') AND finished_at < ?",
+                (time.time() - retention,)
+            ).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_outbox() -> SQLiteOutbox:
+    """
+        The outbox of the process, opened on first use.
+    """
+
+    return SQLiteOutbox(get_settings().outbox_path)
+
+
+def execute_mutation(connected_account_id: str, action: str, input_data: dict, event_id: str | None = None) -> ActionResult:
+    """
+        Run a mutating Composio action. With the outbox enabled it's only written to the outbox and applied in the
+        background by `OutboxFlusher`, the result is then successful with only `{"queued": True, "mutation_id": ...}` as data
+        (a created event has no ID yet).
+    """
+
+    if not get_settings().outbox_enabled:
+        return composio.execute_action(action, connected_account_id, input_data, idempotent=False)
+
+    mutation_id, _ = get_outbox().enqueue(connected_account_id, action, input_data, event_id)
+    return ActionResult(True, {"queued": True, "mutation_id": mutation_id})
+
+
+def is_retryable(error: ComposioError) -> bool:
+    """
+        Whether a failed mutation may succeed later: rate limits, server errors and calls which got no answer.
+    """
+
+    status = error.code or error.status
+    return error.is_rate_limited or status is None or status >= 500
+
+
+def is_ambiguous(error: ComposioError) -> bool:
+    """
+        Whether a failed call may have been applied anyway (no answer or a server error).
+    """
+
+    status = error.code or error.status
+    return status is None or status >= 500
+
+
+class OutboxFlusher:
+    """
+        Apply the mutations of the outbox to Google Calendar in the background, from the event loop.
+
+        Mutations are claimed in batches and applied concurrently. Failed ones are retried with an exponential backoff
+        when the error is temporary, the others (and the ones out of attempts) are dead-lettered and their user is told.
+        Mutations are sent once per attempt (no transport retries), an attempt which got no answer is retried by the outbox
+        and an event it may have created is looked up first, so it isn't created twice.
+
+        :param required outbox: The outbox.
+        :param required client: The Composio client.
+        :param required store: The account store, to find the user of a failed mutation.
+        :param optional notify: Coroutine function called with `(user_id, text)` when a mutation failed for good.
+        :param optional on_applied: Function called with every applied `Mutation`.
+        :param optional interval: Seconds between two reads of the outbox while it's idle.
+        :param optional batch_size: Mutations claimed at once.
+        :param optional concurrency: Mutations applied at once.
+        :param optional max_attempts: Attempts before a mutation is dead-lettered.
+    """
+
+    def __init__(self, outbox: SQLiteOutbox, client: ComposioClient, store: AccountStore, notify=None, on_applied=None, interval: float = OUTBOX_FLUSH_INTERVAL,
+                 batch_size: int = OUTBOX_BATCH_SIZE, concurrency: int = OUTBOX_CONCURRENCY, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.outbox = outbox
+        self.client = client
+        self.store = store
+        self.notify = notify
+        self.on_applied = on_applied
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._slots = asyncio.Semaphore(concurrency)
+        self._purged_at = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def flush(self) -> int:
+        """
+            Apply one batch of due mutations. Returns the number of claimed mutations.
+        """
+
+        loop = asyncio.get_running_loop()
+        batch = await loop.run_in_executor(None, self.outbox.claim, self.batch_size)
+        if not batch:
+            return 0
+
+        results = await asyncio.gather(*(self.apply(mutation) for mutation in batch))
+
+        applied, retries, dead = [], [], []
+        now = time.time()
+        for mutation, result in zip(batch, results):
+            if result.ok:
+                applied.append(mutation.mutation_id)
+            elif is_retryable(result.error) and mutation.attempts < self.max_attempts:
+                delay = min(OUTBOX_RETRY_DELAY * 2 ** (mutation.attempts - 1), MAX_RETRY_DELAY)
+                retries.append((mutation.mutation_id, now + delay, repr(result.error)))
+            else:
+                dead.append((mutation.mutation_id, repr(result.error)))
+
+        await loop.run_in_executor(None, self.outbox.record, applied, retries, dead)
+        outbox_mutations.inc(len(applied), result="applied")
+        outbox_mutations.inc(len(retries), result="retried")
+        outbox_mutations.inc(len(dead), result="dead")
+
+        for mutation, result in zip(batch, results):
+            if result.ok and self.on_applied is not None:
+                try:
+                    self.on_applied(mutation)
+                except Exception as e:
+                    print(f"Handling the applied mutation {mutation.mutation_id} failed: {e!r}")
+
+        failed = {mutation_id for mutation_id, _ in dead}
+        for mutation, result in zip(batch, results):
+            if mutation.mutation_id in failed:
+                print(f"Mutation {mutation.mutation_id} ({mutation.action}) failed for good: {result.error!r}")
+                await self._notify_failure(mutation, result.error)
+        return len(batch)
+
+    async def apply(self, mutation: Mutation) -> ActionResult:
+        async with self._slots:
+            if mutation.attempts > 1 and mutation.action == "googlecalendar_create_event":
+                created = await self._already_created(mutation)
+                if isinstance(created, ActionResult):
+                    return created # Couldn't check, retried later rather than risking a duplicate
+                if created:
+                    return ActionResult(True)
+
+            # Sent once: an attempt which got no answer is only retried by the outbox, after `_already_created`
+            result = await self.client.aexecute_action(mutation.action, mutation.connected_account_id, mutation.input_data, idempotent=False)
+
+        # Deleting an event which is already gone is what was asked
+        if not result.ok and mutation.action == "googlecalendar_delete_event" and (result.error.code or result.error.status) in (404, 410):
+            return ActionResult(True)
+        return result
+
+    async def _already_created(self, mutation: Mutation) -> bool | ActionResult:
+        """
+            Whether an earlier attempt of a create got no answer but created the event (same title and start).
+            Returns the failed result of the search if it couldn't be checked.
+        """
+
+        start = parse_event_time(mutation.input_data.get("start_datetime"))
+        end = parse_event_time(mutation.input_data.get("end_datetime"))
+        if start is None or end is None:
+            return False
+
+        input_data = {"time_min": start.isoformat(), "time_max": end.isoformat()}
+        if mutation.input_data.get("calendar_id"):
+            input_data["calendar_id"] = mutation.input_data["calendar_id"]
+        result = await self.client.aexecute_action("googlecalendar_find_event", mutation.connected_account_id, input_data)
+        if not result.ok:
+            return result
+
+        for event in result.data.get("event_data") or []:
+            if event.get("summary") == mutation.input_data.get("summary") and parse_event_time(event.get("start")) == start:
+                return True
+        return False
+
+    async def _notify_failure(self, mutation: Mutation, error: ComposioError):
+        if self.notify is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        user_id = await loop.run_in_executor(None, self.store.get_user, mutation.connected_account_id)
+        if user_id is None:
+            return
+
+        if error.is_auth_error:
+            text = f"I couldn't {mutation.describe()} in your Google Calendar because your authentication credentials expired. Please use `!authenticate` and ask me again."
+        else:
+            text = f"I couldn't {mutation.describe()} in your Google Calendar after all: {error.message}. Please check your calendar and try again."
+        try:
+            await self.notify(user_id, text)
+        except Exception as e:
+            print(f"Could not tell {user_id} about the failed mutation {mutation.mutation_id}: {e!r}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        self._purged_at = time.time()
+        try:
+            # Only one process flushes, so whatever is still claimed was claimed by a previous run
+            await loop.run_in_executor(None, self.outbox.requeue_expired, 0)
+        except Exception as e:
+            print(f"Requeuing the claimed mutations failed: {e!r}")
+
+        while True:
+            claimed = 0
+            try:
+                now = time.time()
+                if now - self._purged_at >= PURGE_INTERVAL:
+                    self._purged_at = now
+                    await loop.run_in_executor(None, self.outbox.requeue_expired)
+                    await loop.run_in_executor(None, self.outbox.purge)
+                claimed = await self.flush()
+            except Exception as e:
+                print(f"Flushing the outbox failed: {e!r}")
+
+            # A full batch means more mutations are most likely due
+            if claimed < self.batch_size:
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import discord
+from utils.metrics import trace
+
+
+EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "1.5")) # Seconds between two edits of a progress message
+CHANNEL_EDIT_INTERVAL = float(os.getenv("PROGRESS_CHANNEL_EDIT_INTERVAL", "1.0")) # Seconds between two edits in one channel
+MESSAGE_LIMIT = 2000 # Maximum length of a Discord message
+
+_local = threading.local()
+
+
+@contextmanager
+def progress_callback(callback):
+    """
+        Send the progress reported by `report_progress` in the current thread to `callback` during the `with` block.
+    """
+
+    previous = getattr(_local, "callback", None)
+    _local.callback = callback
+    try:
+        yield
+    finally:
+        _local.callback = previous
+
+
+def report_progress(text: str):
+    """
+        Log a step of the current request and forward it to the progress callback of the thread, if any.
+    """
+
+    trace("progress", step=text)
+
+    callback = getattr(_local, "callback", None)
+    if callback is not None:
+        callback(f"🔧 {text}...")
+
+
+def describe_step(step) -> str | None:
+    """
+        Describe a step of the agent, as given to its `step_callback`.
+    """
+
+    if hasattr(step, "return_values"): # The agent's final answer
+        return "✍️ Writing the answer..."
+
+    if isinstance(step, list):
+        tools = [action.tool for action, _ in step if hasattr(action, "tool")]
+        if tools:
+            return f"✅ Done with {', '.join(tools)}"
+
+    return None
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+        Split a text in chunks fitting in Discord messages, on line breaks when possible.
+    """
+
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+
+class ChannelEditLimiter:
+    """
+        Spaces out the message edits of every channel to stay inside Discord's per-channel rate limits.
+    """
+
+    def __init__(self, interval: float = CHANNEL_EDIT_INTERVAL):
+        self.interval = interval
+        self._next = {} # channel_id -> monotonic time of the next free slot
+
+    async def wait(self, channel_id: int):
+        now = time.monotonic()
+        if len(self._next) > 1000:
+            self._next = {key: value for key, value in self._next.items() if value > now}
+
+        slot = max(now, self._next.get(channel_id, now))
+        self._next[channel_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+channel_limiter = ChannelEditLimiter()
+
+
+class ProgressMessage:
+    """
+        A Discord message edited in place with the latest progress of a request.
+
+        `update` can be called from any thread. Updates are coalesced and the message is edited
+        at most once every `min_interval` seconds.
+
+        :param required message: The message to edit.
+        :param optional header: Text shown above the progress lines.
+        :param optional min_interval: Minimum number of seconds between two edits.
+    """
+
+    def __init__(self, message: discord.Message, header: str = "", min_interval: float = EDIT_INTERVAL):
+        self.message = message
+        self.header = header
+        self.min_interval = min_interval
+        self.lines = deque(maxlen=6)
+        self._closed = False
+        self._loop = asyncio.get_running_loop()
+        self._dirty = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    def update(self, text: str):
+        """
+            Add a progress line. Thread-safe.
+        """
+
+        self._loop.call_soon_threadsafe(self._add, text)
+
+    def set_header(self, header: str):
+        self.header = header
+        self._dirty.set()
+
+    async def finish(self, text: str):
+        """
+            Replace the progress with the final response. Parts which don't fit in one message are sent as new messages.
+        """
+
+        self._closed = True
+        self._task.cancel()
+
+        chunks = split_message(text)
+        await channel_limiter.wait(self.message.channel.id)
+        unsent = chunks[1:]
+        try:
+            await self.message.edit(content=chunks[0])
+        except discord.HTTPException as e:
+            # E.g. the progress message was deleted, the whole response is sent as new messages instead
+            print(f"Could not edit the progress message: {e}")
+            unsent = chunks
+
+        try:
+            for chunk in unsent:
+                await self.message.channel.send(chunk)
+        except discord.HTTPException as e:
+            print(f"Could not send the response: {e}")
+
+    def render(self) -> str:
+        return split_message("\n".join([self.header, *self.lines]))[0]
+
+    def _add(self, text: str):
+        if not self._closed:
+            self.lines.append(text)
+            self._dirty.set()
+
+    async def _run(self):
+        while not self._closed:
+            await self._dirty.wait()
+            self._dirty.clear()
+
+            await channel_limiter.wait(self.message.channel.id)
+            if self._closed:
+                return
+            try:
+                await self.message.edit(content=self.render())
+            except discord.HTTPException as e:
+                print(f"Could not edit the progress message: {e}")
+
+            await asyncio.sleep(self.min_interval)
@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+from utils.cache import LRUCache
+
+
+class RateLimitedError(Exception):
+    """
+        Raised when a call would have to wait longer than its deadline for the rate limiter.
+    """
+
+
+class TokenBucket:
+    """
+        Token bucket refilled with `rate` tokens per second up to `capacity` tokens.
+        Not thread-safe on its own, `RateLimiter` guards it.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """
+            Seconds until a token is available. The balance can be negative when tokens are reserved ahead.
+        """
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """
+        Global and per-key (connected account) token buckets in front of an API.
+
+        A call reserves a token in both buckets and sleeps until its turn comes, so throttled calls queue up in
+        arrival order instead of failing. A call which would wait longer than its deadline takes no token
+        and raises `RateLimitedError`.
+
+        :param required rate: Calls per second allowed in total.
+        :param required burst: Calls allowed at once in total.
+        :param required key_rate: Calls per second allowed per key.
+        :param required key_burst: Calls allowed at once per key.
+        :param optional max_wait: Default deadline in seconds of a call.
+        :param optional max_keys: Maximum number of per-key buckets kept. Idle buckets are full anyway, so dropping them is harmless.
+    """
+
+    def __init__(self, rate: float, burst: float, key_rate: float, key_burst: float, max_wait: float = 30, max_keys: int = 10000):
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.max_wait = max_wait
+        self._global = TokenBucket(rate, burst)
+        self._buckets = LRUCache(maxsize=max_keys, ttl=max(60, key_burst / key_rate * 2))
+        self._lock = threading.Lock()
+
+        self.throttled = 0 # Calls which had to wait
+        self.rejected = 0 # Calls which would have waited past their deadline
+
+    def reserve(self, key: str, timeout: float | None = None) -> float:
+        """
+            Reserve a call and return the number of seconds to wait before making it.
+
+            :param required key: The key of the per-key bucket, e.g. the connected account ID.
+            :param optional timeout: Maximum number of seconds to wait, `max_wait` by default.
+        """
+
+        timeout = self.max_wait if timeout is None else timeout
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.key_rate, self.key_burst)
+            self._buckets.set(key, bucket)
+
+            now = time.monotonic()
+            wait = max(self._global.wait_time(now), bucket.wait_time(now))
+            if wait > timeout:
+                self.rejected += 1
+                raise RateLimitedError(f"Rate limited for {wait:.1f}s, more than the {timeout:.1f}s deadline")
+
+            self._global.take()
+            bucket.take()
+            if wait > 0:
+                self.throttled += 1
+            return wait
+
+    def acquire(self, key: str, timeout: float | None = None) -> float:
+        """
+            Block until a call is allowed. Returns the number of seconds waited.
+        """
+
+        wait = self.reserve(key, timeout)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, key: str, timeout: float | None = None) -> float:
+        """
+            Asyncio version of `acquire`.
+        """
+
+        wait = self.reserve(key, timeout)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        return {"throttled": self.throttled, "rejected": self.rejected, "keys": len(self._buckets)}
+
+
+class SingleFlight:
+    """
+        Coalesce identical blocking calls running at the same time: the first caller runs the call and
+        the others wait for it and share its result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {} # key -> [event, result, exception]
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls) # Calls running now
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = func()
+            return call[1]
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+
+
+class AsyncSingleFlight:
+    """
+        Asyncio version of `SingleFlight`. Must only be used from one event loop.
+    """
+
+    def __init__(self):
+        self._calls = {} # key -> future
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # Mark it retrieved, nobody may be waiting
+            raise
+        finally:
+            del self._calls[key]
@@ -0,0 +1,334 @@
+import asyncio
+import heapq
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from utils.account_store import AccountStore
+from utils.composio import ComposioClient
+from utils.formatting import parse_event_time, format_agenda
+from utils.metrics import registry
+
+
+REMINDER_LEAD = float(os.getenv("REMINDER_LEAD_MINUTES", "10")) * 60 # Seconds before the start of an event its reminder is sent
+REMINDER_SYNC_INTERVAL = float(os.getenv("REMINDER_SYNC_INTERVAL", "900")) # Seconds between two syncs of the upcoming events of an account
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "10")) # Syncs running at once
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "50")) # Direct messages sent at once
+REMINDER_ACCOUNT_REFRESH = float(os.getenv("REMINDER_ACCOUNT_REFRESH", "300")) # Seconds between two reads of the account list
+AGENDA_TIME = os.getenv("AGENDA_TIME", "08:00") # Local time of the daily agenda, empty to disable it
+AGENDA_SPREAD = float(os.getenv("AGENDA_SPREAD", "1800")) # The agendas are sent over that many seconds after AGENDA_TIME, not all at once
+
+SYNC_MARGIN = 300 # Seconds the synced window reaches past the next sync, so a late sync doesn't miss a reminder
+MAX_SLEEP = 60 # Seconds the loop sleeps at most, so a changed clock is noticed
+COMPACT_MIN_SIZE = 1024 # The heap is only rebuilt when it holds at least that many stale entries
+
+reminders_sent = registry.counter("reminders_sent_total", "Reminders and agendas sent by kind (event, agenda).")
+reminder_syncs = registry.counter("reminder_syncs_total", "Syncs of the upcoming events of an account by outcome (ok, failed).")
+
+
+def stagger(user_id: int) -> float:
+    """
+        Fixed position of a user in [0, 1), to spread the work of all the users evenly over an interval.
+    """
+
+    return (user_id * 2654435761 % 2 ** 32) / 2 ** 32
+
+
+class Reminder:
+    """
+        A direct message to send at `fire_at` (epoch seconds), for an event or for the daily agenda (`event_id` None).
+        The scheduler holds one per upcoming event of every user, so it has no `__dict__`.
+    """
+
+    __slots__ = ("fire_at", "user_id", "event_id", "title", "start", "sent")
+
+    def __init__(self, fire_at: float, user_id: int, event_id: str | None = None, title: str = "", start: float = 0.0):
+        self.fire_at = fire_at
+        self.user_id = user_id
+        self.event_id = event_id
+        self.title = title
+        self.start = start
+        self.sent = False
+
+    def __lt__(self, other):
+        return self.fire_at < other.fire_at
+
+
+class ReminderScheduler:
+    """
+        Send "event starting soon" reminders and a daily agenda to every user by direct message.
+
+        The upcoming events of every account are synced every `sync_interval` seconds (staggered over the interval,
+        so the calls are spread evenly) with a `googlecalendar_find_event` query of the window until the next sync.
+        Fire times are kept in a heap. Reminders of moved or deleted events are not removed from the heap, they are
+        skipped when they come out of it (lazy deletion) and the heap is rebuilt when most of it is stale.
+        Due reminders are sent from the event loop in batches, one message per user.
+
+        :param required store: The account store, read for the list of users.
+        :param required client: The Composio client.
+        :param required send: Coroutine function called with `(user_id, text)` to send a direct message.
+        :param optional lead: Seconds before the start of an event its reminder is sent.
+        :param optional sync_interval: Seconds between two syncs of an account.
+        :param optional agenda_time: Local `HH:MM` time of the daily agenda, empty to disable it.
+        :param optional concurrency: Maximum number of syncs running at once.
+        :param optional batch_size: Maximum number of direct messages sent at once.
+    """
+
+    def __init__(self, store: AccountStore, client: ComposioClient, send, lead: float = REMINDER_LEAD, sync_interval: float = REMINDER_SYNC_INTERVAL,
+                 agenda_time: str = AGENDA_TIME, concurrency: int = REMINDER_CONCURRENCY, batch_size: int = REMINDER_BATCH_SIZE):
+        self.store = store
+        self.client = client
+        self.send = send
+        self.lead = lead
+        self.sync_interval = sync_interval
+        self.agenda_time = datetime.strptime(agenda_time, "%H:%M").time() if agenda_time else None
+        self.batch_size = batch_size
+
+        self._accounts = {} # user_id -> connected_account_id
+        self._events = {} # user_id -> {event_id: Reminder}, the current reminders of every user
+        self._agendas = {} # user_id -> Reminder of the next agenda
+        self._timers = [] # heap of Reminder by fire time, including stale ones
+        self._syncs = [] # heap of (next sync time, user_id), including stale ones
+        self._next_sync = {} # user_id -> time of its current entry in the sync heap
+        self._pending = 0 # Reminders in the heap which are still current
+        self._accounts_read_at = 0.0
+
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+        self._wake = asyncio.Event()
+        self._task = None
+        self.sent = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def watch(self, user_id: int, connected_account_id: str, now: float | None = None):
+        """
+            Start sending reminders to a user, e.g. right after the account is connected. Its first sync is staggered over the sync interval.
+        """
+
+        now = time.time() if now is None else now
+        known = user_id in self._accounts
+        self._accounts[user_id] = connected_account_id
+        if known:
+            return
+
+        self._push_sync(user_id, now + stagger(user_id) * self.sync_interval)
+        self._schedule_agenda(user_id, now)
+        self._wake.set()
+
+    def forget(self, user_id: int):
+        """
+            Stop sending reminders to a user. Its heap entries become stale.
+        """
+
+        self._accounts.pop(user_id, None)
+        self._next_sync.pop(user_id, None)
+        self._pending -= sum(1 for reminder in self._events.pop(user_id, {}).values() if not reminder.sent)
+        agenda = self._agendas.pop(user_id, None)
+        if agenda is not None and not agenda.sent:
+            self._pending -= 1
+
+    def apply_events(self, user_id: int, events: list, now: float | None = None):
+        """
+            Replace the reminders of a user with the ones of the events found by a sync (Google Calendar API events).
+            Reminders of unchanged events are kept, so a reminder is never sent twice.
+        """
+
+        now = time.time() if now is None else now
+        scheduled = self._events.get(user_id) or {}
+        current = {}
+        for event in events:
+            start = event.get("start")
+            if event.get("status") == "cancelled" or not isinstance(start, dict) or "dateTime" not in start:
+                continue # All-day events have no reminder
+
+            start = parse_event_time(start).timestamp()
+            if start <= now:
+                continue
+
+            title = event.get("summary") or "(no title)"
+            reminder = scheduled.get(event["id"])
+            if reminder is not None and reminder.start == start:
+                reminder.title = title
+            else:
+                reminder = Reminder(max(start - self.lead, now), user_id, event["id"], title, start)
+                heapq.heappush(self._timers, reminder)
+                self._pending += 1
+            current[event["id"]] = reminder
+
+        # Reminders of the events which moved or disappeared are skipped when they come out of the heap
+        self._pending -= sum(1 for event_id, reminder in scheduled.items() if not reminder.sent and current.get(event_id) is not reminder)
+        if current:
+            self._events[user_id] = current
+        else:
+            self._events.pop(user_id, None)
+
+        if len(self._timers) - self._pending > max(COMPACT_MIN_SIZE, self._pending):
+            self._compact()
+        self._wake.set()
+
+    def due(self, now: float | None = None) -> list[Reminder]:
+        """
+            Take the current reminders whose fire time has come out of the heap.
+        """
+
+        now = time.time() if now is None else now
+        due = []
+        while self._timers and self._timers[0].fire_at <= now:
+            reminder = heapq.heappop(self._timers)
+            if self._is_current(reminder):
+                reminder.sent = True
+                self._pending -= 1
+                due.append(reminder)
+        return due
+
+    async def sync(self, user_id: int, connected_account_id: str):
+        """
+            Fetch the events of the account starting before the next sync and schedule their reminders.
+        """
+
+        now = datetime.now(timezone.utc)
+        time_max = now + timedelta(seconds=self.sync_interval + self.lead + SYNC_MARGIN)
+        async with self._slots:
+            result = await self.client.aexecute_action("googlecalendar_find_event", connected_account_id, {"time_min": now.isoformat(), "time_max": time_max.isoformat()})
+
+        if not result.ok:
+            reminder_syncs.inc(outcome="failed")
+            print(f"Could not sync the reminders of {user_id}: {result.error!r}")
+            return
+
+        reminder_syncs.inc(outcome="ok")
+        if self._accounts.get(user_id) == connected_account_id: # Not forgotten in the meantime
+            self.apply_events(user_id, result.data.get("event_data") or [])
+
+    async def tick(self):
+        """
+            Read the account list if it's due, start the due syncs and send the due reminders.
+        """
+
+        now = time.time()
+        if now - self._accounts_read_at >= REMINDER_ACCOUNT_REFRESH:
+            self._accounts_read_at = now
+            await self._read_accounts(now)
+
+        while self._syncs and self._syncs[0][0] <= now:
+            sync_at, user_id = heapq.heappop(self._syncs)
+            connected_account_id = self._accounts.get(user_id)
+            if connected_account_id is None or self._next_sync.get(user_id) != sync_at:
+                continue # Forgotten, or replaced by the entry of a later `watch`
+            self._push_sync(user_id, now + self.sync_interval)
+            self._spawn(self.sync(user_id, connected_account_id))
+
+        due = self.due(now)
+        if due:
+            await self._dispatch(due)
+
+    def stats(self) -> dict:
+        return {"accounts": len(self._accounts), "scheduled": self._pending, "heap": len(self._timers), "sent": self.sent}
+
+    async def _run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"Sending the reminders failed: {e!r}")
+
+            wake_at = time.time() + MAX_SLEEP
+            if self._timers:
+                wake_at = min(wake_at, self._timers[0].fire_at)
+            if self._syncs:
+                wake_at = min(wake_at, self._syncs[0][0])
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(0.0, wake_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _read_accounts(self, now: float):
+        loop = asyncio.get_running_loop()
+        accounts = dict(await loop.run_in_executor(None, self.store.list_accounts, True))
+        for user_id in [user_id for user_id in self._accounts if user_id not in accounts]:
+            self.forget(user_id)
+        for user_id, connected_account_id in accounts.items():
+            self.watch(user_id, connected_account_id, now)
+
+    async def _dispatch(self, due: list[Reminder]):
+        # One message per user, however many of their events start soon
+        messages = {}
+        for reminder in due:
+            if reminder.event_id is None:
+                self._spawn(self._send_agenda(reminder))
+            else:
+                messages.setdefault(reminder.user_id, []).append(f"⏰ **{reminder.title}** starts <t:{int(reminder.start)}:R> (<t:{int(reminder.start)}:t>)")
+
+        items = list(messages.items())
+        for position in range(0, len(items), self.batch_size):
+            await asyncio.gather(*(self._send(user_id, "\n".join(lines), "event", len(lines)) for user_id, lines in items[position:position + self.batch_size]))
+
+    async def _send_agenda(self, reminder: Reminder):
+        self._schedule_agenda(reminder.user_id, reminder.fire_at + AGENDA_SPREAD)
+
+        connected_account_id = self._accounts.get(reminder.user_id)
+        if connected_account_id is None:
+            return
+
+        day = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+        async with self._slots:
+            result = await self.client.aexecute_action("googlecalendar_find_event", connected_account_id, {"time_min": day.isoformat(), "time_max": (day + timedelta(days=1)).isoformat()})
+
+        if not result.ok:
+            print(f"Could not get the agenda of {reminder.user_id}: {result.error!r}")
+            return
+
+        events = result.data.get("event_data") or []
+        if events: # Nothing is sent on free days
+            await self._send(reminder.user_id, f"Good morning! Here is your day 📅\n{format_agenda(events)}", "agenda")
+
+    async def _send(self, user_id: int, text: str, kind: str, count: int = 1):
+        try:
+            await self.send(user_id, text)
+        except Exception as e:
+            print(f"Could not send a reminder to {user_id}: {e!r}")
+            return
+        self.sent += count
+        reminders_sent.inc(count, kind=kind)
+
+    def _schedule_agenda(self, user_id: int, now: float):
+        if self.agenda_time is None:
+            return
+
+        offset = stagger(user_id) * AGENDA_SPREAD
+        day = datetime.fromtimestamp(now - offset).date()
+        fire_at = datetime.combine(day, self.agenda_time).timestamp() + offset # Naive, so it's the local time of that day
+        if fire_at <= now:
+            fire_at = datetime.combine(day + timedelta(days=1), self.agenda_time).timestamp() + offset
+
+        if self._agendas.get(user_id) is None or self._agendas[user_id].sent:
+            self._pending += 1
+        reminder = self._agendas[user_id] = Reminder(fire_at, user_id)
+        heapq.heappush(self._timers, reminder)
+
+    def _is_current(self, reminder: Reminder) -> bool:
+        if reminder.event_id is None:
+            return self._agendas.get(reminder.user_id) is reminder and not reminder.sent
+        return (self._events.get(reminder.user_id) or {}).get(reminder.event_id) is reminder and not reminder.sent
+
+    def _push_sync(self, user_id: int, sync_at: float):
+        self._next_sync[user_id] = sync_at
+        heapq.heappush(self._syncs, (sync_at, user_id))
+
+    def _compact(self):
+        self._timers = [reminder for reminder in self._timers if self._is_current(reminder)]
+        heapq.heapify(self._timers)
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,178 @@
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from utils.cache import LRUCache
+from utils.settings import get_settings
+
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "120")) # Seconds a response to a read-only query is reused
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+
+# Words which make a prompt change the calendar, such prompts are never cached
+MUTATING_WORDS = {
+    "create", "schedule", "add", "book", "set", "delete", "cancel", "remove", "move", "reschedule", "update", "change",
+    "rename", "invite", "uninvite", "postpone", "edit", "clear", "accept", "decline", "import",
+}
+
+# Words which refer to the earlier conversation, the answer depends on more than the prompt then
+CONTEXT_WORDS = {"it", "its", "that", "this", "them", "those", "these", "also", "again", "same", "instead", "about", "else", "there", "then"}
+
+# Words which don't change the meaning of a read-only query
+FILLER_WORDS = {"please", "pls", "hey", "hi", "hello", "can", "could", "would", "you", "tell", "me", "kindly", "just", "the", "a", "an", "my"}
+
+CONTRACTIONS = {"what's": "what is", "whats": "what is", "i've": "i have", "i'm": "i am", "anything's": "anything is", "there's": "there is"}
+
+_local = threading.local()
+
+
+def normalize_query(prompt: str) -> str:
+    """
+        Reduce a prompt to the words which matter for its answer, so "What's on tomorrow?" and "what is on tomorrow" share a cache entry.
+    """
+
+    words = []
+    for word in prompt.lower().split():
+        word = CONTRACTIONS.get(word.strip("?!.,"), word)
+        for part in word.split():
+            part = re.sub(r"^[^\w@]+|[^\w@]+$", "", part)
+            if part and part not in FILLER_WORDS:
+                words.append(part)
+    return " ".join(words)
+
+
+def record_failure():
+    """
+        Mark the response being built in this thread as not cacheable, e.g. because a tool failed.
+    """
+
+    if getattr(_local, "failures", None) is not None:
+        _local.failures.append(True)
+
+
+@contextmanager
+def failure_tracking():
+    """
+        Collect the failures recorded with `record_failure` in the current thread during the `with` block.
+    """
+
+    previous = getattr(_local, "failures", None)
+    _local.failures = failures = []
+    try:
+        yield failures
+    finally:
+        _local.failures = previous
+
+
+class SQLiteGenerations:
+    """
+        Generation numbers of the accounts shared by the processes of one machine, so a change made by one agent
+        worker invalidates the responses cached by the others (`AGENT_POOL=process` or `queue`).
+
+        :param required path: Path of the database file.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS generations (connected_account_id TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+
+    def get(self, connectedAccountId: str, default: int = 0) -> int:
+        with self._lock:
+            row = self._connection.execute("SELECT generation FROM generations WHERE connected_account_id = ?", (connectedAccountId,)).fetchone()
+        return row[0] if row is not None else default
+
+    def bump(self, connectedAccountId: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO generations (connected_account_id, generation) VALUES (?, 1) "
+                "ON CONFLICT (connected_account_id) DO UPDATE SET generation = generation + 1",
+                (connectedAccountId,)
+            )
+
+
+class ResponseCache:
+    """
+        Cache of the responses to read-only queries ("what's on tomorrow", "do I have anything with Alice").
+
+        Entries are keyed by the connected account, the normalised query and the day it was asked.
+        Every account has a generation number which is bumped by `invalidate` when one of its events changes.
+        It's part of the key, so older entries are never read again and simply expire. When the agent runs in
+        several processes the generations must be kept in a `SQLiteGenerations` they share.
+
+        :param optional maxsize: Maximum number of cached responses.
+        :param optional ttl: Seconds a response is reused.
+        :param optional generations: Shared generations, None to keep them in this process.
+    """
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL, generations: SQLiteGenerations | None = None):
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._generations = generations if generations is not None else {} # connectedAccountId -> generation
+        self._lock = threading.Lock()
+
+    def key(self, connectedAccountId: str, prompt: str, intent=None, now: datetime | None = None) -> tuple | None:
+        """
+            Get the cache key of a prompt, or None if it isn't a read-only query.
+
+            :param required connectedAccountId: The ID of the connected account of the user.
+            :param required prompt: The prompt of the user.
+            :param optional intent: The intent the router recognised in the prompt, if any.
+            :param optional now: The current local time (defaults to now).
+        """
+
+        if intent is not None:
+            if intent.name != "list_events":
+                return None
+            query = f"list_events {' '.join(intent.slots['when'].lower().split())}"
+        else:
+            query = normalize_query(prompt)
+            words = query.split()
+            if not words or MUTATING_WORDS.intersection(words) or CONTEXT_WORDS.intersection(words):
+                return None
+
+        day = (now or datetime.now().astimezone()).date().isoformat() # "tomorrow" means something else after midnight
+        return (connectedAccountId, self._generations.get(connectedAccountId, 0), query, day)
+
+    def get(self, key: tuple) -> str | None:
+        return self._cache.get(key)
+
+    def set(self, key: tuple, response: str):
+        """
+            Cache a response, unless the account changed since the key was made.
+        """
+
+        if key[1] == self._generations.get(key[0], 0):
+            self._cache.set(key, response)
+
+    def invalidate(self, connectedAccountId: str):
+        """
+            Drop the cached responses of an account. Called by the tools which change its events.
+        """
+
+        if isinstance(self._generations, SQLiteGenerations):
+            self._generations.bump(connectedAccountId)
+            return
+
+        with self._lock:
+            self._generations[connectedAccountId] = self._generations.get(connectedAccountId, 0) + 1
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+# Shared with the other processes of the machine, a change made by any agent worker or by the outbox flusher invalidates it
+response_cache = ResponseCache(generations=SQLiteGenerations(get_settings().cache_generations_path))
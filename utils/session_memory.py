@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from utils.cache import LRUCache
+from utils.formatting import estimate_tokens, shorten
+
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", "900")) # Seconds of inactivity after which a conversation is forgotten
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "400")) # Maximum size of the context added to a prompt
+SESSION_MAX_TURNS = 3 # Turns kept word for word, older ones are compacted into one line each
+SESSION_MAX_EVENTS = 8 # Events the user worked with recently
+TURN_TEXT_LIMIT = 300 # Characters kept of a prompt or response
+
+
+class Session:
+    """
+        Short-term memory of the conversation with one user: the last turns, summaries of the older ones
+        and the events the user worked with. Its rendered context never exceeds `token_budget` tokens.
+
+        :param optional token_budget: Maximum number of tokens of the rendered context.
+    """
+
+    def __init__(self, token_budget: int = SESSION_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.turns = deque() # (prompt, response)
+        self.summaries = deque() # One line per compacted turn
+        self.events = OrderedDict() # event_id -> (title, start), most recent last
+        self._lock = threading.Lock()
+
+    def add_turn(self, prompt: str, response: str):
+        with self._lock:
+            self.turns.append((shorten(prompt, TURN_TEXT_LIMIT), shorten(response, TURN_TEXT_LIMIT)))
+            while len(self.turns) > SESSION_MAX_TURNS:
+                self._compact_oldest()
+            self._fit()
+
+    def remember_event(self, event_id: str, title: str | None, start: datetime | None = None):
+        with self._lock:
+            self.events.pop(event_id, None)
+            self.events[event_id] = (shorten(title or "(no title)", 80), start)
+            while len(self.events) > SESSION_MAX_EVENTS:
+                self.events.popitem(last=False)
+            self._fit()
+
+    def forget_event(self, event_id: str):
+        with self._lock:
+            self.events.pop(event_id, None)
+
+    def render(self) -> str:
+        with self._lock:
+            return self._render()
+
+    def _render(self) -> str:
+        parts = []
+        if self.events:
+            lines = []
+            for event_id, (title, start) in reversed(self.events.items()): # Most recent first
+                when = f" at {start:%Y-%m-%d %H:%M}" if start is not None else ""
+                lines.append(f"- `{title}`{when} (ID {event_id})")
+            parts.append("Events the user worked with recently, most recent first (use these IDs instead of looking them up again):\n" + "\n".join(lines))
+        if self.summaries or self.turns:
+            lines = list(self.summaries)
+            lines.extend(f"- User: {prompt}\n  You: {response}" for prompt, response in self.turns)
+            parts.append("Earlier in this conversation:\n" + "\n".join(lines))
+        return "\n".join(parts)
+
+    def _compact_oldest(self):
+        prompt, response = self.turns.popleft()
+        self.summaries.append(f"- User asked \"{shorten(prompt, 80)}\", you answered \"{shorten(response.split(chr(10))[0], 80)}\"")
+
+    def _fit(self):
+        """
+            Drop the oldest context until it fits in the token budget: summaries first, then turns, then events.
+        """
+
+        while estimate_tokens(self._render()) > self.token_budget:
+            if self.summaries:
+                self.summaries.popleft()
+            elif len(self.turns) > 1:
+                self._compact_oldest()
+            elif len(self.events) > 1:
+                self.events.popitem(last=False)
+            elif self.turns:
+                self.turns.popleft()
+            else:
+                self.events.clear()
+                return
+
+
+class SessionStore:
+    """
+        Sessions of the users by connected account ID. Idle sessions expire after `ttl` seconds and the least
+        recently used ones are dropped beyond `maxsize` sessions.
+
+        Sessions live in the memory of the process running the agent. With `AGENT_POOL=process` or `queue`, the next
+        prompt of a user may be handled by another process, which doesn't have the earlier context.
+
+        :param optional maxsize: Maximum number of sessions kept.
+        :param optional ttl: Seconds of inactivity after which a session expires.
+        :param optional token_budget: Maximum number of tokens of the context of one session.
+    """
+
+    def __init__(self, maxsize: int = SESSION_MAX_SESSIONS, ttl: float = SESSION_TTL, token_budget: int = SESSION_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self._sessions = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def session(self, connectedAccountId: str) -> Session:
+        """
+            Get the session of an account, creating it if needed. Using a session keeps it alive for another `ttl` seconds.
+        """
+
+        with self._lock:
+            session = self._sessions.get(connectedAccountId)
+            if session is None:
+                session = Session(self.token_budget)
+            self._sessions.set(connectedAccountId, session)
+        return session
+
+    def context(self, connectedAccountId: str) -> str:
+        """
+            Get the context of the conversation to add to the next prompt of the account ("" if there is none).
+        """
+
+        session = self._sessions.get(connectedAccountId)
+        return session.render() if session is not None else ""
+
+    def record_turn(self, connectedAccountId: str, prompt: str, response: str):
+        self.session(connectedAccountId).add_turn(prompt, response)
+
+    def remember_event(self, connectedAccountId: str, event_id: str, title: str | None, start: datetime | None = None):
+        self.session(connectedAccountId).remember_event(event_id, title, start)
+
+    def forget_event(self, connectedAccountId: str, event_id: str):
+        session = self._sessions.get(connectedAccountId)
+        if session is not None:
+            session.forget_event(event_id)
+
+    def clear(self, connectedAccountId: str):
+        self._sessions.pop(connectedAccountId)
+
+    def stats(self) -> dict:
+        return self._sessions.stats()
+
+
+sessions = SessionStore()
@@ -0,0 +1,66 @@
+import functools
+import os
+import dotenv
+
+
+# Loaded once per process, before any module reads its own tuning variables with `os.getenv`
+dotenv.load_dotenv()
+
+
+class Settings:
+    """
+        Configuration of the deployment, read once from the environment (and `.env`).
+
+        Only the secrets and the settings shared by several entry points live here, the tuning knobs of a
+        module stay next to the code they tune. Use `get_settings()` instead of building it.
+    """
+
+    __slots__ = (
+        "discord_bot_token", "integration_id", "composio_api_key", "google_api_key",
+        "agent_pool", "agent_max_workers", "agent_max_per_guild", "agent_max_queue",
+        "account_db_path", "account_cache_size", "account_cache_ttl", "job_queue_path",
+        "shard_count", "shard_ids", "onboarding_poller", "reminders_enabled", "agent_warm_up",
+        "outbox_enabled", "outbox_path", "outbox_flusher", "contact_db_path", "cache_generations_path",
+    )
+
+    def __init__(self, environ=os.environ):
+        self.discord_bot_token = environ.get("DISCORD_BOT_TOKEN")
+        self.integration_id = environ.get("INTEGRATION_ID")
+        self.composio_api_key = environ.get("COMPOSIO_API_KEY") # Get the API key from composio
+        self.google_api_key = environ.get("GOOGLE_API_KEY") # Google API Key
+
+        self.agent_pool = environ.get("AGENT_POOL", "thread") # "thread", "process" or "queue" (handled by `worker.py` processes)
+        self.agent_max_workers = int(environ.get("AGENT_MAX_WORKERS", "4"))
+        self.agent_max_per_guild = int(environ.get("AGENT_MAX_PER_GUILD", "2"))
+        self.agent_max_queue = int(environ.get("AGENT_MAX_QUEUE", "100"))
+        self.agent_warm_up = environ.get("AGENT_WARM_UP", "true").lower() == "true" # Load the agent stack in the background once the bot is online
+
+        self.account_db_path = environ.get("ACCOUNT_DB_PATH", "./db/accounts.sqlite3")
+        self.account_cache_size = int(environ.get("ACCOUNT_CACHE_SIZE", "10000"))
+        self.account_cache_ttl = float(environ.get("ACCOUNT_CACHE_TTL", "60")) # Other processes may change an account
+        self.job_queue_path = environ.get("JOB_QUEUE_PATH", "./db/jobs.sqlite3")
+        self.outbox_enabled = environ.get("OUTBOX_ENABLED", "true").lower() == "true" # Calendar changes are confirmed once written to the outbox and applied in the background
+        self.outbox_path = environ.get("OUTBOX_PATH", "./db/outbox.sqlite3")
+        self.contact_db_path = environ.get("CONTACT_DB_PATH", "./db/contacts.sqlite3") # Emails linked by the members and attendees seen by the users
+        self.cache_generations_path = environ.get("CACHE_GENERATIONS_PATH", "./db/cache_generations.sqlite3") # Invalidations of the response cache shared by the agent processes
+
+        self.shard_count = int(environ.get("SHARD_COUNT", "0")) # Total number of shards, 0 for an unsharded bot
+        self.shard_ids = [int(shard_id) for shard_id in environ.get("SHARD_IDS", "").split(",") if shard_id.strip()] or None # Shards run by this process, all if empty
+        self.onboarding_poller = environ.get("ONBOARDING_POLLER", "true").lower() == "true" # Only one gateway process needs to poll the pending accounts
+        self.reminders_enabled = environ.get("REMINDERS_ENABLED", "true").lower() == "true" # Only one gateway process may send the reminders
+        self.outbox_flusher = environ.get("OUTBOX_FLUSHER", "true").lower() == "true" # Only one gateway process may apply the outbox
+
+    def require(self, name: str) -> str:
+        """
+            Get a setting which must be set, e.g. `require("composio_api_key")`. Raises `KeyError` with the variable name if it's missing.
+        """
+
+        value = getattr(self, name)
+        if not value:
+            raise KeyError(name.upper())
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    return Settings()
@@ -0,0 +1,117 @@
+"""
+    Agent worker of the sharded deployment.
+
+    Gateway processes started with `AGENT_POOL=queue` don't run the agent themselves, they add every
+    `!calendar` request to the job queue (`JOB_QUEUE_PATH`). Worker processes take the jobs from the queue,
+    run them and store the response for the gateway to send. Start as many processes as the machine has cores.
+
+    Usage: python worker.py [--processes 4] [--threads 2]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from utils.settings import get_settings
+from utils.metrics import startup_phase
+
+
+settings = get_settings()
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "1")) # Jobs run at the same time by one process
+WORKER_IDLE_SLEEP = float(os.getenv("WORKER_IDLE_SLEEP", "0.1")) # Seconds to wait when the queue is empty
+WORKER_MAINTENANCE_INTERVAL = 60 # Seconds between two cleanups of expired and old jobs
+
+
+def keep_alive(queue, job_id: int, done: threading.Event):
+    """
+        Renew the lease of a running job until `done` is set, so a slow job isn't handed to a second worker.
+    """
+
+    from utils.job_queue import JOB_HEARTBEAT_INTERVAL
+
+    while not done.wait(JOB_HEARTBEAT_INTERVAL):
+        queue.heartbeat(job_id)
+
+
+def work(queue, name: str, stop: threading.Event):
+    """
+        Take jobs from the queue and run them until `stop` is set.
+    """
+
+    from utils.executor import resolve_function
+
+    last_maintenance = 0.0
+    while not stop.is_set():
+        job = queue.claim(name)
+        if job is None:
+            if time.monotonic() - last_maintenance > WORKER_MAINTENANCE_INTERVAL:
+                last_maintenance = time.monotonic()
+                queue.requeue_expired()
+                queue.purge()
+            stop.wait(WORKER_IDLE_SLEEP)
+            continue
+
+        kwargs = {}
+        if job.payload.get("progress"):
+            kwargs["on_progress"] = lambda text, job_id=job.job_id: queue.add_progress(job_id, text)
+
+        done = threading.Event()
+        threading.Thread(target=keep_alive, args=(queue, job.job_id, done), daemon=True).start()
+        try:
+            func = resolve_function(job.payload["func"])
+            result = func(*job.payload["args"], **kwargs)
+        except Exception as e:
+            print(f"Job {job.job_id} of {job.user_id} failed: {e!r}")
+            queue.finish(job.job_id, "Something went wrong. Please try again.", failed=True)
+        else:
+            queue.finish(job.job_id, result)
+        finally:
+            done.set()
+
+
+def run_process(index: int, threads: int):
+    from utils.job_queue import SQLiteJobQueue
+    from utils.executor import resolve_function
+
+    # Load the agent before taking jobs, so the first job doesn't wait for the imports
+    if settings.agent_warm_up:
+        with startup_phase("import_agent"):
+            resolve_function("utils.manage_events:manage_events")
+
+    queue = SQLiteJobQueue(settings.job_queue_path, max_per_guild=settings.agent_max_per_guild)
+    stop = threading.Event()
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Worker {index} ({name}) is running {threads} thread(s)")
+
+    workers = [threading.Thread(target=work, args=(queue, f"{name}:{number}", stop), daemon=True) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run agent workers for the gateway processes.")
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES)
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS)
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_process(0, args.threads)
+    else:
+        processes = [multiprocessing.Process(target=run_process, args=(index, args.threads), name=f"worker-{index}") for index in range(args.processes)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()